@@ -0,0 +1,195 @@
+import pickle
+import sys
+import unittest
+from datetime import datetime, timedelta
+from functools import lru_cache
+
+_EPOCH = datetime(1970, 1, 1)
+
+# IMO written for vessels whose static data has none (`Unknown`, or missing)
+UNKNOWN_IMO = 1
+
+
+def parse_timestamp(timestamp):
+    """
+    Parse the timestamp of an AIS message, e.g. `2020-11-18T00:00:00.000Z`
+
+    :rtype: datetime
+    """
+    return datetime.strptime(timestamp, '%Y-%m-%dT%H:%M:%S.%fZ')
+
+
+def to_epoch_us(timestamp):
+    """
+    Microseconds since the epoch of a naive UTC datetime
+    """
+    delta = timestamp - _EPOCH
+    return (delta.days * 86400 + delta.seconds) * 1000000 + delta.microseconds
+
+
+def from_epoch_us(timestamp):
+    """
+    Naive UTC datetime of a number of microseconds since the epoch
+    """
+    return _EPOCH + timedelta(microseconds=timestamp)
+
+
+@lru_cache(maxsize=4096)
+def timestamp_us(timestamp):
+    """
+    Microseconds since the epoch of the timestamp of an AIS message
+
+    A receiver's messages share few distinct timestamps (one per second or so), so each is parsed once.
+    """
+    return to_epoch_us(parse_timestamp(timestamp))
+
+
+class AISMessage:
+    """
+    An AIS message of a type whose details are not stored: the columns of AIS_MESSAGE only
+
+    Timestamps are int microseconds since the epoch; `datetime` gives the naive UTC datetime.
+    """
+    __slots__ = ('msg_type', 'mmsi', 'timestamp', 'msg_class')
+
+    def __init__(self, msg_type, mmsi, timestamp, msg_class):
+        self.msg_type = msg_type
+        self.mmsi = mmsi
+        self.timestamp = timestamp
+        self.msg_class = msg_class
+
+    @property
+    def datetime(self):
+        return from_epoch_us(self.timestamp)
+
+    def _fields(self):
+        return [name for cls in reversed(type(self).__mro__) for name in getattr(cls, '__slots__', ())]
+
+    def __eq__(self, other):
+        return type(self) is type(other) and all(getattr(self, name) == getattr(other, name) for name in self._fields())
+
+    def __repr__(self):
+        return f"{type(self).__name__}({', '.join(f'{name}={getattr(self, name)!r}' for name in self._fields())})"
+
+
+class PositionReport(AISMessage):
+    """
+    A position report, with float coordinates and the rate of turn defaulted to 0
+    """
+    __slots__ = ('status', 'latitude', 'longitude', 'rot', 'sog', 'cog', 'heading')
+
+    def __init__(self, mmsi, timestamp, msg_class, status, latitude, longitude, rot=0, sog=None, cog=None, heading=None):
+        self.msg_type = "position_report"
+        self.mmsi = mmsi
+        self.timestamp = timestamp
+        self.msg_class = msg_class
+        self.status = status
+        self.latitude = latitude
+        self.longitude = longitude
+        self.rot = rot
+        self.sog = sog
+        self.cog = cog
+        self.heading = heading
+
+
+class StaticData(AISMessage):
+    """
+    The static data of a vessel, with `UNKNOWN_IMO` for a vessel without IMO
+    """
+    __slots__ = ('imo', 'name', 'vessel_type', 'length', 'breadth')
+
+    def __init__(self, mmsi, timestamp, msg_class, imo=UNKNOWN_IMO, name=None, vessel_type=None, length=None, breadth=None):
+        self.msg_type = "static_data"
+        self.mmsi = mmsi
+        self.timestamp = timestamp
+        self.msg_class = msg_class
+        self.imo = imo
+        self.name = name
+        self.vessel_type = vessel_type
+        self.length = length
+        self.breadth = breadth
+
+
+def decode_message(doc):
+    """
+    Record of a parsed AIS message document; the fields the database does not store are dropped
+
+    :param: doc: a message as parsed from JSON
+    :type: doc: dict
+    :rtype: AISMessage
+    """
+    msg_type = doc.get("MsgType")
+    mmsi = int(doc["MMSI"])
+    timestamp = timestamp_us(doc["Timestamp"])
+    msg_class = doc.get("Class")
+    if msg_type == "position_report":
+        coordinates = doc["Position"]["coordinates"]
+        return PositionReport(mmsi, timestamp, msg_class, doc.get("Status"), float(coordinates[0]), float(coordinates[1]),
+                              doc.get("RoT", 0), doc.get("SoG"), doc.get("CoG"), doc.get("Heading"))
+    if msg_type == "static_data":
+        imo = doc.get("IMO")
+        return StaticData(mmsi, timestamp, msg_class, imo if type(imo) is int else UNKNOWN_IMO,
+                          doc.get("Name"), doc.get("VesselType"), doc.get("Length"), doc.get("Breadth"))
+    return AISMessage(msg_type, mmsi, timestamp, msg_class)
+
+
+def decode_messages(docs):
+    """
+    Records of parsed AIS message documents
+
+    :param: docs: messages as parsed from JSON
+    :type: docs: list
+    :rtype: list of AISMessage
+    """
+    return [decode_message(doc) for doc in docs]
+
+
+class AISRecordsTest(unittest.TestCase):
+
+    position = {"Timestamp": "2020-11-18T00:00:01.500Z", "Class": "Class A", "MMSI": 304858000, "MsgType": "position_report",
+                "Position": {"type": "Point", "coordinates": [55.218332, 13]}, "Status": "Under way using engine",
+                "SoG": 10.8, "CoG": 94.3, "Heading": 97}
+
+    def test_timestamps(self):
+        """
+        Timestamps are kept as microseconds since the epoch, and convert back to the same datetime.
+        """
+        self.assertEqual(timestamp_us("1970-01-01T00:00:01.500Z"), 1500000)
+        timestamp = parse_timestamp(self.position["Timestamp"])
+        self.assertEqual(from_epoch_us(to_epoch_us(timestamp)), timestamp)
+        self.assertEqual(decode_message(self.position).datetime, timestamp)
+
+    def test_decode_position_report(self):
+        """
+        Function `decode_message` gives float coordinates and defaults the rate of turn to 0.
+        """
+        record = decode_message(self.position)
+        self.assertIsInstance(record, PositionReport)
+        self.assertEqual((record.mmsi, record.latitude, record.longitude, record.rot), (304858000, 55.218332, 13.0, 0))
+        self.assertIs(type(record.longitude), float)
+        self.assertEqual(record, decode_message(dict(self.position, RoT=0)))
+
+    def test_decode_static_data(self):
+        """
+        Function `decode_message` writes vessels without IMO with `UNKNOWN_IMO`, and keeps other types bare.
+        """
+        record = decode_message({"Timestamp": "2020-11-18T00:00:00.000Z", "Class": "AtoN", "MMSI": 992111840,
+                                 "MsgType": "static_data", "IMO": "Unknown", "Name": "WIND FARM BALTIC1NW",
+                                 "VesselType": "Undefined", "Length": 60, "Breadth": 60, "A": 30})
+        self.assertEqual((record.imo, record.name, record.length), (UNKNOWN_IMO, "WIND FARM BALTIC1NW", 60))
+        other = decode_message({"Timestamp": "2020-11-18T00:00:00.000Z", "MMSI": 1, "MsgType": "aton_report"})
+        self.assertEqual(type(other), AISMessage)
+        self.assertEqual(other.msg_type, "aton_report")
+
+    def test_compact(self):
+        """
+        Records have no per-instance dict, are smaller than the documents they come from and pickle.
+        """
+        record = decode_message(self.position)
+        self.assertFalse(hasattr(record, '__dict__'))
+        self.assertLess(sys.getsizeof(record), sys.getsizeof(self.position))
+        self.assertEqual(pickle.loads(pickle.dumps(record)), record)
+
+
+if __name__ == '__main__':
+    unittest.main()
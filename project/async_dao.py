@@ -0,0 +1,250 @@
+import asyncio
+import functools
+import threading
+import time
+import unittest
+from concurrent.futures import ThreadPoolExecutor
+from mysqlutils import SQL_runner
+from tmb_dao import TMB_DAO
+
+DEFAULT_MAX_CONCURRENCY = 8
+
+
+class AsyncSQL_runner:
+    """
+    Awaitable front of a :class:`SQL_runner`, running each call in a bounded thread pool
+
+    At most `max_concurrency` calls run at once; further callers wait for a free slot. A call's
+    connection is borrowed and returned inside its worker thread, so cancelling the awaiting task
+    never leaks it: a call that has started runs to completion and returns its connection before
+    its slot is freed, and a call still waiting for a thread is dropped without borrowing one.
+
+    Keep the connection pool (`[POOL] size`) at least as large as `max_concurrency`, or the
+    extra threads wait for a connection instead of overlapping queries.
+    """
+
+    def __init__(self, runner=None, max_concurrency=DEFAULT_MAX_CONCURRENCY, executor=None):
+        """
+        :param: runner: runner the calls are made on
+        :type: runner: SQL_runner
+        :param: max_concurrency: maximum number of calls in flight
+        :type: max_concurrency: int
+        :param: executor: thread pool to run the calls in, one of `max_concurrency` threads if not given
+        :type: executor: concurrent.futures.Executor
+        """
+        if max_concurrency < 1:
+            raise ValueError("max_concurrency must be at least 1")
+        self.runner = runner if runner is not None else SQL_runner()
+        self.max_concurrency = max_concurrency
+        self._owns_executor = executor is None
+        self._executor = executor if executor is not None else ThreadPoolExecutor(max_workers=max_concurrency, thread_name_prefix="sql")
+        self._slots = asyncio.Semaphore(max_concurrency)
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def close(self):
+        """
+        Wait for the running calls and stop the thread pool, if the runner created it
+        """
+        if self._owns_executor:
+            self._executor.shutdown(wait=True)
+
+    async def call(self, function, *args, **kwargs):
+        """
+        Run a blocking function in the thread pool, within the concurrency limit
+
+        :return: the function's result
+        """
+        loop = asyncio.get_running_loop()
+        await self._slots.acquire()
+        try:
+            future = self._executor.submit(function, *args, **kwargs)
+        except BaseException:
+            self._slots.release()
+            raise
+
+        def release(_):
+            # The slot is freed when the call is over in its thread, not when the awaiting task
+            # is cancelled, so that cancelled calls still count against the limit until they end
+            try:
+                loop.call_soon_threadsafe(self._slots.release)
+            except RuntimeError:
+                pass  # the event loop is closed
+
+        future.add_done_callback(release)
+        return await asyncio.wrap_future(future)
+
+    async def execute(self, sql, params=()):
+        """
+        Awaitable :meth:`SQL_runner.execute`
+        """
+        return await self.call(self.runner.execute, sql, params)
+
+    async def executemany(self, sql, seq_params):
+        """
+        Awaitable :meth:`SQL_runner.executemany`
+        """
+        return await self.call(self.runner.executemany, sql, seq_params)
+
+    async def run_multi(self, script, params=None):
+        """
+        Awaitable :meth:`SQL_runner.run_multi`
+        """
+        return await self.call(self.runner.run_multi, script, params)
+
+    async def run(self, query):
+        """
+        Awaitable :meth:`SQL_runner.run`
+        """
+        return await self.call(self.runner.run, query)
+
+
+def _awaitable(name):
+    """
+    Awaitable version of the TMB_DAO method `name`, run on the DAO's thread pool
+    """
+    method = getattr(TMB_DAO, name)
+
+    @functools.wraps(method)
+    async def wrapper(self, *args, **kwargs):
+        return await self.runner.call(getattr(self.dao, name), *args, **kwargs)
+
+    return wrapper
+
+
+class AsyncTMB_DAO:
+    """
+    TMB_DAO whose ingest and read methods are coroutines, so that many queries and ingest
+    chunks can be in flight at once
+
+    Each method takes the same arguments and returns the same values as its TMB_DAO counterpart.
+    """
+
+    def __init__(self, dao=None, max_concurrency=DEFAULT_MAX_CONCURRENCY, executor=None):
+        """
+        :param: dao: the DAO doing the work, a new one if not given
+        :type: dao: TMB_DAO
+        :param: max_concurrency: maximum number of DAO calls in flight
+        :type: max_concurrency: int
+        :param: executor: thread pool to run the calls in
+        :type: executor: concurrent.futures.Executor
+        """
+        self.dao = dao if dao is not None else TMB_DAO()
+        self.runner = AsyncSQL_runner(max_concurrency=max_concurrency, executor=executor)
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def close(self):
+        self.runner.close()
+
+    insert_message_batch = _awaitable("insert_message_batch")
+    insert_message_batch_bulk = _awaitable("insert_message_batch_bulk")
+    insert_message_stream = _awaitable("insert_message_stream")
+    insert_message = _awaitable("insert_message")
+    flush = _awaitable("flush")
+    delete_all_msg_timestamp = _awaitable("delete_all_msg_timestamp")
+    read_most_recent_ship_pos = _awaitable("read_most_recent_ship_pos")
+    read_pos_MMSI = _awaitable("read_pos_MMSI")
+    read_pos_MMSI_many = _awaitable("read_pos_MMSI_many")
+    read_vessel_info = _awaitable("read_vessel_info")
+    read_vessel_info_many = _awaitable("read_vessel_info_many")
+    read_most_recent_ship_pos_in_tile = _awaitable("read_most_recent_ship_pos_in_tile")
+    read_all_ports = _awaitable("read_all_ports")
+    read_all_ship_pos_scale3 = _awaitable("read_all_ship_pos_scale3")
+    read_last_5_pos = _awaitable("read_last_5_pos")
+    read_last_5_pos_many = _awaitable("read_last_5_pos_many")
+    read_last_n_pos = _awaitable("read_last_n_pos")
+    read_last_n_pos_many = _awaitable("read_last_n_pos_many")
+    read_positions_between = _awaitable("read_positions_between")
+    read_position_to_port_id = _awaitable("read_position_to_port_id")
+    read_position_to_port_id_many = _awaitable("read_position_to_port_id_many")
+    read_position_given_port = _awaitable("read_position_given_port")
+    read_position_given_port_many = _awaitable("read_position_given_port_many")
+    find_tiles_zoom_2 = _awaitable("find_tiles_zoom_2")
+    find_tiles_zoom_2_many = _awaitable("find_tiles_zoom_2_many")
+    find_tile_from_id = _awaitable("find_tile_from_id")
+
+    async def insert_message_batches(self, batches, max_packet_size=None):
+        """
+        Insert several batches of messages concurrently, each in its own bulk transaction
+
+        :param: batches: strings that represent JSON arrays of docs
+        :type: batches: list
+        :return: the result of `insert_message_batch_bulk` for each batch, in order
+        :rtype: list
+        """
+        kwargs = {} if max_packet_size is None else {"max_packet_size": max_packet_size}
+        return await asyncio.gather(*(self.insert_message_batch_bulk(batch, **kwargs) for batch in batches))
+
+
+class AsyncTMBTest(unittest.TestCase):
+
+    batch = """[ {\"Timestamp\":\"2020-11-18T00:00:00.000Z\",\"Class\":\"Class A\",\"MMSI\":304858000,\"MsgType\":\"position_report\",\"Position\":{\"type\":\"Point\",\"coordinates\":[55.218332,13.371672]},\"Status\":\"Under way using engine\",\"SoG\":10.8,\"CoG\":94.3,\"Heading\":97},
+                {\"Timestamp\":\"2020-11-18T00:00:00.000Z\",\"Class\":\"Class A\",\"MMSI\":219005465,\"MsgType\":\"static_data\",\"IMO\":\"Unknown\",\"CallSign\":\"OXAD2\",\"Name\":\"SAGA\",\"VesselType\":\"Passenger\",\"Length\":35,\"Breadth\":11,\"Draught\":4.1,\"Destination\":\"DK HOR\"} ]"""
+
+    def test_awaitable_methods(self):
+        """
+        The DAO methods return the same values as the synchronous ones when awaited.
+        """
+        async def main():
+            async with AsyncTMB_DAO(TMB_DAO(True)) as tmb:
+                return await asyncio.gather(tmb.insert_message(self.batch), tmb.read_last_n_pos(1, 5),
+                                            tmb.insert_message_batches([self.batch, self.batch]))
+
+        inserted, positions, counts = asyncio.run(main())
+        self.assertEqual((inserted, positions), (2, []))
+        self.assertEqual(counts[1], {"AIS_MESSAGE": 2, "STATIC_DATA": 1, "POSITION_REPORT": 1})
+
+    def test_concurrency_limit(self):
+        """
+        Function `call` runs at most `max_concurrency` calls at once.
+        """
+        lock = threading.Lock()
+        running = [0, 0]
+
+        def query():
+            with lock:
+                running[0] += 1
+                running[1] = max(running[1], running[0])
+            time.sleep(0.01)
+            with lock:
+                running[0] -= 1
+
+        async def main():
+            async with AsyncSQL_runner(runner=object(), max_concurrency=3) as runner:
+                await asyncio.gather(*(runner.call(query) for _ in range(12)))
+
+        asyncio.run(main())
+        self.assertEqual(running[1], 3)
+
+    def test_cancellation(self):
+        """
+        A cancelled call keeps its slot until it has finished in its thread.
+        """
+        finished = threading.Event()
+
+        def query():
+            time.sleep(0.05)
+            finished.set()
+
+        async def main():
+            async with AsyncSQL_runner(runner=object(), max_concurrency=1) as runner:
+                task = asyncio.ensure_future(runner.call(query))
+                await asyncio.sleep(0.01)
+                task.cancel()
+                await runner.call(lambda: None)
+                return finished.is_set()
+
+        self.assertTrue(asyncio.run(main()))
+
+
+if __name__ == '__main__':
+    unittest.main()
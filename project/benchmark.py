@@ -0,0 +1,397 @@
+import argparse
+import builtins
+import contextlib
+import heapq
+import io
+import json
+import math
+import random
+import sys
+import time
+import unittest
+from datetime import datetime, timedelta, timezone
+from mysqlutils import SQL_runner
+from bulk_ingest import ais_message_row, static_data_row, position_report_row
+from ais_records import decode_messages
+
+# Maritime identification digits of the Baltic and North Sea states, weighted by traffic
+MIDS = [(219, 8), (220, 4), (265, 5), (266, 4), (211, 5), (218, 2), (230, 3), (257, 3), (258, 1), (276, 1), (305, 2), (636, 2)]
+
+# Bounding box of the Danish waters covered by the MAP_VIEW tiles
+LONGITUDE_RANGE = (8.0, 15.0)
+LATITUDE_RANGE = (54.0, 58.0)
+
+VESSEL_TYPES = ["Cargo", "Tanker", "Passenger", "Fishing", "Pleasure", "Tug", "Pilot", "Sailing", "Undefined"]
+DESTINATIONS = ["DK AAR", "DK CPH", "SE GOT", "DE KEL", "DK HOR", "PL GDN", "SE MMA", "DK ESB"]
+STATUSES = ["Under way using engine", "Under way using engine", "Under way using engine", "At anchor", "Moored", "Engaged in fishing"]
+
+# Seconds between two reports of a vessel: position reports by speed class, static data every 6 minutes
+MOORED_INTERVAL = 180
+UNDERWAY_INTERVALS = (2, 10)
+CLASS_B_INTERVAL = 30
+STATIC_DATA_INTERVAL = 360
+
+PERCENTILES = (50, 95, 99)
+
+ALL_SCENARIOS = [
+    "insert_message_batch", "insert_message_batch_bulk", "insert_message_stream", "insert_message",
+    "read_most_recent_ship_pos", "read_pos_MMSI", "read_vessel_info", "read_most_recent_ship_pos_in_tile",
+    "read_all_ports", "read_all_ship_pos_scale3", "read_last_5_pos", "read_position_to_port_id",
+    "read_position_given_port", "find_tiles_zoom_2", "find_tile_from_id", "delete_all_msg_timestamp",
+]
+
+READ_SAMPLE_TILES = """
+    SELECT Id, Scale FROM MAP_VIEW ORDER BY Id LIMIT 200
+    """
+
+READ_SAMPLE_PORTS = """
+    SELECT Id, Name, Country FROM PORT ORDER BY Id LIMIT 50
+    """
+
+
+class Vessel:
+    """
+    State of one simulated vessel
+    """
+
+    def __init__(self, rng, mmsi):
+        self.mmsi = mmsi
+        self.ais_class = "Class A" if rng.random() < 0.8 else "Class B"
+        self.imo = rng.randint(9000000, 9899999) if self.ais_class == "Class A" and rng.random() < 0.7 else "Unknown"
+        self.name = "".join(rng.choice("ABCDEFGHIJKLMNOPRSTUVWY") for _ in range(rng.randint(4, 12)))
+        self.call_sign = "".join(rng.choice("ABCDEFGHIJKLMNOPQRSTUVWXYZ0123456789") for _ in range(5))
+        self.vessel_type = rng.choice(VESSEL_TYPES)
+        self.length = rng.randint(8, 300)
+        self.breadth = max(3, self.length // rng.randint(5, 8))
+        self.draught = round(rng.uniform(1.0, 12.0), 1)
+        self.destination = rng.choice(DESTINATIONS)
+        self.status = rng.choice(STATUSES)
+        self.latitude = rng.uniform(*LATITUDE_RANGE)
+        self.longitude = rng.uniform(*LONGITUDE_RANGE)
+        self.course = rng.uniform(0, 360)
+        self.speed = rng.uniform(4, 20) if self.status.startswith("Under way") else rng.uniform(0, 0.3)
+
+    def report_interval(self, rng):
+        if self.ais_class == "Class B":
+            return CLASS_B_INTERVAL
+        if self.speed < 0.5:
+            return MOORED_INTERVAL
+        return rng.uniform(*UNDERWAY_INTERVALS)
+
+    def move(self, rng, seconds):
+        # One knot is 1852 m/h, and one degree of latitude about 111 km
+        distance = self.speed * 1852 * seconds / 3600 / 111000
+        self.course = (self.course + rng.gauss(0, 2)) % 360
+        self.latitude += distance * math.cos(math.radians(self.course))
+        self.longitude += distance * math.sin(math.radians(self.course)) / math.cos(math.radians(self.latitude))
+        self.latitude = min(max(self.latitude, LATITUDE_RANGE[0]), LATITUDE_RANGE[1])
+        self.longitude = min(max(self.longitude, LONGITUDE_RANGE[0]), LONGITUDE_RANGE[1])
+
+
+def format_timestamp(timestamp):
+    return timestamp.strftime("%Y-%m-%dT%H:%M:%S.") + f"{timestamp.microsecond // 1000:03d}Z"
+
+
+class AISFeed:
+    """
+    Seeded generator of AIS messages from a fleet of simulated vessels
+
+    Each vessel reports its position at the rate of its class and speed, and its static data every
+    six minutes; messages come out in timestamp order, like a receiver's feed.
+    """
+
+    def __init__(self, seed=0, vessels=100, start=None):
+        """
+        :param: seed: seed of the generator; the same seed gives the same messages
+        :type: seed: int
+        :param: vessels: size of the fleet
+        :type: vessels: int
+        :param: start: timestamp of the first message, ten minutes ago by default
+        :type: start: datetime
+        """
+        self.rng = random.Random(seed)
+        if start is None:
+            start = datetime.now(timezone.utc).replace(tzinfo=None, microsecond=0) - timedelta(minutes=10)
+        self.vessels = []
+        mmsis = set()
+        mids = [mid for mid, weight in MIDS for _ in range(weight)]
+        while len(self.vessels) < vessels:
+            mmsi = self.rng.choice(mids) * 1000000 + self.rng.randint(0, 999999)
+            if mmsi not in mmsis:
+                mmsis.add(mmsi)
+                self.vessels.append(Vessel(self.rng, mmsi))
+        # (time, sequence, vessel index, message type) of the next report of each vessel
+        self._queue = []
+        for i, vessel in enumerate(self.vessels):
+            self._schedule(start + timedelta(seconds=self.rng.uniform(0, vessel.report_interval(self.rng))), i, "position_report")
+            self._schedule(start + timedelta(seconds=self.rng.uniform(0, STATIC_DATA_INTERVAL)), i, "static_data")
+
+    def _schedule(self, timestamp, i, msg_type):
+        heapq.heappush(self._queue, (timestamp, self.rng.random(), i, msg_type))
+
+    def mmsis(self):
+        return [vessel.mmsi for vessel in self.vessels]
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        timestamp, _, i, msg_type = heapq.heappop(self._queue)
+        vessel = self.vessels[i]
+        if msg_type == "static_data":
+            self._schedule(timestamp + timedelta(seconds=STATIC_DATA_INTERVAL), i, msg_type)
+            return {"Timestamp": format_timestamp(timestamp), "Class": vessel.ais_class, "MMSI": vessel.mmsi,
+                    "MsgType": "static_data", "IMO": vessel.imo, "CallSign": vessel.call_sign, "Name": vessel.name,
+                    "VesselType": vessel.vessel_type, "Length": vessel.length, "Breadth": vessel.breadth,
+                    "Draught": vessel.draught, "Destination": vessel.destination}
+
+        interval = vessel.report_interval(self.rng)
+        self._schedule(timestamp + timedelta(seconds=interval), i, msg_type)
+        vessel.move(self.rng, interval)
+        return {"Timestamp": format_timestamp(timestamp), "Class": vessel.ais_class, "MMSI": vessel.mmsi,
+                "MsgType": "position_report",
+                "Position": {"type": "Point", "coordinates": [round(vessel.latitude, 6), round(vessel.longitude, 6)]},
+                "Status": vessel.status, "RoT": round(self.rng.gauss(0, 3), 1), "SoG": round(vessel.speed, 1),
+                "CoG": round(vessel.course, 1), "Heading": int(vessel.course)}
+
+    def messages(self, n):
+        """
+        The next `n` messages
+
+        :rtype: list
+        """
+        return [next(self) for _ in range(n)]
+
+
+def percentile(sorted_values, p):
+    """
+    Nearest-rank percentile of sorted values
+    """
+    if not sorted_values:
+        return 0.0
+    rank = max(1, math.ceil(p / 100 * len(sorted_values)))
+    return sorted_values[rank - 1]
+
+
+def summarize(latencies, messages=0, errors=0):
+    """
+    Throughput and latency statistics of a scenario
+
+    :param: latencies: seconds taken by each operation
+    :type: latencies: list
+    :param: messages: messages written over all operations, for ingest scenarios
+    :type: messages: int
+    :rtype: dict
+    """
+    values = sorted(latencies)
+    total = sum(values)
+    summary = {
+        "operations": len(values),
+        "errors": errors,
+        "seconds": total,
+        "ops_per_sec": len(values) / total if total > 0 else 0.0,
+        "latency_ms": {f"p{p}": percentile(values, p) * 1000 for p in PERCENTILES},
+    }
+    summary["latency_ms"]["mean"] = total / len(values) * 1000 if values else 0.0
+    summary["latency_ms"]["max"] = values[-1] * 1000 if values else 0.0
+    if messages:
+        summary["messages_per_sec"] = messages / total if total > 0 else 0.0
+    return summary
+
+
+@contextlib.contextmanager
+def answers(values):
+    """
+    Answer the DAO's interactive prompts with the given values, in turn
+    """
+    values = iter(values)
+    original = builtins.input
+    builtins.input = lambda prompt="": str(next(values))
+    try:
+        yield
+    finally:
+        builtins.input = original
+
+
+class Benchmark:
+    """
+    Runs the DAO scenarios against a database and collects their statistics
+    """
+
+    def __init__(self, dao, feed, batch_size=100, iterations=20):
+        """
+        :param: dao: the DAO to measure
+        :type: dao: TMB_DAO
+        :param: feed: source of the messages written
+        :type: feed: AISFeed
+        :param: batch_size: messages per ingest operation
+        :type: batch_size: int
+        :param: iterations: operations per scenario
+        :type: iterations: int
+        """
+        self.dao = dao
+        self.feed = feed
+        self.batch_size = batch_size
+        self.iterations = iterations
+        self.tiles = []
+        self.ports = []
+
+    def load_samples(self):
+        """
+        Read tiles and ports to query from the database
+        """
+        runner = SQL_runner()
+        self.tiles = runner.execute(READ_SAMPLE_TILES)
+        self.ports = runner.execute(READ_SAMPLE_PORTS)
+
+    def _batch(self):
+        return json.dumps(self.feed.messages(self.batch_size))
+
+    def _operations(self, scenario):
+        """
+        The operations of a scenario: (function, prompt answers, messages written) for each iteration
+        """
+        rng = random.Random(scenario)
+        mmsis = self.feed.mmsis()
+        dao = self.dao
+        for _ in range(self.iterations):
+            mmsi = rng.choice(mmsis)
+            port = rng.choice(self.ports) if self.ports else (0, "", "")
+            tile = rng.choice(self.tiles) if self.tiles else (0, 3)
+            parent = rng.choice([t for t in self.tiles if t[1] < 3] or [(0, 1)])
+            if scenario in ("insert_message_batch", "insert_message_batch_bulk", "insert_message"):
+                batch = self._batch()
+                yield (lambda batch=batch: getattr(dao, scenario)(batch)), (), self.batch_size
+            elif scenario == "insert_message_stream":
+                lines = self._batch()
+                yield (lambda lines=lines: dao.insert_message_stream(io.StringIO(lines))), (), self.batch_size
+            elif scenario in ("read_pos_MMSI", "read_vessel_info", "read_last_5_pos"):
+                yield (lambda: getattr(dao, scenario)("[{}]")), (mmsi,), 0
+            elif scenario in ("read_most_recent_ship_pos_in_tile", "find_tile_from_id"):
+                yield (lambda: getattr(dao, scenario)("[{}]")), (tile[0],), 0
+            elif scenario == "find_tiles_zoom_2":
+                yield (lambda: dao.find_tiles_zoom_2("[{}]")), (parent[0],), 0
+            elif scenario in ("read_all_ports", "read_all_ship_pos_scale3"):
+                yield (lambda: getattr(dao, scenario)("[{}]")), (port[1], port[2]), 0
+            elif scenario in ("read_position_to_port_id", "read_position_given_port"):
+                yield (lambda: getattr(dao, scenario)("[{}]")), (port[0],), 0
+            else:
+                yield (lambda: getattr(dao, scenario)("[{}]")), (), 0
+
+    def run(self, scenario):
+        """
+        Run one scenario
+
+        :return: its statistics
+        :rtype: dict
+        """
+        latencies = []
+        messages = 0
+        errors = 0
+        for operation, prompts, written in self._operations(scenario):
+            with answers(prompts), contextlib.redirect_stdout(io.StringIO()):
+                start = time.perf_counter()
+                try:
+                    result = operation()
+                except Exception:
+                    result = -1
+                latencies.append(time.perf_counter() - start)
+            if result == -1:
+                errors += 1
+            messages += written
+        return summarize(latencies, messages, errors)
+
+    def run_all(self, scenarios=ALL_SCENARIOS):
+        """
+        Run scenarios in order, ingest first so that the reads find data
+
+        :return: the statistics of each scenario, by name
+        :rtype: dict
+        """
+        return {scenario: self.run(scenario) for scenario in scenarios}
+
+
+def main(argv=None):
+    """
+    Run the benchmark against the database of connection_data.conf and print the report as JSON
+    """
+    from tmb_dao import TMB_DAO
+
+    parser = argparse.ArgumentParser(description="Measure the DAO against a MySQL database.")
+    parser.add_argument("--seed", type=int, default=0, help="seed of the message generator (default: 0)")
+    parser.add_argument("--vessels", type=int, default=500, help="size of the simulated fleet (default: 500)")
+    parser.add_argument("--batch-size", type=int, default=100, help="messages per ingest operation (default: 100)")
+    parser.add_argument("--iterations", type=int, default=20, help="operations per scenario (default: 20)")
+    parser.add_argument("--scenarios", default=",".join(ALL_SCENARIOS), help="comma-separated scenarios (default: all)")
+    parser.add_argument("--output", help="file to write the report to, instead of standard output")
+    args = parser.parse_args(argv)
+
+    scenarios = [scenario for scenario in args.scenarios.split(",") if scenario]
+    unknown = [scenario for scenario in scenarios if scenario not in ALL_SCENARIOS]
+    if unknown:
+        parser.error(f"unknown scenarios: {', '.join(unknown)}")
+
+    benchmark = Benchmark(TMB_DAO(), AISFeed(args.seed, args.vessels), args.batch_size, args.iterations)
+    benchmark.load_samples()
+    report = {
+        "started": format_timestamp(datetime.now(timezone.utc).replace(tzinfo=None)),
+        "settings": {"seed": args.seed, "vessels": args.vessels, "batch_size": args.batch_size, "iterations": args.iterations},
+        "scenarios": benchmark.run_all(scenarios),
+    }
+    text = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(text + "\n")
+    else:
+        print(text)
+    return 0
+
+
+class BenchmarkTest(unittest.TestCase):
+
+    def test_feed_seeded(self):
+        """
+        The same seed gives the same messages, in timestamp order.
+        """
+        start = datetime(2020, 11, 18)
+        messages = AISFeed(seed=7, vessels=20, start=start).messages(200)
+        self.assertEqual(messages, AISFeed(seed=7, vessels=20, start=start).messages(200))
+        self.assertEqual([m["Timestamp"] for m in messages], sorted(m["Timestamp"] for m in messages))
+        self.assertTrue({"static_data", "position_report"} <= {m["MsgType"] for m in messages})
+
+    def test_feed_rows(self):
+        """
+        Generated messages have the fields the ingest rows are built from.
+        """
+        for record in decode_messages(AISFeed(seed=1, vessels=10, start=datetime(2020, 11, 18)).messages(100)):
+            ais_message_row(1, record)
+            if record.msg_type == "position_report":
+                position_report_row(1, record)
+            else:
+                static_data_row(1, record)
+            self.assertEqual(len(str(record.mmsi)), 9)
+
+    def test_summarize(self):
+        """
+        Function `summarize` reports nearest-rank percentiles in milliseconds.
+        """
+        summary = summarize([i / 1000 for i in range(1, 101)], messages=1000)
+        self.assertAlmostEqual(summary["latency_ms"]["p50"], 50.0)
+        self.assertAlmostEqual(summary["latency_ms"]["p99"], 99.0)
+        self.assertEqual(summary["operations"], 100)
+        self.assertTrue(summary["messages_per_sec"] > 0)
+
+    def test_run_stub(self):
+        """
+        Every scenario runs against a stub DAO.
+        """
+        from tmb_dao import TMB_DAO
+        feed = AISFeed(seed=3, vessels=10, start=datetime(2020, 11, 18))
+        report = Benchmark(TMB_DAO(True), feed, batch_size=10, iterations=2).run_all()
+        self.assertEqual(sorted(report), sorted(ALL_SCENARIOS))
+        self.assertEqual(report["insert_message_batch_bulk"]["operations"], 2)
+        self.assertEqual(report["insert_message_batch_bulk"]["errors"], 0)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
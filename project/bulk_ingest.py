@@ -0,0 +1,275 @@
+import unittest
+from mysqlutils import SQL_runner
+from id_allocator import default_allocator
+from schema import ensure_schema
+from ais_records import from_epoch_us, decode_message, decode_messages
+
+# Upper bound, in bytes, for the text of one multi-row INSERT. MySQL rejects statements larger
+# than its max_allowed_packet (4MB by default in 5.7), so we stay well under it.
+MAX_PACKET_SIZE = 1024 * 1024
+
+# Fixed cost of one `(..., ...)` group in a VALUES list, on top of the values themselves
+ROW_OVERHEAD = 16
+
+INSERT_AIS_MESSAGE = """
+    INSERT INTO AIS_MESSAGE
+    (Id, Timestamp, MMSI, Class)
+    VALUES (%s, %s, %s, %s)
+    """
+
+INSERT_STATIC_DATA = """
+    INSERT INTO STATIC_DATA
+    (AISMessage_Id, AIS_IMO, Name, VesselType, Length, Breadth)
+    VALUES (%s, %s, %s, %s, %s, %s)
+    """
+
+INSERT_POSITION_REPORT = """
+    INSERT INTO POSITION_REPORT
+    (AISMessage_Id, NavigationalStatus, Longitude, Latitude, RoT, SoG, CoG, Heading, MapView1_Id, MapView2_Id, MapView3_Id, Timestamp)
+    VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s)
+    """
+
+# Each column only changes when the report is at least as recent as the stored one;
+# Timestamp is assigned last, as MySQL applies the assignments from left to right.
+UPSERT_LATEST_POSITION = """
+    INSERT INTO LATEST_POSITION
+    (MMSI, AISMessage_Id, Timestamp, Vessel_IMO, Latitude, Longitude, MapView1_Id, MapView2_Id, MapView3_Id)
+    VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s)
+    ON DUPLICATE KEY UPDATE
+    AISMessage_Id = IF(VALUES(Timestamp) >= Timestamp, VALUES(AISMessage_Id), AISMessage_Id),
+    Vessel_IMO = IF(VALUES(Timestamp) >= Timestamp, COALESCE(VALUES(Vessel_IMO), Vessel_IMO), Vessel_IMO),
+    Latitude = IF(VALUES(Timestamp) >= Timestamp, VALUES(Latitude), Latitude),
+    Longitude = IF(VALUES(Timestamp) >= Timestamp, VALUES(Longitude), Longitude),
+    MapView1_Id = IF(VALUES(Timestamp) >= Timestamp, VALUES(MapView1_Id), MapView1_Id),
+    MapView2_Id = IF(VALUES(Timestamp) >= Timestamp, VALUES(MapView2_Id), MapView2_Id),
+    MapView3_Id = IF(VALUES(Timestamp) >= Timestamp, VALUES(MapView3_Id), MapView3_Id),
+    Timestamp = IF(VALUES(Timestamp) >= Timestamp, VALUES(Timestamp), Timestamp)
+    """
+
+
+def group_by_type(messages):
+    """
+    Split AIS message records by message type
+
+    :param: messages: AIS message records
+    :type: messages: list of AISMessage
+    :return: the static data messages and the position reports
+    :rtype: tuple
+    """
+    static_data = []
+    position_reports = []
+    for record in messages:
+        if record.msg_type == "static_data":
+            static_data.append(record)
+        elif record.msg_type == "position_report":
+            position_reports.append(record)
+    return static_data, position_reports
+
+
+def ais_message_row(id, record):
+    return (id, from_epoch_us(record.timestamp), record.mmsi, record.msg_class)
+
+
+def static_data_row(id, record):
+    return (id, record.imo, record.name, record.vessel_type, record.length, record.breadth)
+
+
+# Tile ids of a position report whose tiles are unknown
+NO_TILES = (None, None, None)
+
+
+def position_report_row(id, record, tile_ids=NO_TILES):
+    return (
+        id,
+        record.status,
+        record.longitude,
+        record.latitude,
+        record.rot,
+        record.sog,
+        record.cog,
+        record.heading) + tuple(tile_ids) + (from_epoch_us(record.timestamp),)
+
+
+def tile_ids_of(tile_index, record):
+    """
+    Tiles of scale 1, 2 and 3 containing a position report, or `NO_TILES` without an index
+
+    :param: tile_index: the tile index, or None
+    :type: tile_index: TileIndex
+    :rtype: tuple
+    """
+    if tile_index is None:
+        return NO_TILES
+    return tile_index.tile_ids(record.longitude, record.latitude)
+
+
+def latest_position_row(id, record, tile_ids=NO_TILES):
+    return (
+        record.mmsi,
+        id,
+        from_epoch_us(record.timestamp),
+        None,
+        record.latitude,
+        record.longitude) + tuple(tile_ids)
+
+
+def latest_position_rows(rows):
+    """
+    Keep the most recent of several LATEST_POSITION rows for the same MMSI
+
+    :param: rows: rows built by `latest_position_row`
+    :type: rows: list
+    :return: one row per MMSI
+    :rtype: list
+    """
+    latest = {}
+    for row in rows:
+        current = latest.get(row[0])
+        if current is None or row[2] >= current[2]:
+            latest[row[0]] = row
+    return list(latest.values())
+
+
+def chunk_rows(rows, max_packet_size=MAX_PACKET_SIZE):
+    """
+    Split rows into chunks whose multi-row INSERT stays under `max_packet_size` bytes
+
+    The size of a row is estimated from the text of its values; a row larger than the limit
+    on its own still gets a chunk of its own.
+
+    :param: rows: tuples of column values
+    :type: rows: list
+    :param: max_packet_size: maximum estimated size of one chunk, in bytes
+    :type: max_packet_size: int
+    :return: lists of rows
+    :rtype: generator
+    """
+    chunk = []
+    chunk_size = 0
+    for row in rows:
+        row_size = ROW_OVERHEAD + sum(len(str(value)) + 3 for value in row)
+        if chunk and chunk_size + row_size > max_packet_size:
+            yield chunk
+            chunk = []
+            chunk_size = 0
+        chunk.append(row)
+        chunk_size += row_size
+    if chunk:
+        yield chunk
+
+
+class BulkWriter:
+    """
+    Writes AIS message records with one multi-row INSERT per table and chunk, in a single transaction
+    """
+
+    def __init__(self, runner=None, max_packet_size=MAX_PACKET_SIZE, id_allocator=None, tile_index=None,
+                 static_data_cache=None):
+        """
+        :param: static_data_cache: cache of the static data already written, to skip the STATIC_DATA
+            rows of unchanged vessels, or None to write every static data message
+        :type: static_data_cache: StaticDataCache
+        """
+        self.runner = runner if runner is not None else SQL_runner()
+        self.max_packet_size = max_packet_size
+        self.id_allocator = id_allocator if id_allocator is not None else default_allocator()
+        self.tile_index = tile_index
+        self.static_data_cache = static_data_cache
+
+    def _insert(self, cursor, query, rows):
+        inserted = 0
+        for chunk in chunk_rows(rows, self.max_packet_size):
+            cursor.executemany(query, chunk)
+            inserted += cursor.rowcount
+        return inserted
+
+    def write(self, messages):
+        """
+        Insert AIS message records
+
+        :param: messages: AIS message records
+        :type: messages: list of AISMessage
+        :return: number of insertions per table
+        :rtype: dict
+        """
+        counts = {"AIS_MESSAGE": 0, "STATIC_DATA": 0, "POSITION_REPORT": 0}
+        if not messages:
+            return counts
+
+        ids = self.id_allocator.allocate(len(messages))
+        ais_rows = []
+        static_rows = []
+        position_rows = []
+        latest_rows = []
+        for id, record in zip(ids, messages):
+            ais_rows.append(ais_message_row(id, record))
+            if record.msg_type == "static_data":
+                if self.static_data_cache is None or self.static_data_cache.changed(record):
+                    static_rows.append(static_data_row(id, record))
+            elif record.msg_type == "position_report":
+                tile_ids = tile_ids_of(self.tile_index, record)
+                position_rows.append(position_report_row(id, record, tile_ids))
+                latest_rows.append(latest_position_row(id, record, tile_ids))
+
+        try:
+            ensure_schema(self.runner)
+            with self.runner.transaction() as cursor:
+                counts["AIS_MESSAGE"] = self._insert(cursor, INSERT_AIS_MESSAGE, ais_rows)
+                counts["STATIC_DATA"] = self._insert(cursor, INSERT_STATIC_DATA, static_rows)
+                counts["POSITION_REPORT"] = self._insert(cursor, INSERT_POSITION_REPORT, position_rows)
+                self._insert(cursor, UPSERT_LATEST_POSITION, latest_position_rows(latest_rows))
+        except Exception:
+            if self.static_data_cache is not None:
+                self.static_data_cache.forget(record.mmsi for record in messages if record.msg_type == "static_data")
+            raise
+
+        return counts
+
+
+class BulkIngestTest(unittest.TestCase):
+
+    def test_chunk_rows_1(self):
+        """
+        Function `chunk_rows` keeps every row, in order, and respects the size limit.
+        """
+        rows = [(i, "x" * 10) for i in range(100)]
+        chunks = list(chunk_rows(rows, 200))
+        self.assertEqual([row for chunk in chunks for row in chunk], rows)
+        self.assertTrue(len(chunks) > 1)
+        for chunk in chunks:
+            self.assertTrue(sum(ROW_OVERHEAD + len(str(i)) + 3 + 13 for i, _ in chunk) <= 200)
+
+    def test_chunk_rows_2(self):
+        """
+        Function `chunk_rows` puts a row larger than the limit in a chunk of its own.
+        """
+        chunks = list(chunk_rows([(1,), ("y" * 500,), (2,)], 100))
+        self.assertEqual(chunks, [[(1,)], [("y" * 500,)], [(2,)]])
+
+    def test_latest_position_rows(self):
+        """
+        Function `latest_position_rows` keeps the most recent row of each MMSI.
+        """
+        def message(mmsi, timestamp, latitude):
+            return decode_message({"MMSI": mmsi, "Timestamp": timestamp, "MsgType": "position_report",
+                                   "Position": {"coordinates": [latitude, 13.0]}})
+        rows = [latest_position_row(1, message(7, "2020-11-18T00:00:02.000Z", 55.0)),
+                latest_position_row(2, message(7, "2020-11-18T00:00:01.000Z", 54.0)),
+                latest_position_row(3, message(8, "2020-11-18T00:00:00.000Z", 53.0))]
+        latest = sorted(latest_position_rows(rows))
+        self.assertEqual([(row[0], row[1], row[4]) for row in latest], [(7, 1, 55.0), (8, 3, 53.0)])
+
+    def test_group_by_type(self):
+        """
+        Function `group_by_type` splits records by message type, leaving out the other types.
+        """
+        messages = decode_messages([{"MMSI": 1, "Timestamp": "2020-11-18T00:00:00.000Z", "MsgType": msg_type,
+                                     "Position": {"coordinates": [55.0, 13.0]}}
+                                    for msg_type in ("static_data", "position_report", "position_report", "aton_report")])
+        static_data, position_reports = group_by_type(messages)
+        self.assertEqual(len(static_data), 1)
+        self.assertEqual(len(position_reports), 2)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,156 @@
+import os
+import threading
+import unittest
+from mysqlutils import SQL_runner
+
+# One-row table holding the next free AIS_MESSAGE.Id. Blocks are reserved with the
+# LAST_INSERT_ID(expr) idiom, so the increment and the read are atomic per connection.
+CREATE_SEQUENCE = """
+    CREATE TABLE IF NOT EXISTS AIS_MESSAGE_SEQ (
+    Id TINYINT NOT NULL PRIMARY KEY,
+    NextId BIGINT NOT NULL)
+    """
+
+SEED_SEQUENCE = """
+    INSERT IGNORE INTO AIS_MESSAGE_SEQ (Id, NextId)
+    SELECT 1, COALESCE(MAX(Id), 0) + 1 FROM AIS_MESSAGE
+    """
+
+RESERVE_BLOCK = """
+    UPDATE AIS_MESSAGE_SEQ SET NextId = LAST_INSERT_ID(NextId + %s) WHERE Id = 1
+    """
+
+# SQLite has no LAST_INSERT_ID(expr), but returns the updated value and serializes writers
+RESERVE_BLOCK_RETURNING = """
+    UPDATE AIS_MESSAGE_SEQ SET NextId = NextId + %s WHERE Id = 1 RETURNING NextId
+    """
+
+BLOCK_SIZE = 1000
+
+
+class IdAllocator:
+    """
+    Hands out AIS_MESSAGE ids from blocks reserved in the AIS_MESSAGE_SEQ table
+
+    Concurrent writers (threads, processes or hosts) never get the same id. Ids left in a block
+    when the process exits are never used, so ids are unique and increasing but not gapless.
+    Every writer of AIS_MESSAGE must take its ids from an allocator.
+    """
+
+    def __init__(self, runner=None, block_size=BLOCK_SIZE):
+        """
+        :param: runner: runner used to reserve blocks
+        :type: runner: SQL_runner
+        :param: block_size: number of ids reserved per round trip
+        :type: block_size: int
+        """
+        self.runner = runner if runner is not None else SQL_runner()
+        self.block_size = block_size
+        self._next = 0
+        self._end = 0
+        self._lock = threading.Lock()
+        self._initialized = False
+
+    def _reserve(self, count):
+        """
+        Reserve `count` consecutive ids and return the first one
+        """
+        with self.runner.transaction() as cursor:
+            if not self._initialized:
+                cursor.execute(CREATE_SEQUENCE)
+                cursor.execute(SEED_SEQUENCE)
+                self._initialized = True
+            if self.runner.backend == "sqlite":
+                cursor.execute(RESERVE_BLOCK_RETURNING, (count,))
+            else:
+                cursor.execute(RESERVE_BLOCK, (count,))
+                cursor.execute("SELECT LAST_INSERT_ID()")
+            end = cursor.fetchall()[0][0]
+        return end - count
+
+    def allocate(self, count):
+        """
+        Allocate `count` ids
+
+        :param: count: number of ids
+        :type: count: int
+        :return: the ids, in increasing order
+        :rtype: list
+        """
+        ids = []
+        with self._lock:
+            while len(ids) < count:
+                if self._next == self._end:
+                    size = max(self.block_size, count - len(ids))
+                    self._next = self._reserve(size)
+                    self._end = self._next + size
+                take = min(count - len(ids), self._end - self._next)
+                ids.extend(range(self._next, self._next + take))
+                self._next += take
+        return ids
+
+    def next_id(self):
+        """
+        Allocate a single id
+
+        :rtype: int
+        """
+        return self.allocate(1)[0]
+
+
+_default_allocator = None
+_default_pid = None
+_default_lock = threading.Lock()
+
+def default_allocator():
+    """
+    Return the allocator shared by the whole process
+
+    A forked child gets its own allocator, so that it does not hand out its parent's reserved ids.
+    """
+    global _default_allocator, _default_pid
+    with _default_lock:
+        if _default_allocator is None or _default_pid != os.getpid():
+            _default_allocator = IdAllocator()
+            _default_pid = os.getpid()
+        return _default_allocator
+
+
+class IdAllocatorTest(unittest.TestCase):
+
+    class FakeAllocator(IdAllocator):
+        def __init__(self, block_size):
+            super().__init__(runner=object(), block_size=block_size)
+            self.reserved = []
+            self.sequence = 1
+
+        def _reserve(self, count):
+            start = self.sequence
+            self.sequence += count
+            self.reserved.append(count)
+            return start
+
+    def test_allocate_1(self):
+        """
+        Function `allocate` hands out consecutive ids within a block, one reservation per block.
+        """
+        allocator = self.FakeAllocator(block_size=10)
+        self.assertEqual(allocator.allocate(3), [1, 2, 3])
+        self.assertEqual(allocator.next_id(), 4)
+        self.assertEqual(allocator.allocate(6), [5, 6, 7, 8, 9, 10])
+        self.assertEqual(allocator.reserved, [10])
+
+    def test_allocate_2(self):
+        """
+        Function `allocate` reserves a larger block when asked for more ids than the block size.
+        """
+        allocator = self.FakeAllocator(block_size=4)
+        allocator.allocate(2)
+        ids = allocator.allocate(7)
+        self.assertEqual(ids, [3, 4, 5, 6, 7, 8, 9])
+        self.assertEqual(len(set(ids)), 7)
+        self.assertEqual(allocator.reserved, [4, 5])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -6,9 +6,52 @@
 # Exercises in SQL (covering Week #8)
 
 import mysql.connector
-from mysql.connector import errorcode
+from mysql.connector import errorcode, errors
 
-import configparser, sys, re
+import configparser, sys, re, os, threading, time
+from contextlib import contextmanager
+from collections import OrderedDict, namedtuple
+
+from query_metrics import QueryMetrics
+
+
+_config_cache = {}
+_config_lock = threading.Lock()
+
+def read_config(cfg):
+	"""
+	Parse a connection configuration file, once per process.
+
+	:param cfg: path to the configuration file
+	:type cfg: str
+	:return: the parsed configuration (shared, do not modify)
+	:rtype: configparser.ConfigParser
+	"""
+	key = os.path.abspath(cfg)
+	with _config_lock:
+		config = _config_cache.get(key)
+		if config is None:
+			config = configparser.ConfigParser()
+			success = config.read(cfg)
+			if not success:
+				raise configparser.Error("Could not read file {}".format( cfg ))
+			_config_cache[key] = config
+		return config
+
+def connect(config):
+	"""
+	Open a new connection from a parsed configuration.
+
+	The ``backend`` key of the ``[SQL]`` section selects the database: ``mysql`` (the default), or
+	``sqlite`` for an embedded database configured by the ``[SQLITE]`` section (see ``sqlite_backend``).
+	"""
+	if config['SQL'].get('backend', 'mysql') == 'sqlite':
+		import sqlite_backend
+		return sqlite_backend.connect(config)
+	return mysql.connector.connect( 
+		user=config['SQL']['user'],
+		password=config['SQL']['password'], 
+		database=config['SQL']['database'])
 
 
 class MySQLConnectionManager:
@@ -18,20 +61,305 @@ class MySQLConnectionManager:
 		self.config_file = cfg
 
 	def __enter__(self):
-		config = configparser.ConfigParser()
-		success = config.read(self.config_file)
-		if not success:
-			raise configparser.Error("Could not read file {}".format( self.config_file))
-		self.cnx = mysql.connector.connect( 
-			user=config['SQL']['user'],
-			password=config['SQL']['password'], 
-			database=config['SQL']['database'])
+		self.cnx = connect( read_config(self.config_file) )
 
 		return self.cnx
 
 	def __exit__(self, *ignore):
 		self.cnx.close()
 
+
+class StatementCache:
+	"""
+	Server-side prepared statements of one connection, keyed by SQL text, with LRU eviction.
+
+	Each statement gets its own prepared cursor, which ``mysql.connector`` only re-prepares when
+	executed with a different query object; the cache always executes with the text it stored.
+	"""
+
+	def __init__(self, cnx, capacity=64):
+		self.cnx = cnx
+		self.capacity = capacity
+		self._entries = OrderedDict()
+
+	def get(self, sql):
+		"""
+		Return the prepared cursor for ``sql`` and the query object to execute it with.
+
+		:param sql: statement text, with ``%s`` placeholders
+		:type sql: str
+		:rtype: tuple
+		"""
+		entry = self._entries.get(sql)
+		if entry is not None:
+			self._entries.move_to_end(sql)
+			return entry
+		entry = (self.cnx.cursor(prepared=True), sql)
+		self._entries[sql] = entry
+		while len(self._entries) > self.capacity:
+			_, (cursor, _) = self._entries.popitem(last=False)
+			cursor.close()
+		return entry
+
+	def __len__(self):
+		return len(self._entries)
+
+	def clear(self):
+		for cursor, _ in self._entries.values():
+			try:
+				cursor.close()
+			except Exception:
+				pass
+		self._entries.clear()
+
+
+class PooledConnection:
+	"""
+	A connection owned by a :class:`MySQLConnectionPool`, with the bookkeeping the pool needs.
+	"""
+
+	def __init__(self, cnx, statement_cache_size=64):
+		self.cnx = cnx
+		self.last_used = time.monotonic()
+		self.statements = StatementCache(cnx, statement_cache_size)
+		self.invalid = False
+
+	def invalidate(self):
+		"""
+		Mark the connection as unusable, so the pool closes it instead of reusing it.
+		"""
+		self.invalid = True
+
+	def close(self):
+		self.statements.clear()
+		try:
+			self.cnx.close()
+		except Exception:
+			pass
+
+
+class MySQLConnectionPool:
+	"""
+	A thread-safe pool of MySQL connections.
+
+	Connections are created lazily, up to ``size``. A connection that has been idle for more than
+	``health_check_interval`` seconds is pinged before being handed out, and replaced if it is dead;
+	connections idle for more than ``idle_timeout`` seconds are closed.
+	"""
+
+	def __init__(self, cfg, size=5, idle_timeout=300, health_check_interval=30, acquire_timeout=None, statement_cache_size=64):
+		"""
+		:param cfg: path to the configuration file
+		:type cfg: str
+		:param size: maximum number of open connections
+		:type size: int
+		:param idle_timeout: seconds after which an idle connection is closed
+		:type idle_timeout: float
+		:param health_check_interval: idle seconds after which a connection is pinged before reuse
+		:type health_check_interval: float
+		:param acquire_timeout: seconds to wait for a free connection (``None`` waits forever)
+		:type acquire_timeout: float
+		:param statement_cache_size: prepared statements kept per connection
+		:type statement_cache_size: int
+		"""
+		if size < 1:
+			raise ValueError("Pool size must be at least 1")
+		self.config_file = cfg
+		self.size = size
+		self.idle_timeout = idle_timeout
+		self.health_check_interval = health_check_interval
+		self.acquire_timeout = acquire_timeout
+		self.statement_cache_size = statement_cache_size
+		self._idle = []
+		self._open = 0
+		self._closed = False
+		self._cond = threading.Condition()
+
+	def _evict_idle(self, now):
+		"""
+		Close connections idle for longer than ``idle_timeout``. Caller holds the lock.
+		"""
+		keep = []
+		for pc in self._idle:
+			if now - pc.last_used > self.idle_timeout:
+				pc.close()
+				self._open -= 1
+			else:
+				keep.append(pc)
+		self._idle = keep
+
+	def _is_healthy(self, pc, now):
+		if now - pc.last_used <= self.health_check_interval:
+			return True
+		try:
+			return pc.cnx.is_connected()
+		except Exception:
+			return False
+
+	def acquire(self):
+		"""
+		Take a connection out of the pool, opening a new one if none is idle.
+
+		:return: a pooled connection, to be given back with :meth:`release`
+		:rtype: PooledConnection
+		:raises mysql.connector.errors.PoolError: if no connection frees up within ``acquire_timeout``
+		"""
+		deadline = None if self.acquire_timeout is None else time.monotonic() + self.acquire_timeout
+		with self._cond:
+			while True:
+				if self._closed:
+					raise errors.PoolError("Connection pool is closed")
+				now = time.monotonic()
+				self._evict_idle(now)
+				while self._idle:
+					pc = self._idle.pop()
+					if self._is_healthy(pc, now):
+						return pc
+					pc.close()
+					self._open -= 1
+				if self._open < self.size:
+					self._open += 1
+					break
+				remaining = None if deadline is None else deadline - now
+				if remaining is not None and remaining <= 0:
+					raise errors.PoolError("No connection available in the pool")
+				self._cond.wait(remaining)
+
+		try:
+			return PooledConnection( connect( read_config(self.config_file) ), self.statement_cache_size )
+		except Exception:
+			with self._cond:
+				self._open -= 1
+				self._cond.notify()
+			raise
+
+	def release(self, pc, discard=False):
+		"""
+		Give a connection back to the pool. Any open transaction is rolled back.
+
+		:param pc: a connection obtained from :meth:`acquire`
+		:type pc: PooledConnection
+		:param discard: close the connection instead of keeping it (e.g. after a connection error)
+		:type discard: bool
+		"""
+		discard = discard or pc.invalid
+		if not discard:
+			try:
+				if pc.cnx.in_transaction:
+					pc.cnx.rollback()
+			except Exception:
+				discard = True
+		with self._cond:
+			if discard or self._closed:
+				pc.close()
+				self._open -= 1
+			else:
+				pc.last_used = time.monotonic()
+				self._idle.append(pc)
+			self._cond.notify()
+
+	@contextmanager
+	def session(self):
+		"""
+		Context manager yielding a :class:`PooledConnection`.
+		"""
+		pc = self.acquire()
+		discard = False
+		try:
+			yield pc
+		except (errors.OperationalError, errors.InterfaceError):
+			discard = True
+			raise
+		finally:
+			self.release(pc, discard)
+
+	@contextmanager
+	def connection(self):
+		"""
+		Context manager yielding a pooled ``mysql.connector`` connection.
+		"""
+		with self.session() as pc:
+			yield pc.cnx
+
+	def close(self):
+		"""
+		Close all idle connections; connections in use are closed when released.
+		"""
+		with self._cond:
+			self._closed = True
+			for pc in self._idle:
+				pc.close()
+				self._open -= 1
+			self._idle = []
+			self._cond.notify_all()
+
+
+_pools = {}
+_metrics = {}
+_pools_lock = threading.Lock()
+_pools_pid = os.getpid()
+
+def _check_pid():
+	"""
+	Forget the pools and metrics inherited from a parent process. Caller holds ``_pools_lock``.
+	"""
+	global _pools_pid
+	if _pools_pid != os.getpid():
+		# A forked child must not share its parent's sockets, nor count its parent's queries
+		_pools.clear()
+		_metrics.clear()
+		_pools_pid = os.getpid()
+
+def get_pool(cfg):
+	"""
+	Return the process-wide pool for a configuration file, creating it on first use.
+
+	Pool settings are read from the optional ``[POOL]`` section of the file
+	(``size``, ``idle_timeout``, ``health_check_interval``, ``acquire_timeout``, ``statement_cache_size``).
+
+	:param cfg: path to the configuration file
+	:type cfg: str
+	:rtype: MySQLConnectionPool
+	"""
+	key = os.path.abspath(cfg)
+	with _pools_lock:
+		_check_pid()
+		pool = _pools.get(key)
+		if pool is None:
+			config = read_config(cfg)
+			settings = config['POOL'] if config.has_section('POOL') else {}
+			acquire_timeout = settings.get('acquire_timeout')
+			pool = MySQLConnectionPool(cfg,
+				size=int(settings.get('size', 5)),
+				idle_timeout=float(settings.get('idle_timeout', 300)),
+				health_check_interval=float(settings.get('health_check_interval', 30)),
+				acquire_timeout=float(acquire_timeout) if acquire_timeout else None,
+				statement_cache_size=int(settings.get('statement_cache_size', 64)))
+			_pools[key] = pool
+		return pool
+
+def get_metrics(cfg):
+	"""
+	Return the process-wide query metrics for a configuration file, creating them on first use.
+
+	Settings are read from the optional ``[METRICS]`` section of the file
+	(``enabled``, ``slow_query_ms``, ``slow_query_log``, ``slow_query_keep``).
+
+	:param cfg: path to the configuration file
+	:type cfg: str
+	:rtype: query_metrics.QueryMetrics
+	"""
+	key = os.path.abspath(cfg)
+	with _pools_lock:
+		_check_pid()
+		metrics = _metrics.get(key)
+		if metrics is None:
+			config = read_config(cfg)
+			metrics = QueryMetrics.from_settings(config['METRICS'] if config.has_section('METRICS') else {})
+			_metrics[key] = metrics
+		return metrics
+
+
 class MySQLCursorManager:
 	
 	def __init__(self, cnx, options={}): 
@@ -55,15 +383,315 @@ class MySQLCursorManager:
 		self.cursor.close()
 
 
+class InstrumentedCursor:
+	"""
+	A cursor whose ``execute`` and ``executemany`` calls are recorded in query metrics.
+
+	Affected rows are counted when the statement runs, returned rows when they are fetched with ``fetchall``.
+	"""
+
+	def __init__(self, cursor, metrics):
+		self._cursor = cursor
+		self._metrics = metrics
+		self._statement = None
+
+	def execute(self, operation, params=(), **kwargs):
+		self._statement = operation
+		with self._metrics.measure( operation, params ) as measurement:
+			result = self._cursor.execute( operation, params, **kwargs )
+			if not self._cursor.with_rows:
+				measurement.rows = max(self._cursor.rowcount, 0)
+		return result
+
+	def executemany(self, operation, seq_params):
+		self._statement = None
+		with self._metrics.measure( operation, seq_params ) as measurement:
+			result = self._cursor.executemany( operation, seq_params )
+			measurement.rows = max(self._cursor.rowcount, 0)
+		return result
+
+	def fetchall(self):
+		rows = self._cursor.fetchall()
+		if self._statement is not None:
+			self._metrics.add_rows( self._statement, len(rows) )
+		return rows
+
+	def __iter__(self):
+		return iter(self._cursor)
+
+	def __getattr__(self, name):
+		return getattr(self._cursor, name)
+
+
+StatementResult = namedtuple('StatementResult', ['statement', 'rows', 'rowcount', 'lastrowid'])
+StatementResult.__doc__ = """
+Outcome of one statement of a script: its rows (``None`` if it returns none), affected rows and last insert id.
+"""
+
+def _iter_results(cursor, script, params):
+	"""
+	Execute a multi-statement script in one round trip and yield a cursor positioned on each result.
+	"""
+	try:
+		results = cursor.execute( script, params, multi=True )
+	except TypeError:
+		# Connector/Python 9.2 replaced ``multi=True`` with ``map_results=True`` and ``nextset()``
+		cursor.execute( script, params, map_results=True )
+		while True:
+			yield cursor
+			if not cursor.nextset():
+				break
+	else:
+		yield from results
+
+
 class SQL_runner():
 
 	config_file = 'connection_data.conf'
-		
+
+	def __init__(self, pooled=True):
+		"""
+		:param pooled: borrow connections from the process-wide pool instead of opening one per call
+		:type pooled: bool
+		"""
+		self.pooled = pooled
+
+	@property
+	def metrics(self):
+		"""
+		The process-wide :class:`query_metrics.QueryMetrics` of the configuration file.
+		"""
+		return get_metrics(self.config_file)
+
+	@property
+	def backend(self):
+		"""
+		Name of the database backend of the configuration file: ``mysql`` or ``sqlite``.
+		"""
+		return read_config(self.config_file)['SQL'].get('backend', 'mysql')
+
+	@contextmanager
+	def connection(self):
+		"""
+		Context manager yielding a connection: pooled by default, otherwise a fresh one.
+		"""
+		with self.session() as pc:
+			yield pc.cnx
+
+	@contextmanager
+	def session(self):
+		"""
+		Context manager yielding a :class:`PooledConnection`, whose prepared statements are kept
+		for the next user when pooled, and closed on exit otherwise.
+
+		The time taken to get the connection is recorded in :attr:`metrics`.
+		"""
+		metrics = self.metrics
+		start = time.perf_counter()
+		if self.pooled:
+			with get_pool(self.config_file).session() as pc:
+				metrics.record_acquire( time.perf_counter() - start )
+				yield pc
+		else:
+			with MySQLConnectionManager(self.config_file) as con:
+				metrics.record_acquire( time.perf_counter() - start )
+				pc = PooledConnection(con)
+				try:
+					yield pc
+				finally:
+					pc.statements.clear()
+
+	@contextmanager
+	def transaction(self):
+		"""
+		Context manager yielding a cursor whose statements are committed together on exit,
+		or rolled back if an exception is raised. Errors are not swallowed, unlike :meth:`run`.
+
+		The statements run through the cursor are recorded in :attr:`metrics`.
+		"""
+		metrics = self.metrics
+		with self.connection() as con:
+			with MySQLCursorManager( con ) as cursor:
+				try:
+					yield InstrumentedCursor( cursor, metrics ) if metrics.enabled else cursor
+					con.commit()
+				except Exception:
+					con.rollback()
+					raise
+
+	def execute(self, sql, params=()):
+		"""
+		Run one parameterized statement as a server-side prepared statement, and commit.
+
+		The statement is prepared once per connection and reused from the connection's cache.
+
+		:param sql: a single statement, with ``%s`` placeholders
+		:type sql: str
+		:param params: values for the placeholders
+		:type params: tuple
+		:return: the rows of a query, or ``[(rowcount,)]`` for other statements, like :meth:`run`
+		:rtype: list
+		"""
+		rs = []
+
+		try:
+			with self.session() as pc:
+				with self.metrics.measure( sql, params ) as measurement:
+					cursor, stmt = pc.statements.get(sql)
+					cursor.execute( stmt, params )
+					if cursor.with_rows:
+						rs = cursor.fetchall()
+						measurement.rows = len(rs)
+					else:
+						rs = [(cursor.rowcount,)]
+						measurement.rows = max(cursor.rowcount, 0)
+					pc.cnx.commit()
+		except Exception as err:
+			report_error(err)
+		finally:
+			return rs
+
+	def execute_in(self, sql, keys, params=(), chunk_size=512):
+		"""
+		Run a query whose ``IN ({keys})`` list takes many keys, a chunk of keys per statement.
+
+		Each list is padded with its last key to a power of two, so that a query is prepared for a
+		handful of list lengths only. Duplicate keys are sent once.
+
+		:param sql: a single query, with a ``{keys}`` field inside ``IN (...)`` and ``%s`` placeholders after it
+		:type sql: str
+		:param keys: values for the list
+		:type keys: list
+		:param params: values for the placeholders after the list
+		:type params: tuple
+		:param chunk_size: maximum number of keys per statement
+		:type chunk_size: int
+		:return: the rows of all the chunks, like :meth:`execute`
+		:rtype: list
+		"""
+		rs = []
+		keys = list(dict.fromkeys(keys))
+		for start in range(0, len(keys), chunk_size):
+			chunk = keys[start:start + chunk_size]
+			size = min(1 << (len(chunk) - 1).bit_length(), chunk_size)
+			chunk += chunk[-1:] * (size - len(chunk))
+			rs += self.execute( sql.format(keys=", ".join(["%s"] * size)), tuple(chunk) + tuple(params) )
+		return rs
+
+	def executemany(self, sql, seq_params):
+		"""
+		Run one statement for each set of parameters, in a single transaction.
+
+		The statement is not prepared: the connector's ``executemany`` sends an ``INSERT ... VALUES``
+		as one multi-row insert, in a single round trip; other statements are run once per set of
+		parameters. Keep each call within ``max_allowed_packet`` (see ``bulk_ingest.chunk_rows``).
+
+		:param sql: a single statement, with ``%s`` placeholders
+		:type sql: str
+		:param seq_params: one tuple of values per execution
+		:type seq_params: list
+		:return: ``[(rowcount,)]``, the total number of affected rows
+		:rtype: list
+		"""
+		rs = []
+
+		try:
+			with self.connection() as con:
+				with self.metrics.measure( sql, seq_params ) as measurement:
+					with MySQLCursorManager( con ) as cursor:
+						cursor.executemany( sql, seq_params )
+						rowcount = max(cursor.rowcount, 0)
+						measurement.rows = rowcount
+					con.commit()
+				rs = [(rowcount,)]
+		except Exception as err:
+			report_error(err)
+		finally:
+			return rs
+
+	def run_multi(self, script, params=None):
+		"""
+		Send a multi-statement script in a single round trip, and commit.
+
+		Unlike :meth:`run`, the script is not split on ``;`` client-side, and every result is kept.
+
+		:param script: statements separated by ``;``, with ``%s`` placeholders
+		:type script: str
+		:param params: values for all placeholders of the script, in order
+		:type params: tuple
+		:return: one result per statement (results of statements that ran before an error are kept)
+		:rtype: list of StatementResult
+		"""
+		results = []
+
+		try:
+			with self.connection() as con:
+				with self.metrics.measure( script, params ) as measurement:
+					with MySQLCursorManager( con ) as cursor:
+						for result in _iter_results( cursor, script, params ):
+							rows = result.fetchall() if result.with_rows else None
+							results.append( StatementResult(result.statement, rows, result.rowcount, result.lastrowid) )
+							measurement.rows += len(rows) if rows is not None else max(result.rowcount, 0)
+					con.commit()
+		except Exception as err:
+			report_error(err)
+		finally:
+			return results
+
+	def stream(self, sql, params=(), chunk_size=1000):
+		"""
+		Iterate over the rows of a query as the server sends them, ``chunk_size`` rows at a time.
+
+		The result set is read with an unbuffered cursor, so at most ``chunk_size`` rows are held in
+		memory. The connection stays checked out until the iterator is exhausted or closed; if it is
+		closed early, the connection is dropped rather than reading the rest of the rows. Errors are
+		raised, unlike :meth:`run`. The time recorded in :attr:`metrics` is the time spent executing
+		and fetching, not the time the caller spends between chunks.
+
+		:param sql: a single query, with ``%s`` placeholders
+		:type sql: str
+		:param params: values for the placeholders
+		:type params: tuple
+		:param chunk_size: rows fetched per round trip
+		:type chunk_size: int
+		:return: rows
+		:rtype: generator
+		"""
+		metrics = self.metrics
+		with self.session() as pc:
+			cursor = pc.cnx.cursor( buffered=False )
+			finished = False
+			error = None
+			elapsed = 0.0
+			count = 0
+			try:
+				start = time.perf_counter()
+				cursor.execute( sql, params )
+				while True:
+					rows = cursor.fetchmany( chunk_size )
+					elapsed += time.perf_counter() - start
+					if not rows:
+						break
+					count += len(rows)
+					yield from rows
+					start = time.perf_counter()
+				finished = True
+			except Exception as err:
+				error = err
+				elapsed += time.perf_counter() - start
+				raise
+			finally:
+				metrics.record( sql, elapsed, count, params, error )
+				if finished:
+					cursor.close()
+				else:
+					pc.invalidate()
+
 	def run(self,  query):
 		rs = []
 
 		try:
-			with MySQLConnectionManager(self.config_file) as con:
+			with self.connection() as con:
 				with MySQLCursorManager( con ) as cursor:
 					statements = []
 					if ';' in query:
@@ -74,20 +702,32 @@ class SQL_runner():
 						statements.append(query)
 
 					for sttmt in statements:
-						cursor.execute( sttmt )
-						if cursor.with_rows:
-							rs = cursor.fetchall()
-						else:
-							rs = [(cursor.rowcount,)]
+						with self.metrics.measure( sttmt ) as measurement:
+							cursor.execute( sttmt )
+							if cursor.with_rows:
+								rs = cursor.fetchall()
+								measurement.rows = len(rs)
+							else:
+								rs = [(cursor.rowcount,)]
+								measurement.rows = max(cursor.rowcount, 0)
+				con.commit()
 							
-		except mysql.connector.Error as err:
-			if  err.errno == errorcode.ER_ACCESS_DENIED_ERROR:
-				print("Something is wrong with your user name or password")
-			elif err.errno == errorcode.ER_BAD_DB_ERROR:
-				print("Database does not exist")
-			else:
-				print(err)
-		except Exception as e:
-			print( e )
+		except Exception as err:
+			report_error(err)
 		finally: 
 			return rs
+
+
+def report_error(err):
+	"""
+	Print a short description of a failed query, as :class:`SQL_runner` does not raise.
+	"""
+	if isinstance(err, mysql.connector.Error):
+		if  err.errno == errorcode.ER_ACCESS_DENIED_ERROR:
+			print("Something is wrong with your user name or password")
+		elif err.errno == errorcode.ER_BAD_DB_ERROR:
+			print("Database does not exist")
+		else:
+			print(err)
+	else:
+		print( err )
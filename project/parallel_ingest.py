@@ -0,0 +1,174 @@
+import multiprocessing
+import os
+import unittest
+from concurrent.futures import ProcessPoolExecutor
+from mysqlutils import SQL_runner, read_config
+from bulk_ingest import BulkWriter, MAX_PACKET_SIZE
+from stream_ingest import chunked, DEFAULT_CHUNK_SIZE
+from ais_records import decode_messages
+
+# Set in each worker process by `_init_worker`
+_writer = None
+_chunk_size = DEFAULT_CHUNK_SIZE
+
+
+def default_workers(cfg=SQL_runner.config_file):
+    """
+    Number of ingest worker processes: `workers` of the optional `[INGEST]` section of the
+    configuration file, or the number of cores
+    """
+    config = read_config(cfg)
+    if config.has_section('INGEST') and config['INGEST'].get('workers'):
+        return int(config['INGEST']['workers'])
+    return os.cpu_count() or 1
+
+
+def partition_by_mmsi(messages, partitions):
+    """
+    Split messages in partitions by MMSI, so that all messages of a vessel land in the same
+    partition, in their original order
+
+    :param: messages: messages as parsed from JSON
+    :type: messages: list of dict
+    :param: partitions: number of partitions
+    :type: partitions: int
+    :rtype: list of lists
+    """
+    parts = [[] for _ in range(partitions)]
+    for doc in messages:
+        parts[int(doc["MMSI"]) % partitions].append(doc)
+    return parts
+
+
+def merge_counts(results):
+    """
+    Sum per-table insertion counts
+    """
+    counts = {"AIS_MESSAGE": 0, "STATIC_DATA": 0, "POSITION_REPORT": 0}
+    for result in results:
+        for table, count in result.items():
+            counts[table] += count
+    return counts
+
+
+def _init_worker(max_packet_size, chunk_size, load_tiles):
+    """
+    Give the worker process its own writer, and so its own connection pool and id allocator
+    """
+    global _writer, _chunk_size
+    tile_index = None
+    if load_tiles:
+        from tile_index import TileIndex
+        tile_index = TileIndex.load()
+    _writer = BulkWriter(max_packet_size=max_packet_size, tile_index=tile_index)
+    _chunk_size = chunk_size
+
+
+def _write_partition(messages):
+    """
+    Decode and write one partition, a transaction per chunk, in order
+    """
+    return merge_counts(_writer.write(decode_messages(chunk)) for chunk in chunked(messages, _chunk_size))
+
+
+class ParallelWriter:
+    """
+    Writes AIS messages from a pool of worker processes, one partition of vessels per worker
+
+    The parent only partitions the parsed messages; each worker decodes its partition, builds the
+    rows and writes them with its own connection, a transaction per chunk.
+    The messages of a vessel all go to the same worker and are written in order, but partitions
+    commit independently: if one fails, the others may already be written.
+    """
+
+    def __init__(self, workers=None, chunk_size=DEFAULT_CHUNK_SIZE, max_packet_size=MAX_PACKET_SIZE, load_tiles=False):
+        """
+        :param: workers: number of worker processes, from the configuration file if not given
+        :type: workers: int
+        :param: chunk_size: messages written per transaction
+        :type: chunk_size: int
+        :param: max_packet_size: maximum size of one INSERT statement, in bytes
+        :type: max_packet_size: int
+        :param: load_tiles: have the workers load the tile index to fill the tile columns
+        :type: load_tiles: bool
+        """
+        self.workers = workers if workers is not None else default_workers()
+        if self.workers < 1:
+            raise ValueError("workers must be at least 1")
+        self.chunk_size = chunk_size
+        self.max_packet_size = max_packet_size
+        self.load_tiles = load_tiles
+        self._executor = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def _pool(self):
+        if self._executor is None:
+            # Spawned rather than forked workers, so that no connection or lock is inherited
+            self._executor = ProcessPoolExecutor(max_workers=self.workers,
+                mp_context=multiprocessing.get_context("spawn"), initializer=_init_worker,
+                initargs=(self.max_packet_size, self.chunk_size, self.load_tiles))
+        return self._executor
+
+    def write(self, messages):
+        """
+        Insert AIS messages
+
+        :param: messages: messages as parsed from JSON
+        :type: messages: list of dict
+        :return: number of insertions per table
+        :rtype: dict
+        """
+        partitions = [part for part in partition_by_mmsi(messages, self.workers) if part]
+        if not partitions:
+            return merge_counts([])
+        futures = [self._pool().submit(_write_partition, part) for part in partitions]
+        return merge_counts(future.result() for future in futures)
+
+    def close(self):
+        """
+        Stop the worker processes
+        """
+        if self._executor is not None:
+            self._executor.shutdown(wait=True)
+            self._executor = None
+
+
+class ParallelIngestTest(unittest.TestCase):
+
+    def test_partition_by_mmsi(self):
+        """
+        Function `partition_by_mmsi` keeps each vessel in one partition, in order.
+        """
+        messages = [{"MsgType": "aton_report", "MMSI": mmsi, "Seq": seq} for seq, mmsi in enumerate([1, 2, 3, 1, 4, 1, 2])]
+        parts = partition_by_mmsi(messages, 3)
+        self.assertEqual(sum(len(part) for part in parts), len(messages))
+        for part in parts:
+            for mmsi in {doc["MMSI"] for doc in part}:
+                vessel = [doc["Seq"] for doc in messages if doc["MMSI"] == mmsi]
+                self.assertEqual([doc["Seq"] for doc in part if doc["MMSI"] == mmsi], vessel)
+        self.assertEqual([doc["Seq"] for doc in parts[1]], [0, 3, 4, 5])
+
+    def test_merge_counts(self):
+        """
+        Function `merge_counts` sums the insertions of each table.
+        """
+        counts = merge_counts([{"AIS_MESSAGE": 2, "STATIC_DATA": 1, "POSITION_REPORT": 1},
+                               {"AIS_MESSAGE": 3, "STATIC_DATA": 0, "POSITION_REPORT": 3}])
+        self.assertEqual(counts, {"AIS_MESSAGE": 5, "STATIC_DATA": 1, "POSITION_REPORT": 4})
+
+    def test_write_empty(self):
+        """
+        Function `write` returns zero counts for no messages, without starting workers.
+        """
+        with ParallelWriter(workers=2) as writer:
+            self.assertEqual(sum(writer.write([]).values()), 0)
+            self.assertIsNone(writer._executor)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,290 @@
+import unittest
+from datetime import datetime, timedelta, timezone
+from mysqlutils import SQL_runner, read_config
+from schema import ensure_schema, migrate_schema
+
+# Partition width, by granularity name
+GRANULARITIES = {
+    "hourly": timedelta(hours=1),
+    "daily": timedelta(days=1),
+}
+
+# Parent first; both tables get the same partitions, so a period is dropped from both at once
+PARTITIONED_TABLES = ("AIS_MESSAGE", "POSITION_REPORT")
+
+# Partitions below the first period, and from the last pre-created one on
+HEAD_PARTITION = "p0"
+TAIL_PARTITION = "pmax"
+
+READ_PARTITIONS = """
+    SELECT PARTITION_NAME, PARTITION_DESCRIPTION FROM information_schema.PARTITIONS
+    WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME = %s AND PARTITION_NAME IS NOT NULL
+    ORDER BY PARTITION_ORDINAL_POSITION
+    """
+
+READ_PRIMARY_KEY = """
+    SELECT COLUMN_NAME FROM information_schema.KEY_COLUMN_USAGE
+    WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME = %s AND CONSTRAINT_NAME = 'PRIMARY'
+    ORDER BY ORDINAL_POSITION
+    """
+
+# Partitioned InnoDB tables can neither have nor be the target of foreign keys
+READ_FOREIGN_KEYS = """
+    SELECT TABLE_NAME, CONSTRAINT_NAME FROM information_schema.REFERENTIAL_CONSTRAINTS
+    WHERE CONSTRAINT_SCHEMA = DATABASE()
+    AND (TABLE_NAME IN (%s, %s) OR REFERENCED_TABLE_NAME IN (%s, %s))
+    """
+
+BACKFILL_POSITION_REPORT_TIMESTAMP = """
+    UPDATE POSITION_REPORT JOIN AIS_MESSAGE ON POSITION_REPORT.AISMessage_Id = AIS_MESSAGE.Id
+    SET POSITION_REPORT.Timestamp = AIS_MESSAGE.Timestamp
+    WHERE POSITION_REPORT.Timestamp IS NULL
+    """
+
+# STATIC_DATA is not partitioned: the rows of a partition's messages are deleted before it is dropped
+DELETE_PARTITION_STATIC_DATA = """
+    DELETE STATIC_DATA FROM STATIC_DATA
+    JOIN AIS_MESSAGE PARTITION ({partition}) ON STATIC_DATA.AISMessage_Id = AIS_MESSAGE.Id
+    """
+
+# Vessels whose static data is deleted with a partition's messages
+READ_PARTITION_STATIC_DATA_MMSIS = """
+    SELECT DISTINCT AIS_MESSAGE.MMSI FROM STATIC_DATA
+    JOIN AIS_MESSAGE PARTITION ({partition}) ON STATIC_DATA.AISMessage_Id = AIS_MESSAGE.Id
+    """
+
+DELETE_EXPIRED_LATEST_POSITION = """
+    DELETE FROM LATEST_POSITION WHERE Timestamp < %s
+    """
+
+
+def period_start(timestamp, granularity):
+    """
+    Start of the partition period containing a timestamp
+    """
+    if granularity == "hourly":
+        return timestamp.replace(minute=0, second=0, microsecond=0)
+    return timestamp.replace(hour=0, minute=0, second=0, microsecond=0)
+
+
+def partition_name(start, granularity):
+    """
+    Name of the partition of the period starting at `start`, e.g. `p2020111800` or `p20201118`
+    """
+    return "p" + start.strftime("%Y%m%d%H" if granularity == "hourly" else "%Y%m%d")
+
+
+def partition_definitions(first, last, granularity):
+    """
+    Definitions of the partitions of the periods from `first` to `last` included
+
+    :rtype: list of str
+    """
+    step = GRANULARITIES[granularity]
+    definitions = []
+    start = first
+    while start <= last:
+        definitions.append(f"PARTITION {partition_name(start, granularity)} VALUES LESS THAN ('{start + step:%Y-%m-%d %H:%M:%S}')")
+        start += step
+    return definitions
+
+
+def parse_bound(description):
+    """
+    Upper bound of a partition from its information_schema description, None for MAXVALUE
+    """
+    if description is None or description == "MAXVALUE":
+        return None
+    return datetime.strptime(description.strip("'"), "%Y-%m-%d %H:%M:%S")
+
+
+class PartitionManager:
+    """
+    Range-partitions AIS_MESSAGE and POSITION_REPORT by Timestamp, one partition per hour or day,
+    keeps `ahead` future partitions ready and enforces retention by dropping whole partitions
+
+    Converting the tables (`partition_tables`) drops the foreign keys between the message tables,
+    which MySQL does not allow on partitioned tables, and adds Timestamp to the primary keys.
+    """
+
+    def __init__(self, granularity="daily", retention=timedelta(days=7), ahead=3, runner=None, static_data_cache=None):
+        """
+        :param: granularity: `hourly` or `daily`
+        :type: granularity: str
+        :param: retention: age beyond which a whole partition is dropped
+        :type: retention: timedelta
+        :param: ahead: number of future periods with a partition ready
+        :type: ahead: int
+        :param: runner: runner to use
+        :type: runner: SQL_runner
+        :param: static_data_cache: cache told about the vessels whose static data is dropped
+        :type: static_data_cache: StaticDataCache
+        """
+        if granularity not in GRANULARITIES:
+            raise ValueError(f"granularity must be one of {', '.join(GRANULARITIES)}")
+        self.granularity = granularity
+        self.step = GRANULARITIES[granularity]
+        self.retention = retention
+        self.ahead = ahead
+        self.runner = runner if runner is not None else SQL_runner()
+        self.static_data_cache = static_data_cache
+
+    @classmethod
+    def from_config(cls, cfg=SQL_runner.config_file, runner=None, static_data_cache=None):
+        """
+        Manager with the settings of the `[PARTITIONING]` section of the configuration file
+        (`granularity`, `retention_hours`, `ahead`), or None if there is no such section or the
+        database is SQLite, which has no partitions
+        """
+        config = read_config(cfg)
+        if not config.has_section('PARTITIONING') or config['SQL'].get('backend', 'mysql') != 'mysql':
+            return None
+        settings = config['PARTITIONING']
+        return cls(granularity=settings.get('granularity', 'daily'),
+                   retention=timedelta(hours=float(settings.get('retention_hours', 168))),
+                   ahead=int(settings.get('ahead', 3)),
+                   runner=runner,
+                   static_data_cache=static_data_cache)
+
+    def _now(self, now):
+        return now if now is not None else datetime.now(timezone.utc).replace(tzinfo=None)
+
+    def partitions(self, table):
+        """
+        Partitions of a table, in order
+
+        :return: (name, upper bound) pairs, the bound None for MAXVALUE
+        :rtype: list
+        """
+        rs = self.runner.execute(READ_PARTITIONS, (table,))
+        return [(name, parse_bound(description)) for name, description in rs]
+
+    def is_partitioned(self):
+        return all(self.partitions(table) for table in PARTITIONED_TABLES)
+
+    def partition_tables(self, now=None):
+        """
+        Convert AIS_MESSAGE and POSITION_REPORT to partitioned tables
+
+        Messages older than the retention go to the head partition, dropped by the next `drop_expired`.
+        The tables are rebuilt, so this takes as long as copying them.
+        """
+        now = self._now(now)
+        first = period_start(now - self.retention, self.granularity)
+        last = period_start(now, self.granularity) + self.ahead * self.step
+        definitions = [f"PARTITION {HEAD_PARTITION} VALUES LESS THAN ('{first:%Y-%m-%d %H:%M:%S}')"]
+        definitions += partition_definitions(first, last, self.granularity)
+        definitions.append(f"PARTITION {TAIL_PARTITION} VALUES LESS THAN (MAXVALUE)")
+
+        migrate_schema(self.runner)
+        ensure_schema(self.runner)
+        with self.runner.transaction() as cursor:
+            cursor.execute(READ_FOREIGN_KEYS, PARTITIONED_TABLES + PARTITIONED_TABLES)
+            for table, constraint in cursor.fetchall():
+                cursor.execute(f"ALTER TABLE {table} DROP FOREIGN KEY {constraint}")
+            cursor.execute(BACKFILL_POSITION_REPORT_TIMESTAMP)
+            cursor.execute("ALTER TABLE POSITION_REPORT MODIFY Timestamp DATETIME NOT NULL")
+            for table in PARTITIONED_TABLES:
+                cursor.execute(READ_PRIMARY_KEY, (table,))
+                key = [row[0] for row in cursor.fetchall()]
+                if key and "Timestamp" not in key:
+                    cursor.execute(f"ALTER TABLE {table} DROP PRIMARY KEY, ADD PRIMARY KEY ({', '.join(key + ['Timestamp'])})")
+                cursor.execute(f"ALTER TABLE {table} PARTITION BY RANGE COLUMNS(Timestamp) ({', '.join(definitions)})")
+
+    def create_future(self, now=None):
+        """
+        Split the tail partition so that the next `ahead` periods each have their own partition
+
+        :return: names of the partitions created
+        :rtype: list
+        """
+        last = period_start(self._now(now), self.granularity) + self.ahead * self.step
+        created = []
+        for table in PARTITIONED_TABLES:
+            bounds = [bound for _, bound in self.partitions(table) if bound is not None]
+            if not bounds or bounds[-1] > last:
+                continue
+            definitions = partition_definitions(bounds[-1], last, self.granularity)
+            definitions.append(f"PARTITION {TAIL_PARTITION} VALUES LESS THAN (MAXVALUE)")
+            with self.runner.transaction() as cursor:
+                cursor.execute(f"ALTER TABLE {table} REORGANIZE PARTITION {TAIL_PARTITION} INTO ({', '.join(definitions)})")
+            created += [definition.split()[1] for definition in definitions[:-1]]
+        return created
+
+    def drop_expired(self, now=None):
+        """
+        Drop the partitions whose whole period is older than the retention
+
+        :return: names of the partitions dropped
+        :rtype: list
+        """
+        cutoff = self._now(now) - self.retention
+        expired = [name for name, bound in self.partitions("AIS_MESSAGE") if bound is not None and bound <= cutoff]
+        if not expired:
+            return []
+        mmsis = set()
+        with self.runner.transaction() as cursor:
+            for name in expired:
+                if self.static_data_cache is not None:
+                    cursor.execute(READ_PARTITION_STATIC_DATA_MMSIS.format(partition=name))
+                    mmsis.update(row[0] for row in cursor.fetchall())
+                cursor.execute(DELETE_PARTITION_STATIC_DATA.format(partition=name))
+            cursor.execute(DELETE_EXPIRED_LATEST_POSITION, (cutoff,))
+        if mmsis:
+            # Their next static data must be written again, even if unchanged
+            self.static_data_cache.forget(mmsis)
+        for table in reversed(PARTITIONED_TABLES):
+            names = [name for name, _ in self.partitions(table) if name in expired]
+            if names:
+                with self.runner.transaction() as cursor:
+                    cursor.execute(f"ALTER TABLE {table} DROP PARTITION {', '.join(names)}")
+        return expired
+
+    def maintain(self, now=None):
+        """
+        Pre-create the future partitions and drop the expired ones
+
+        :return: names of the partitions created and dropped
+        :rtype: dict
+        """
+        return {"created": self.create_future(now), "dropped": self.drop_expired(now)}
+
+
+class PartitioningTest(unittest.TestCase):
+
+    def test_partition_definitions(self):
+        """
+        Function `partition_definitions` names each partition after its period, bounded by the next one.
+        """
+        start = datetime(2020, 11, 18, 22)
+        self.assertEqual(partition_definitions(start, start + timedelta(hours=1), "hourly"),
+                         ["PARTITION p2020111822 VALUES LESS THAN ('2020-11-18 23:00:00')",
+                          "PARTITION p2020111823 VALUES LESS THAN ('2020-11-19 00:00:00')"])
+        self.assertEqual(partition_definitions(datetime(2020, 11, 18), datetime(2020, 11, 18), "daily"),
+                         ["PARTITION p20201118 VALUES LESS THAN ('2020-11-19 00:00:00')"])
+
+    def test_period_start(self):
+        """
+        Function `period_start` truncates a timestamp to its hour or day.
+        """
+        timestamp = datetime(2020, 11, 18, 13, 37, 21, 5)
+        self.assertEqual(period_start(timestamp, "hourly"), datetime(2020, 11, 18, 13))
+        self.assertEqual(period_start(timestamp, "daily"), datetime(2020, 11, 18))
+
+    def test_parse_bound(self):
+        """
+        Function `parse_bound` reads the bounds information_schema reports for RANGE COLUMNS partitions.
+        """
+        self.assertEqual(parse_bound("'2020-11-19 00:00:00'"), datetime(2020, 11, 19))
+        self.assertIsNone(parse_bound("MAXVALUE"))
+
+    def test_granularity(self):
+        """
+        The manager only accepts hourly or daily partitions.
+        """
+        with self.assertRaises(ValueError):
+            PartitionManager(granularity="weekly", runner=object())
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,230 @@
+import threading
+import unittest
+from datetime import datetime
+from mysqlutils import SQL_runner
+from schema import ensure_schema
+from ais_records import decode_messages
+
+READ_LATEST_POSITIONS = """
+    SELECT MMSI, Timestamp, Latitude, Longitude, Vessel_IMO FROM LATEST_POSITION
+    """
+
+READ_LATEST_POSITION_MMSI = """
+    SELECT MMSI, Timestamp, Latitude, Longitude, Vessel_IMO FROM LATEST_POSITION WHERE MMSI = %s
+    """
+
+READ_LATEST_POSITION_MMSI_MANY = """
+    SELECT MMSI, Timestamp, Latitude, Longitude, Vessel_IMO FROM LATEST_POSITION WHERE MMSI IN ({keys})
+    """
+
+
+class LatestPositionStore:
+    """
+    In-process map from MMSI to the most recent position report of that vessel
+
+    Positions are kept as `(MMSI, Latitude, Longitude, Vessel_IMO)` rows, the shape the DAO's
+    position queries return, alongside their timestamp. A report older than the one stored
+    for its MMSI is ignored, so reports may arrive out of order.
+    """
+
+    def __init__(self, fallback_to_sql=True):
+        """
+        :param: fallback_to_sql: on a miss, look the MMSI up in the database (and remember it)
+        :type: fallback_to_sql: bool
+        """
+        self.fallback_to_sql = fallback_to_sql
+        self.warmed = False
+        self._positions = {}
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._positions)
+
+    def update(self, mmsi, timestamp, latitude, longitude, vessel_imo=None):
+        """
+        Record a position if it is the newest seen for its MMSI
+
+        :param: mmsi: MMSI of the vessel
+        :type: mmsi: int
+        :param: timestamp: time of the report
+        :type: timestamp: datetime
+        :return: True if the position replaced the stored one
+        :rtype: bool
+        """
+        with self._lock:
+            current = self._positions.get(mmsi)
+            if current is not None and current[0] > timestamp:
+                return False
+            if vessel_imo is None and current is not None:
+                vessel_imo = current[1][3]
+            self._positions[mmsi] = (timestamp, (mmsi, latitude, longitude, vessel_imo))
+            return True
+
+    def update_from_messages(self, messages):
+        """
+        Record the position reports among AIS message records
+
+        :param: messages: AIS message records
+        :type: messages: list of AISMessage
+        :return: number of positions that replaced a stored one
+        :rtype: int
+        """
+        updated = 0
+        for record in messages:
+            if record.msg_type == "position_report":
+                if self.update(record.mmsi, record.datetime, record.latitude, record.longitude):
+                    updated += 1
+        return updated
+
+    def get(self, mmsi, runner=None):
+        """
+        Most recent position of a vessel
+
+        :param: mmsi: MMSI of the vessel
+        :type: mmsi: int
+        :param: runner: runner used on a miss, when falling back to SQL
+        :type: runner: SQL_runner
+        :return: a position document (MMSI, Latitude, Longitude, Vessel_IMO), or None if unknown
+        :rtype: tuple
+        """
+        entry = self._positions.get(mmsi)
+        if entry is not None:
+            return entry[1]
+        if not self.fallback_to_sql:
+            return None
+
+        runner = runner if runner is not None else SQL_runner()
+        ensure_schema(runner)
+        rs = runner.execute(READ_LATEST_POSITION_MMSI, (mmsi,))
+        if not rs:
+            return None
+        mmsi, timestamp, latitude, longitude, vessel_imo = rs[0]
+        self.update(mmsi, timestamp, latitude, longitude, vessel_imo)
+        return self._positions[mmsi][1]
+
+    def get_many(self, mmsis, runner=None):
+        """
+        Most recent positions of several vessels, the misses looked up in the database together
+
+        :param: mmsis: MMSIs of the vessels
+        :type: mmsis: list
+        :param: runner: runner used for the misses, when falling back to SQL
+        :type: runner: SQL_runner
+        :return: a position document (MMSI, Latitude, Longitude, Vessel_IMO) per MMSI, None if unknown
+        :rtype: dict
+        """
+        positions = {}
+        missing = []
+        for mmsi in mmsis:
+            entry = self._positions.get(mmsi)
+            positions[mmsi] = entry[1] if entry is not None else None
+            if entry is None:
+                missing.append(mmsi)
+        if not missing or not self.fallback_to_sql:
+            return positions
+
+        runner = runner if runner is not None else SQL_runner()
+        ensure_schema(runner)
+        for mmsi, timestamp, latitude, longitude, vessel_imo in runner.execute_in(READ_LATEST_POSITION_MMSI_MANY, missing):
+            self.update(mmsi, timestamp, latitude, longitude, vessel_imo)
+            positions[mmsi] = self._positions[mmsi][1]
+        return positions
+
+    def expire(self, cutoff):
+        """
+        Forget the vessels whose latest position is older than `cutoff`, as retention deletes
+        them from LATEST_POSITION
+
+        :param: cutoff: oldest timestamp kept
+        :type: cutoff: datetime
+        :return: number of vessels forgotten
+        :rtype: int
+        """
+        with self._lock:
+            expired = [mmsi for mmsi, entry in self._positions.items() if entry[0] < cutoff]
+            for mmsi in expired:
+                del self._positions[mmsi]
+            return len(expired)
+
+    def all(self):
+        """
+        Most recent position of every known vessel
+
+        :return: list of position documents
+        :rtype: list
+        """
+        with self._lock:
+            return [entry[1] for entry in self._positions.values()]
+
+    def warm(self, runner=None, chunk_size=1000):
+        """
+        Load the latest position of every vessel from the database
+
+        :param: runner: runner to read with
+        :type: runner: SQL_runner
+        :return: number of vessels loaded
+        :rtype: int
+        """
+        runner = runner if runner is not None else SQL_runner()
+        ensure_schema(runner)
+        loaded = 0
+        for mmsi, timestamp, latitude, longitude, vessel_imo in runner.stream(READ_LATEST_POSITIONS, chunk_size=chunk_size):
+            self.update(mmsi, timestamp, latitude, longitude, vessel_imo)
+            loaded += 1
+        self.warmed = True
+        return loaded
+
+
+class LatestPositionStoreTest(unittest.TestCase):
+
+    def test_update(self):
+        """
+        Function `update` keeps only the newest position of each MMSI.
+        """
+        store = LatestPositionStore(fallback_to_sql=False)
+        self.assertTrue(store.update(1, datetime(2020, 11, 18, 0, 1), 55.0, 13.0, 9000001))
+        self.assertFalse(store.update(1, datetime(2020, 11, 18, 0, 0), 54.0, 12.0))
+        self.assertTrue(store.update(1, datetime(2020, 11, 18, 0, 2), 56.0, 14.0))
+        self.assertEqual(store.get(1), (1, 56.0, 14.0, 9000001))
+        self.assertEqual(len(store), 1)
+
+    def test_get_miss(self):
+        """
+        Function `get` returns None for an unknown MMSI when not falling back to SQL.
+        """
+        store = LatestPositionStore(fallback_to_sql=False)
+        self.assertIsNone(store.get(1))
+
+    def test_get_many(self):
+        """
+        Function `get_many` returns a position per MMSI, None for the unknown ones.
+        """
+        store = LatestPositionStore(fallback_to_sql=False)
+        store.update(7, datetime(2020, 11, 18), 55.0, 13.0, 9000001)
+        self.assertEqual(store.get_many([7, 8]), {7: (7, 55.0, 13.0, 9000001), 8: None})
+
+    def test_update_from_messages(self):
+        """
+        Function `update_from_messages` records position reports and skips static data.
+        """
+        store = LatestPositionStore(fallback_to_sql=False)
+        messages = decode_messages([
+            {"Timestamp": "2020-11-18T00:00:00.000Z", "MMSI": 1, "MsgType": "position_report",
+             "Position": {"type": "Point", "coordinates": [55.2, 13.3]}},
+            {"Timestamp": "2020-11-18T00:00:00.000Z", "MMSI": 2, "MsgType": "static_data"}])
+        self.assertEqual(store.update_from_messages(messages), 1)
+        self.assertEqual(store.all(), [(1, 55.2, 13.3, None)])
+
+    def test_expire(self):
+        """
+        Function `expire` forgets the vessels whose latest position is older than the cutoff.
+        """
+        store = LatestPositionStore(fallback_to_sql=False)
+        store.update(1, datetime(2020, 11, 18, 0, 0), 55.0, 13.0)
+        store.update(2, datetime(2020, 11, 18, 0, 10), 56.0, 13.0)
+        self.assertEqual(store.expire(datetime(2020, 11, 18, 0, 5)), 1)
+        self.assertEqual(store.all(), [(2, 56.0, 13.0, None)])
+
+
+if __name__ == '__main__':
+    unittest.main()
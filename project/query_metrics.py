@@ -0,0 +1,480 @@
+import os
+import re
+import tempfile
+import threading
+import time
+import unittest
+from bisect import bisect_left
+from collections import deque
+from contextlib import contextmanager
+from datetime import datetime
+from functools import lru_cache
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# Upper bounds of the latency histogram buckets, in seconds
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+DEFAULT_SLOW_QUERY_MS = 1000
+DEFAULT_SLOW_QUERY_KEEP = 100
+
+# Limits on what a slow-query entry keeps of the parameters
+MAX_LOGGED_PARAMS = 10
+MAX_LOGGED_VALUE = 64
+
+# Literals and placeholder lists are folded, so that a statement built with its values inlined
+# and an IN list of any length fall under the same template
+NORMALIZATIONS = [
+    (re.compile(r"'(?:[^'\\]|\\.|'')*'"), "?"),
+    (re.compile(r"(?<![\w.])-?\d+(?:\.\d+)?\b"), "?"),
+    (re.compile(r"%s"), "?"),
+    (re.compile(r"\(\s*\?(?:\s*,\s*\?)+\s*\)"), "(...)"),
+    (re.compile(r"\(\.\.\.\)(?:\s*,\s*\(\.\.\.\))+"), "(...), ..."),
+    (re.compile(r"\s+"), " "),
+]
+
+
+@lru_cache(maxsize=1024)
+def normalize_statement(sql):
+    """
+    Template of a statement: its text with the values replaced by `?` and the whitespace collapsed
+    """
+    for pattern, replacement in NORMALIZATIONS:
+        sql = pattern.sub(replacement, sql)
+    return sql.strip()
+
+
+def format_params(params):
+    """
+    Short text of the parameters of a statement, for the slow-query log
+
+    Long values (e.g. PNG tiles) are cut, and only the first sets of an `executemany` are kept.
+    """
+    def value(v):
+        text = repr(v)
+        return text if len(text) <= MAX_LOGGED_VALUE else text[:MAX_LOGGED_VALUE] + "..."
+
+    if params is None:
+        return ""
+    params = list(params)
+    if params and isinstance(params[0], (tuple, list)):
+        shown = ", ".join("(" + ", ".join(value(v) for v in p) + ")" for p in params[:MAX_LOGGED_PARAMS])
+        more = f", ... ({len(params)} sets)" if len(params) > MAX_LOGGED_PARAMS else ""
+        return "[" + shown + more + "]"
+    shown = ", ".join(value(v) for v in params[:MAX_LOGGED_PARAMS])
+    more = f", ... ({len(params)} values)" if len(params) > MAX_LOGGED_PARAMS else ""
+    return "(" + shown + more + ")"
+
+
+class Histogram:
+    """
+    Counts of observed durations in fixed buckets, with their sum and maximum
+    """
+
+    def __init__(self, bounds=LATENCY_BUCKETS):
+        """
+        :param: bounds: upper bounds of the buckets, increasing, in seconds
+        :type: bounds: tuple
+        """
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    def observe(self, seconds):
+        self.counts[bisect_left(self.bounds, seconds)] += 1
+        self.count += 1
+        self.sum += seconds
+        if seconds > self.max:
+            self.max = seconds
+
+    def cumulative(self):
+        """
+        Number of observations at most each bound, the last one (for +Inf) being the total
+
+        :rtype: list
+        """
+        total = 0
+        counts = []
+        for count in self.counts:
+            total += count
+            counts.append(total)
+        return counts
+
+    def quantile(self, q):
+        """
+        Estimate of a quantile: the upper bound of the bucket it falls in, or the maximum for the last one
+        """
+        if self.count == 0:
+            return 0.0
+        rank = q * self.count
+        for bound, count in zip(self.bounds, self.cumulative()):
+            if count >= rank:
+                return min(bound, self.max)
+        return self.max
+
+    def snapshot(self):
+        return {
+            "count": self.count,
+            "sum": self.sum,
+            "mean": self.sum / self.count if self.count else 0.0,
+            "max": self.max,
+            "p50": self.quantile(0.5),
+            "p95": self.quantile(0.95),
+            "p99": self.quantile(0.99),
+            "buckets": dict(zip(self.bounds + (float("inf"),), self.cumulative())),
+        }
+
+
+class TemplateStats:
+    """
+    Latencies, rows and errors of one statement template
+    """
+
+    def __init__(self):
+        self.latency = Histogram()
+        self.rows = 0
+        self.errors = 0
+
+    def snapshot(self):
+        snapshot = self.latency.snapshot()
+        snapshot["rows"] = self.rows
+        snapshot["errors"] = self.errors
+        return snapshot
+
+
+class Measurement:
+    """
+    Rows of a statement being measured, filled in by the caller of :meth:`QueryMetrics.measure`
+    """
+    __slots__ = ("rows",)
+
+    def __init__(self):
+        self.rows = 0
+
+
+class QueryMetrics:
+    """
+    Per-template latency histograms, row and error counts of the statements run through SQL_runner,
+    the time spent waiting for connections, and a log of the slow statements with their parameters
+
+    Read the counters with `snapshot`, or in the Prometheus text format with `prometheus`.
+    """
+
+    def __init__(self, enabled=True, slow_query_ms=DEFAULT_SLOW_QUERY_MS, slow_query_log=None,
+                 slow_query_keep=DEFAULT_SLOW_QUERY_KEEP):
+        """
+        :param: enabled: record anything at all
+        :type: enabled: bool
+        :param: slow_query_ms: duration from which a statement is logged, None to log none
+        :type: slow_query_ms: float
+        :param: slow_query_log: file the slow statements are appended to, besides the ones kept in memory
+        :type: slow_query_log: str
+        :param: slow_query_keep: number of slow statements kept in memory
+        :type: slow_query_keep: int
+        """
+        self.enabled = enabled
+        self.slow_query_ms = slow_query_ms
+        self.slow_query_log = slow_query_log
+        self._slow_queries = deque(maxlen=slow_query_keep)
+        self._lock = threading.Lock()
+        self.reset()
+
+    @classmethod
+    def from_settings(cls, settings):
+        """
+        Metrics with the settings of a `[METRICS]` configuration section
+        (`enabled`, `slow_query_ms`, `slow_query_log`, `slow_query_keep`)
+
+        :type: settings: mapping
+        """
+        slow_query_ms = settings.get('slow_query_ms', DEFAULT_SLOW_QUERY_MS)
+        return cls(enabled=str(settings.get('enabled', 'true')).lower() in ('1', 'true', 'yes', 'on'),
+                   slow_query_ms=float(slow_query_ms) if slow_query_ms not in (None, '') else None,
+                   slow_query_log=settings.get('slow_query_log') or None,
+                   slow_query_keep=int(settings.get('slow_query_keep', DEFAULT_SLOW_QUERY_KEEP)))
+
+    def reset(self):
+        """
+        Forget everything recorded so far
+        """
+        with self._lock:
+            self._templates = {}
+            self._acquire = Histogram()
+            self._slow_count = 0
+            self._slow_queries.clear()
+
+    def record(self, sql, seconds, rows=0, params=None, error=None):
+        """
+        Record one run of a statement
+
+        :param: sql: the statement, with its placeholders
+        :type: sql: str
+        :param: seconds: how long it ran
+        :type: seconds: float
+        :param: rows: rows returned or affected
+        :type: rows: int
+        :param: params: its parameters, for the slow-query log
+        :param: error: the exception it raised, if any
+        :type: error: Exception
+        """
+        if not self.enabled:
+            return
+        template = normalize_statement(sql)
+        slow = self.slow_query_ms is not None and seconds * 1000 >= self.slow_query_ms
+        with self._lock:
+            stats = self._templates.get(template)
+            if stats is None:
+                stats = self._templates[template] = TemplateStats()
+            stats.latency.observe(seconds)
+            stats.rows += rows
+            if error is not None:
+                stats.errors += 1
+            if slow:
+                self._slow_count += 1
+        if slow:
+            self._log_slow(sql, template, seconds, rows, params, error)
+
+    def add_rows(self, sql, rows):
+        """
+        Count rows fetched after a statement was recorded
+        """
+        if not self.enabled:
+            return
+        template = normalize_statement(sql)
+        with self._lock:
+            stats = self._templates.get(template)
+            if stats is not None:
+                stats.rows += rows
+
+    def record_acquire(self, seconds):
+        """
+        Record the time spent getting a connection
+        """
+        if not self.enabled:
+            return
+        with self._lock:
+            self._acquire.observe(seconds)
+
+    @contextmanager
+    def measure(self, sql, params=None):
+        """
+        Context manager timing the statement run in its block, recorded as an error if it raises
+
+        Set the `rows` of the yielded :class:`Measurement` to count the rows of the statement.
+        """
+        measurement = Measurement()
+        start = time.perf_counter()
+        try:
+            yield measurement
+        except Exception as err:
+            self.record(sql, time.perf_counter() - start, measurement.rows, params, err)
+            raise
+        self.record(sql, time.perf_counter() - start, measurement.rows, params)
+
+    def _log_slow(self, sql, template, seconds, rows, params, error):
+        entry = {
+            "time": datetime.now().isoformat(sep=" ", timespec="milliseconds"),
+            "seconds": seconds,
+            "rows": rows,
+            "template": template,
+            "statement": " ".join(sql.split()),
+            "params": format_params(params),
+            "error": str(error) if error is not None else None,
+        }
+        with self._lock:
+            self._slow_queries.append(entry)
+        if self.slow_query_log is not None:
+            line = f"{entry['time']} {seconds:.3f}s rows={rows} {entry['statement']} params={entry['params']}"
+            if error is not None:
+                line += f" error={entry['error']}"
+            try:
+                with open(self.slow_query_log, "a") as f:
+                    f.write(line + "\n")
+            except OSError as e:
+                print(e)
+
+    def snapshot(self):
+        """
+        Copy of the counters
+
+        :return: per-template stats (`queries`), connection-acquire times, error and slow-query totals,
+            and the latest slow statements
+        :rtype: dict
+        """
+        with self._lock:
+            queries = {template: stats.snapshot() for template, stats in self._templates.items()}
+            return {
+                "queries": queries,
+                "connection_acquire": self._acquire.snapshot(),
+                "errors": sum(stats["errors"] for stats in queries.values()),
+                "slow_queries": self._slow_count,
+                "slow_query_log": list(self._slow_queries),
+            }
+
+    def prometheus(self, prefix="sql"):
+        """
+        The counters in the Prometheus text exposition format
+
+        :param: prefix: prefix of the metric names
+        :type: prefix: str
+        :rtype: str
+        """
+        snapshot = self.snapshot()
+        lines = []
+
+        def histogram(name, help, series):
+            lines.append(f"# HELP {name} {help}")
+            lines.append(f"# TYPE {name} histogram")
+            for labels, stats in series:
+                for bound, count in stats["buckets"].items():
+                    le = "+Inf" if bound == float("inf") else repr(bound)
+                    lines.append(f"{name}_bucket{{{labels}{',' if labels else ''}le=\"{le}\"}} {count}")
+                lines.append(f"{name}_sum{{{labels}}} {stats['sum']!r}" if labels else f"{name}_sum {stats['sum']!r}")
+                lines.append(f"{name}_count{{{labels}}} {stats['count']}" if labels else f"{name}_count {stats['count']}")
+
+        def counter(name, help, series):
+            lines.append(f"# HELP {name} {help}")
+            lines.append(f"# TYPE {name} counter")
+            for labels, value in series:
+                lines.append(f"{name}{{{labels}}} {value}" if labels else f"{name} {value}")
+
+        queries = [(f'template="{escape_label(template)}"', stats) for template, stats in sorted(snapshot["queries"].items())]
+        histogram(f"{prefix}_query_duration_seconds", "Duration of the statements, by template", queries)
+        counter(f"{prefix}_query_rows_total", "Rows returned or affected, by template",
+                [(labels, stats["rows"]) for labels, stats in queries])
+        counter(f"{prefix}_query_errors_total", "Failed statements, by template",
+                [(labels, stats["errors"]) for labels, stats in queries])
+        histogram(f"{prefix}_connection_acquire_seconds", "Time spent getting a connection",
+                  [("", snapshot["connection_acquire"])])
+        counter(f"{prefix}_slow_queries_total", "Statements slower than the slow-query threshold",
+                [("", snapshot["slow_queries"])])
+        return "\n".join(lines) + "\n"
+
+
+def escape_label(value):
+    """
+    A label value escaped for the Prometheus text format
+    """
+    return value.replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+
+
+def serve_metrics(metrics, port, host=""):
+    """
+    Serve the Prometheus export of some metrics over HTTP, from a background thread
+
+    :param: metrics: the metrics to export, e.g. `get_metrics(SQL_runner.config_file)`
+    :type: metrics: QueryMetrics
+    :param: port: port to listen on
+    :type: port: int
+    :return: the server, to be stopped with `shutdown()`
+    :rtype: http.server.ThreadingHTTPServer
+    """
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            body = metrics.prometheus().encode()
+            self.send_response(200)
+            self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    server = ThreadingHTTPServer((host, port), Handler)
+    threading.Thread(target=server.serve_forever, name="metrics", daemon=True).start()
+    return server
+
+
+class QueryMetricsTest(unittest.TestCase):
+
+    def test_normalize_statement(self):
+        """
+        Function `normalize_statement` folds values, IN lists and multi-row VALUES into one template.
+        """
+        self.assertEqual(normalize_statement("SELECT * FROM VESSEL\n    WHERE IMO = %s"), "SELECT * FROM VESSEL WHERE IMO = ?")
+        self.assertEqual(normalize_statement("SELECT Id FROM PORT WHERE Id IN (%s, %s, %s) AND Name = 'Aarhus' LIMIT 5"),
+                         "SELECT Id FROM PORT WHERE Id IN (...) AND Name = ? LIMIT ?")
+        self.assertEqual(normalize_statement("INSERT INTO T (A, B) VALUES (1, 'a'), (2, 'b'), (-3, 'c')"),
+                         "INSERT INTO T (A, B) VALUES (...), ...")
+        self.assertEqual(normalize_statement("SELECT AIS_MESSAGE.Id FROM AIS_MESSAGE PARTITION (p20201118)"),
+                         "SELECT AIS_MESSAGE.Id FROM AIS_MESSAGE PARTITION (p20201118)")
+
+    def test_histogram(self):
+        """
+        A histogram counts observations into cumulative buckets and estimates quantiles from them.
+        """
+        histogram = Histogram(bounds=(0.01, 0.1, 1.0))
+        for seconds in (0.005, 0.01, 0.05, 0.5, 2.0):
+            histogram.observe(seconds)
+        self.assertEqual(histogram.cumulative(), [2, 3, 4, 5])
+        self.assertEqual((histogram.quantile(0.4), histogram.quantile(0.6), histogram.quantile(1.0)), (0.01, 0.1, 2.0))
+
+    def test_record(self):
+        """
+        Function `record` counts latency, rows and errors per template, and logs slow statements with their parameters.
+        """
+        with tempfile.TemporaryDirectory() as tmp:
+            log = os.path.join(tmp, "slow.log")
+            metrics = QueryMetrics(slow_query_ms=100, slow_query_log=log)
+            metrics.record("SELECT * FROM VESSEL WHERE IMO = %s", 0.002, rows=1, params=(9000001,))
+            metrics.record("SELECT * FROM VESSEL  WHERE IMO = %s", 0.3, rows=0, params=(9000002,))
+            metrics.record("DELETE FROM PORT WHERE Id = %s", 0.001, params=(1,), error=ValueError("locked"))
+            metrics.record_acquire(0.0001)
+            snapshot = metrics.snapshot()
+            with open(log) as f:
+                lines = f.readlines()
+
+        vessel = snapshot["queries"]["SELECT * FROM VESSEL WHERE IMO = ?"]
+        self.assertEqual((vessel["count"], vessel["rows"], vessel["errors"], vessel["max"]), (2, 1, 0, 0.3))
+        self.assertEqual((snapshot["errors"], snapshot["slow_queries"], snapshot["connection_acquire"]["count"]), (1, 1, 1))
+        self.assertEqual(snapshot["slow_query_log"][0]["params"], "(9000002)")
+        self.assertEqual(len(lines), 1)
+        self.assertTrue(lines[0].rstrip().endswith("WHERE IMO = %s params=(9000002)"))
+
+    def test_measure(self):
+        """
+        Function `measure` records the statement of its block, as an error if the block raises.
+        """
+        metrics = QueryMetrics()
+        with metrics.measure("UPDATE T SET A = %s", (1,)) as measurement:
+            measurement.rows = 3
+        with self.assertRaises(RuntimeError):
+            with metrics.measure("UPDATE T SET A = %s", (2,)):
+                raise RuntimeError()
+        stats = metrics.snapshot()["queries"]["UPDATE T SET A = ?"]
+        self.assertEqual((stats["count"], stats["rows"], stats["errors"]), (2, 3, 1))
+
+    def test_format_params(self):
+        """
+        Function `format_params` cuts long values and long `executemany` parameter lists.
+        """
+        self.assertEqual(format_params((1, "a" * 100)), "(1, '" + "a" * 63 + "...)")
+        self.assertEqual(format_params([(i,) for i in range(12)]),
+                         "[(0), (1), (2), (3), (4), (5), (6), (7), (8), (9), ... (12 sets)]")
+
+    def test_prometheus(self):
+        """
+        Function `prometheus` exports per-template histograms and counters in the text format.
+        """
+        metrics = QueryMetrics(enabled=True)
+        metrics.record('SELECT "x" FROM T WHERE A = %s', 0.003, rows=2)
+        text = metrics.prometheus()
+        self.assertIn('sql_query_duration_seconds_bucket{template="SELECT \\"x\\" FROM T WHERE A = ?",le="0.0025"} 0', text)
+        self.assertIn('sql_query_duration_seconds_bucket{template="SELECT \\"x\\" FROM T WHERE A = ?",le="+Inf"} 1', text)
+        self.assertIn('sql_query_rows_total{template="SELECT \\"x\\" FROM T WHERE A = ?"} 2', text)
+        self.assertIn("sql_connection_acquire_seconds_count 0", text)
+        self.assertIn("# TYPE sql_slow_queries_total counter", text)
+
+    def test_disabled(self):
+        """
+        Disabled metrics record nothing.
+        """
+        metrics = QueryMetrics(enabled=False)
+        metrics.record("SELECT 1", 5.0)
+        self.assertEqual((metrics.snapshot()["queries"], metrics.snapshot()["slow_queries"]), ({}, 0))
+
+
+if __name__ == '__main__':
+    unittest.main()
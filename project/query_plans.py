@@ -0,0 +1,284 @@
+import importlib
+import json
+import os
+import re
+import shutil
+import tempfile
+import unittest
+from collections import namedtuple
+from datetime import datetime
+from mysqlutils import SQL_runner
+
+# Modules whose READ_ and SELECT_ statements are the DAO's queries; a statement imported by a later
+# module keeps the name of the module defining it
+DAO_MODULES = ("trajectory", "position_store", "static_data_cache", "tile_index", "tile_cache", "retention", "tmb_dao")
+
+QUERY_PREFIXES = ("READ_", "SELECT_")
+
+# IN list the batch reads are explained with
+SAMPLE_KEYS = ", ".join(["%s"] * 4)
+
+# Queries that read every row of a table by design
+EXPECTED_FULL_SCANS = {
+    "tmb_dao.READ_MOST_RECENT_SHIP_POS": {"LATEST_POSITION"},
+    "position_store.READ_LATEST_POSITIONS": {"LATEST_POSITION"},
+    "static_data_cache.READ_LATEST_STATIC_DATA": {"AIS_MESSAGE", "STATIC_DATA"},
+    "tile_index.READ_MAP_VIEWS": {"MAP_VIEW"},
+}
+
+# Queries that sort by design: numbering the last positions of each vessel sorts the requested vessels' rows,
+# and warming the static data cache the whole static data history
+EXPECTED_SORTS = {"trajectory.READ_LAST_N_POS_MANY", "static_data_cache.READ_LATEST_STATIC_DATA"}
+
+# Values given to the placeholders compared with these columns; other placeholders get 1
+SAMPLE_VALUES = {
+    "Timestamp": datetime(2020, 11, 18),
+    "Name": "Aarhus",
+    "Country": "Denmark",
+}
+
+
+class QueryPlan(namedtuple('QueryPlan', ['name', 'statement', 'full_scans', 'filesort', 'temporary', 'plan', 'error'])):
+    """
+    What the database does for one query: the tables it reads whole, whether it sorts or builds
+    temporary tables, and the raw plan (or the error the EXPLAIN raised)
+    """
+    __slots__ = ()
+
+    @property
+    def unexpected_scans(self):
+        return [table for table in self.full_scans if table not in EXPECTED_FULL_SCANS.get(self.name, ())]
+
+    @property
+    def unexpected_sort(self):
+        return self.filesort and self.name not in EXPECTED_SORTS
+
+    @property
+    def flagged(self):
+        return self.error is not None or bool(self.unexpected_scans) or self.unexpected_sort or self.temporary
+
+
+def query_templates():
+    """
+    The statements of the DAO's reads, one entry per scale for the per-scale statements
+
+    :return: statement text by name, e.g. `tmb_dao.READ_POS_MMSI`
+    :rtype: dict
+    """
+    templates = {}
+    seen = set()
+    for module_name in DAO_MODULES:
+        module = importlib.import_module(module_name)
+        for name, value in vars(module).items():
+            if not name.startswith(QUERY_PREFIXES):
+                continue
+            statements = {f"{name}[{key}]": sql for key, sql in value.items()} if isinstance(value, dict) else {name: value}
+            for key, sql in statements.items():
+                if isinstance(sql, str) and sql not in seen:
+                    seen.add(sql)
+                    templates[f"{module_name}.{key}"] = sql.format(keys=SAMPLE_KEYS) if "{keys}" in sql else sql
+    return templates
+
+
+def sample_params(sql):
+    """
+    Plausible values for the placeholders of a statement, so that it can be explained
+    """
+    params = []
+    for match in re.finditer(r"%s", sql):
+        before = sql[:match.start()]
+        if re.search(r"\bLIMIT\s*$", before, re.I):
+            params.append(5)
+            continue
+        column = re.search(r"(\w+)\s*(?:[<>]?=|[<>]|\bLIKE)\s*$", before, re.I)
+        params.append(SAMPLE_VALUES.get(column.group(1), 1) if column else 1)
+    return tuple(params)
+
+
+def mysql_plan_issues(plan):
+    """
+    Full table scans, filesorts and temporary tables of a MySQL `EXPLAIN FORMAT=JSON` plan,
+    in either version of the format
+
+    :return: scanned tables, filesort, temporary table
+    :rtype: tuple
+    """
+    full_scans = []
+    issues = {"filesort": False, "temporary": False}
+
+    def walk(node):
+        if isinstance(node, list):
+            for item in node:
+                walk(item)
+        elif isinstance(node, dict):
+            table = node.get("table_name")
+            operation = str(node.get("operation", ""))
+            derived = "materialized_from_subquery" in node or (table or "").startswith("<")
+            if table and not derived and table not in full_scans:
+                if node.get("access_type") == "ALL" or operation.startswith("Table scan on"):
+                    full_scans.append(table)
+            if node.get("using_filesort") or node.get("access_type") == "sort":
+                issues["filesort"] = True
+            if node.get("using_temporary_table") or "temporary" in operation:
+                issues["temporary"] = True
+            for value in node.values():
+                walk(value)
+
+    walk(plan)
+    return full_scans, issues["filesort"], issues["temporary"]
+
+
+def sqlite_plan_issues(rows):
+    """
+    Full table scans, sorts and temporary tables of a SQLite `EXPLAIN QUERY PLAN`
+
+    :param: rows: (id, parent, notused, detail) rows of the plan
+    :type: rows: list
+    :return: scanned tables, sort, temporary table
+    :rtype: tuple
+    """
+    full_scans = []
+    subqueries = {"CONSTANT"}
+    filesort = temporary = False
+    for row in rows:
+        detail = row[3]
+        subquery = re.match(r"(?:CO-ROUTINE|MATERIALIZE) (\w+)", detail)
+        if subquery:
+            subqueries.add(subquery.group(1))
+        scan = re.match(r"SCAN (?:TABLE )?(\w+)", detail)
+        if scan and scan.group(1) not in subqueries and scan.group(1) not in full_scans:
+            full_scans.append(scan.group(1))
+        if detail.startswith("USE TEMP B-TREE FOR") and "ORDER BY" in detail:
+            filesort = True
+        elif detail.startswith(("USE TEMP B-TREE", "MATERIALIZE")):
+            temporary = True
+    return full_scans, filesort, temporary
+
+
+def explain(cursor, name, sql, backend="mysql"):
+    """
+    Plan of one statement, explained with sample values for its placeholders
+
+    :param: cursor: cursor to run the EXPLAIN with
+    :param: backend: `mysql` or `sqlite`
+    :type: backend: str
+    :rtype: QueryPlan
+    """
+    params = sample_params(sql)
+    try:
+        if backend == "sqlite":
+            cursor.execute("EXPLAIN QUERY PLAN " + sql, params)
+            plan = [tuple(row) for row in cursor.fetchall()]
+            full_scans, filesort, temporary = sqlite_plan_issues(plan)
+        else:
+            cursor.execute("EXPLAIN FORMAT=JSON " + sql, params)
+            plan = json.loads(cursor.fetchall()[0][0])
+            full_scans, filesort, temporary = mysql_plan_issues(plan)
+    except Exception as err:
+        return QueryPlan(name, sql, [], False, False, None, str(err))
+    return QueryPlan(name, sql, full_scans, filesort, temporary, plan, None)
+
+
+def explain_all(runner=None):
+    """
+    Plans of all the DAO's queries
+
+    :param: runner: runner to use
+    :type: runner: SQL_runner
+    :rtype: list of QueryPlan
+    """
+    runner = runner if runner is not None else SQL_runner()
+    backend = runner.backend
+    with runner.transaction() as cursor:
+        return [explain(cursor, name, sql, backend) for name, sql in query_templates().items()]
+
+
+def format_report(plans):
+    """
+    One line per query: `ok`, or what is wrong with its plan
+    """
+    lines = []
+    for plan in plans:
+        issues = []
+        if plan.error is not None:
+            issues.append(f"error: {plan.error}")
+        for table in plan.full_scans:
+            issues.append(f"full scan of {table}" + ("" if table in plan.unexpected_scans else " (expected)"))
+        if plan.filesort:
+            issues.append("filesort" + ("" if plan.unexpected_sort else " (expected)"))
+        if plan.temporary:
+            issues.append("temporary table")
+        status = "FLAGGED" if plan.flagged else "ok"
+        lines.append(f"{plan.name}: {status}" + (f" - {'; '.join(issues)}" if issues else ""))
+    return "\n".join(lines)
+
+
+class QueryPlansTest(unittest.TestCase):
+
+    def test_query_templates(self):
+        """
+        Function `query_templates` finds the DAO's queries once each, under the module defining them.
+        """
+        templates = query_templates()
+        self.assertIn("tmb_dao.READ_POS_MMSI", templates)
+        self.assertIn("tmb_dao.READ_MOST_RECENT_SHIP_POS_IN_TILE[3]", templates)
+        self.assertIn("trajectory.READ_LAST_N_POS", templates)
+        self.assertNotIn("tmb_dao.READ_LAST_N_POS", templates)
+        self.assertIn("IN (%s, %s, %s, %s)", templates["tmb_dao.READ_POS_MMSI_MANY"])
+
+    def test_sample_params(self):
+        """
+        Function `sample_params` gives each placeholder a value of the type of what it is compared with.
+        """
+        self.assertEqual(sample_params("SELECT * FROM T WHERE MMSI = %s AND Timestamp >= %s AND Name=%s LIMIT %s"),
+                         (1, datetime(2020, 11, 18), "Aarhus", 5))
+
+    def test_mysql_plan_issues(self):
+        """
+        Function `mysql_plan_issues` finds full scans, filesorts and temporary tables in both JSON formats.
+        """
+        v1 = {"query_block": {"ordering_operation": {"using_filesort": True, "grouping_operation": {
+            "using_temporary_table": True, "nested_loop": [
+                {"table": {"table_name": "PORT", "access_type": "ALL"}},
+                {"table": {"table_name": "MAP_VIEW", "access_type": "ref"}}]}}}}
+        self.assertEqual(mysql_plan_issues(v1), (["PORT"], True, True))
+        v2 = {"query_plan": {"operation": "Sort: AIS_MESSAGE.Timestamp DESC", "access_type": "sort", "inputs": [
+            {"operation": "Table scan on AIS_MESSAGE", "access_type": "table", "table_name": "AIS_MESSAGE"}]}}
+        self.assertEqual(mysql_plan_issues(v2), (["AIS_MESSAGE"], True, False))
+
+    def test_sqlite_plan_issues(self):
+        """
+        Function `sqlite_plan_issues` tells scans of tables from scans of subqueries.
+        """
+        rows = [(2, 0, 0, "CO-ROUTINE RECENT"), (10, 2, 0, "SCAN PORT"), (20, 2, 0, "USE TEMP B-TREE FOR GROUP BY"),
+                (30, 0, 0, "SCAN RECENT"), (40, 0, 0, "USE TEMP B-TREE FOR ORDER BY")]
+        self.assertEqual(sqlite_plan_issues(rows), (["PORT"], True, True))
+
+    def test_explain_sqlite(self):
+        """
+        The provisioned indexes remove the scan and sort of a vessel's latest position.
+        """
+        from mysqlutils import get_pool
+        from schema import provision_indexes
+        directory = tempfile.mkdtemp()
+        runner = SQL_runner()
+        runner.config_file = os.path.join(directory, "connection_data.conf")
+        with open(runner.config_file, "w") as f:
+            f.write(f"[SQL]\nbackend=sqlite\n\n[SQLITE]\npath={os.path.join(directory, 'ais.db')}\n")
+        try:
+            with runner.transaction() as cursor:
+                before = explain(cursor, "READ_POS_MMSI", importlib.import_module("tmb_dao").READ_POS_MMSI, "sqlite")
+            self.assertTrue(before.flagged)
+            self.assertIn("AIS_MESSAGE_MMSI_Timestamp", provision_indexes(runner)["AIS_MESSAGE"])
+            plans = {plan.name: plan for plan in explain_all(runner)}
+            self.assertFalse(plans["tmb_dao.READ_POS_MMSI"].flagged)
+            self.assertFalse(plans["trajectory.READ_LAST_N_POS"].flagged)
+            self.assertEqual([plan.name for plan in plans.values() if plan.error is not None], [])
+            self.assertIn("tmb_dao.READ_POS_MMSI: ok", format_report(plans.values()))
+        finally:
+            get_pool(runner.config_file).close()
+            shutil.rmtree(directory)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,274 @@
+import threading
+import time
+import unittest
+from datetime import datetime, timedelta, timezone
+from mysqlutils import SQL_runner, read_config
+from schema import ensure_indexes, BASE_TABLE_INDEXES
+from partitioning import PartitionManager
+from position_store import LatestPositionStore
+
+DEFAULT_MAX_AGE = timedelta(minutes=5)
+DEFAULT_CHUNK_SIZE = 1000
+DEFAULT_INTERVAL = 60
+
+# Next chunk of expired messages, in Id order
+SELECT_EXPIRED_IDS = """
+    SELECT Id FROM AIS_MESSAGE WHERE Timestamp < %s AND Id > %s ORDER BY Id LIMIT %s
+    """
+
+# One chunk is deleted children first, each statement bounded by the chunk's Id range
+DELETE_EXPIRED = {
+    "POSITION_REPORT": """
+    DELETE POSITION_REPORT FROM POSITION_REPORT
+    JOIN AIS_MESSAGE ON POSITION_REPORT.AISMessage_Id = AIS_MESSAGE.Id
+    WHERE AIS_MESSAGE.Id BETWEEN %s AND %s AND AIS_MESSAGE.Timestamp < %s
+    """,
+    "STATIC_DATA": """
+    DELETE STATIC_DATA FROM STATIC_DATA
+    JOIN AIS_MESSAGE ON STATIC_DATA.AISMessage_Id = AIS_MESSAGE.Id
+    WHERE AIS_MESSAGE.Id BETWEEN %s AND %s AND AIS_MESSAGE.Timestamp < %s
+    """,
+    "AIS_MESSAGE": """
+    DELETE FROM AIS_MESSAGE WHERE Id BETWEEN %s AND %s AND Timestamp < %s
+    """,
+}
+
+# Vessels whose static data is deleted with one chunk
+SELECT_EXPIRED_STATIC_DATA_MMSIS = """
+    SELECT DISTINCT AIS_MESSAGE.MMSI FROM STATIC_DATA
+    JOIN AIS_MESSAGE ON STATIC_DATA.AISMessage_Id = AIS_MESSAGE.Id
+    WHERE AIS_MESSAGE.Id BETWEEN %s AND %s AND AIS_MESSAGE.Timestamp < %s
+    """
+
+# Vessels whose latest position has expired
+DELETE_EXPIRED_LATEST_POSITION = """
+    DELETE FROM LATEST_POSITION WHERE Timestamp < %s LIMIT %s
+    """
+
+
+class RetentionEngine:
+    """
+    Purges the messages older than `max_age`, a bounded chunk of message ids per transaction,
+    so that no purge holds locks or undo for long
+
+    Run `purge` once, or `start` a background thread that purges every `interval` seconds.
+    With a partition manager, each purge first maintains the partitions, so that whole expired
+    periods are dropped and only the rest is deleted row by row.
+    """
+
+    def __init__(self, max_age=DEFAULT_MAX_AGE, chunk_size=DEFAULT_CHUNK_SIZE, interval=DEFAULT_INTERVAL, runner=None,
+                 partitions=None, position_store=None, static_data_cache=None):
+        """
+        :param: max_age: age beyond which messages are deleted
+        :type: max_age: timedelta
+        :param: chunk_size: messages deleted per transaction
+        :type: chunk_size: int
+        :param: interval: seconds between two purges of the background job
+        :type: interval: float
+        :param: runner: runner to use
+        :type: runner: SQL_runner
+        :param: partitions: manager of the time partitions of the message tables, if they are partitioned
+        :type: partitions: PartitionManager
+        :param: position_store: in-memory latest positions, pruned like LATEST_POSITION
+        :type: position_store: LatestPositionStore
+        :param: static_data_cache: cache told about the vessels whose static data is purged, so that
+            their next static data is written again
+        :type: static_data_cache: StaticDataCache
+        """
+        self.max_age = max_age
+        self.chunk_size = chunk_size
+        self.interval = interval
+        self.runner = runner if runner is not None else SQL_runner()
+        self.partitions = partitions
+        self.position_store = position_store
+        self.static_data_cache = static_data_cache
+        self.last_report = None
+        self._indexed = False
+        self._stop = threading.Event()
+        self._thread = None
+
+    @classmethod
+    def from_config(cls, cfg=SQL_runner.config_file, runner=None, position_store=None, static_data_cache=None):
+        """
+        Engine with the settings of the optional `[RETENTION]` section of the configuration file
+        (`max_age_minutes`, `chunk_size`, `interval`), maintaining the partitions configured in
+        the `[PARTITIONING]` section if there is one
+        """
+        config = read_config(cfg)
+        settings = config['RETENTION'] if config.has_section('RETENTION') else {}
+        return cls(max_age=timedelta(minutes=float(settings.get('max_age_minutes', DEFAULT_MAX_AGE.total_seconds() / 60))),
+                   chunk_size=int(settings.get('chunk_size', DEFAULT_CHUNK_SIZE)),
+                   interval=float(settings.get('interval', DEFAULT_INTERVAL)),
+                   runner=runner,
+                   partitions=PartitionManager.from_config(cfg, runner, static_data_cache),
+                   position_store=position_store,
+                   static_data_cache=static_data_cache)
+
+    def _next_chunk(self, cutoff, after):
+        """
+        Ids of the next expired messages after the id `after`, in order
+        """
+        rs = self.runner.execute(SELECT_EXPIRED_IDS, (cutoff, after, self.chunk_size))
+        return [row[0] for row in rs]
+
+    def _delete_chunk(self, first, last, cutoff):
+        """
+        Delete the expired messages with ids from `first` to `last` and their children, in one transaction
+
+        :return: number of rows deleted per table
+        :rtype: dict
+        """
+        deleted = {}
+        mmsis = []
+        with self.runner.transaction() as cursor:
+            if self.static_data_cache is not None:
+                cursor.execute(SELECT_EXPIRED_STATIC_DATA_MMSIS, (first, last, cutoff))
+                mmsis = [row[0] for row in cursor.fetchall()]
+            for table, statement in DELETE_EXPIRED.items():
+                cursor.execute(statement, (first, last, cutoff))
+                deleted[table] = cursor.rowcount
+        if mmsis:
+            # Their next static data must be written again, even if unchanged
+            self.static_data_cache.forget(mmsis)
+        return deleted
+
+    def _delete_latest_positions(self, cutoff):
+        deleted = 0
+        while True:
+            rs = self.runner.execute(DELETE_EXPIRED_LATEST_POSITION, (cutoff, self.chunk_size))
+            deleted += rs[0][0] if rs else 0
+            if not rs or rs[0][0] < self.chunk_size:
+                return deleted
+
+    def purge(self, now=None):
+        """
+        Delete everything older than `max_age`
+
+        :param: now: the current time, naive UTC like the message timestamps
+        :type: now: datetime
+        :return: rows deleted per table, with the elapsed time and the deletion rate
+        :rtype: dict
+        """
+        now = now if now is not None else datetime.now(timezone.utc).replace(tzinfo=None)
+        cutoff = now - self.max_age
+        if not self._indexed:
+            with self.runner.transaction() as cursor:
+                # The Timestamp index lets the purge find expired messages without scanning the table
+                ensure_indexes(cursor, "AIS_MESSAGE", BASE_TABLE_INDEXES["AIS_MESSAGE"])
+            self._indexed = True
+
+        start = time.perf_counter()
+        report = {"POSITION_REPORT": 0, "STATIC_DATA": 0, "AIS_MESSAGE": 0, "LATEST_POSITION": 0}
+        partitions = self.partitions.maintain(now) if self.partitions is not None else {"created": [], "dropped": []}
+        after = 0
+        while True:
+            ids = self._next_chunk(cutoff, after)
+            if not ids:
+                break
+            for table, count in self._delete_chunk(ids[0], ids[-1], cutoff).items():
+                report[table] += count
+            after = ids[-1]
+            if len(ids) < self.chunk_size:
+                break
+        report["LATEST_POSITION"] = self._delete_latest_positions(cutoff)
+        if self.position_store is not None:
+            # Dropping partitions deletes the latest positions older than their own retention
+            partitions_cutoff = now - self.partitions.retention if self.partitions is not None else cutoff
+            self.position_store.expire(max(cutoff, partitions_cutoff))
+
+        elapsed = time.perf_counter() - start
+        rows = sum(report.values())
+        report["rows"] = rows
+        report["seconds"] = elapsed
+        report["rows_per_sec"] = rows / elapsed if elapsed > 0 else 0.0
+        report["partitions_dropped"] = partitions["dropped"]
+        self.last_report = report
+        return report
+
+    def _run(self):
+        while not self._stop.is_set():
+            try:
+                report = self.purge()
+                print(f"Purged {report['rows']} rows older than {self.max_age} "
+                      f"in {report['seconds']:.2f} s ({report['rows_per_sec']:.1f} rows/sec), "
+                      f"{len(report['partitions_dropped'])} partitions dropped")
+            except Exception as e:
+                print(e)
+            self._stop.wait(self.interval)
+
+    def start(self):
+        """
+        Purge in a background thread, every `interval` seconds, until `stop` is called
+        """
+        if self._thread is not None and self._thread.is_alive():
+            return
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name="retention", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        """
+        Stop the background job, waiting for a running purge to finish
+        """
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+
+class RetentionEngineTest(unittest.TestCase):
+
+    class FakeEngine(RetentionEngine):
+        def __init__(self, ids, chunk_size):
+            super().__init__(chunk_size=chunk_size, runner=object())
+            self._indexed = True
+            self.ids = ids
+            self.chunks = []
+
+        def _next_chunk(self, cutoff, after):
+            return [id for id in self.ids if id > after][:self.chunk_size]
+
+        def _delete_chunk(self, first, last, cutoff):
+            self.chunks.append((first, last))
+            count = len([id for id in self.ids if first <= id <= last])
+            return {"POSITION_REPORT": count, "STATIC_DATA": 0, "AIS_MESSAGE": count}
+
+        def _delete_latest_positions(self, cutoff):
+            return 1
+
+    def test_purge_chunks(self):
+        """
+        Function `purge` deletes the expired messages a bounded id range at a time.
+        """
+        engine = self.FakeEngine([3, 4, 9, 10, 11, 20, 21], chunk_size=3)
+        report = engine.purge()
+        self.assertEqual(engine.chunks, [(3, 9), (10, 20), (21, 21)])
+        self.assertEqual((report["AIS_MESSAGE"], report["POSITION_REPORT"], report["LATEST_POSITION"]), (7, 7, 1))
+        self.assertEqual(report["rows"], 15)
+        self.assertTrue(report["rows_per_sec"] >= 0)
+
+    def test_purge_position_store(self):
+        """
+        Function `purge` forgets the in-memory latest positions that LATEST_POSITION no longer has.
+        """
+        engine = self.FakeEngine([], chunk_size=3)
+        engine.position_store = LatestPositionStore(fallback_to_sql=False)
+        engine.position_store.update(1, datetime(2020, 11, 18, 0, 0), 55.0, 13.0)
+        engine.position_store.update(2, datetime(2020, 11, 18, 0, 9), 56.0, 13.0)
+        engine.purge(now=datetime(2020, 11, 18, 0, 10))
+        self.assertEqual(engine.position_store.all(), [(2, 56.0, 13.0, None)])
+
+    def test_background_job(self):
+        """
+        Functions `start` and `stop` run purges in a background thread.
+        """
+        engine = self.FakeEngine([], chunk_size=3)
+        engine.interval = 0.01
+        engine.start()
+        time.sleep(0.05)
+        engine.stop()
+        self.assertEqual(engine.last_report["LATEST_POSITION"], 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
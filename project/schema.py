@@ -0,0 +1,298 @@
+import argparse
+import sys
+import threading
+from mysqlutils import SQL_runner
+
+# Latest position report of each vessel, maintained by the insert methods so that
+# "most recent position" reads do not aggregate over the whole message history
+CREATE_LATEST_POSITION = """
+    CREATE TABLE IF NOT EXISTS LATEST_POSITION (
+    MMSI INT NOT NULL PRIMARY KEY,
+    AISMessage_Id INT NOT NULL,
+    Timestamp DATETIME NOT NULL,
+    Vessel_IMO INT NULL,
+    Latitude DOUBLE NOT NULL,
+    Longitude DOUBLE NOT NULL,
+    MapView1_Id INT NULL,
+    MapView2_Id INT NULL,
+    MapView3_Id INT NULL)
+    """
+
+# Secondary indexes of LATEST_POSITION, by name
+LATEST_POSITION_INDEXES = {
+    "LATEST_POSITION_Vessel_IMO": "(Vessel_IMO)",
+    "LATEST_POSITION_MapView1": "(MapView1_Id)",
+    "LATEST_POSITION_MapView2": "(MapView2_Id)",
+    "LATEST_POSITION_MapView3": "(MapView3_Id)",
+}
+
+# Secondary indexes of the base tables, by table and name, for the filters, joins and sorts of the
+# DAO's reads; the time-ordered reads of one vessel (read_pos_MMSI, read_last_n_pos,
+# read_positions_between) walk (MMSI, Timestamp) backwards instead of sorting the vessel's messages
+BASE_TABLE_INDEXES = {
+    "AIS_MESSAGE": {
+        "AIS_MESSAGE_MMSI_Timestamp": "(MMSI, Timestamp)",
+        "AIS_MESSAGE_Timestamp": "(Timestamp)",
+    },
+    "PORT": {
+        "PORT_Name_Country": "(Name, Country)",
+    },
+    "MAP_VIEW": {
+        "MAP_VIEW_Scale": "(Scale)",
+    },
+}
+
+# Columns added to the base tables. POSITION_REPORT carries its message's timestamp so that
+# it can be partitioned, and its reads pruned, by time (see partitioning.py)
+POSITION_REPORT_COLUMNS = {
+    "Timestamp": "DATETIME NULL",
+}
+
+DEFAULT_BACKFILL_CHUNK_SIZE = 1000
+
+# Whether POSITION_REPORT has any row, i.e. whether adding a column means filling it
+READ_ANY_POSITION_REPORT = """
+    SELECT AISMessage_Id FROM POSITION_REPORT LIMIT 1
+    """
+
+# Next chunk of position reports written before POSITION_REPORT had the Timestamp column, in id order
+SELECT_POSITION_REPORTS_WITHOUT_TIMESTAMP = """
+    SELECT AISMessage_Id FROM POSITION_REPORT WHERE Timestamp IS NULL AND AISMessage_Id > %s
+    ORDER BY AISMessage_Id LIMIT %s
+    """
+
+# Timestamps of one chunk of those position reports, bounded by its id range
+BACKFILL_POSITION_REPORT_TIMESTAMP = """
+    UPDATE POSITION_REPORT SET Timestamp = (
+    SELECT AIS_MESSAGE.Timestamp FROM AIS_MESSAGE WHERE AIS_MESSAGE.Id = POSITION_REPORT.AISMessage_Id)
+    WHERE AISMessage_Id BETWEEN %s AND %s AND Timestamp IS NULL
+    """
+
+# Most recent position report of every MMSI in the history, ties broken by the highest message id
+BACKFILL_LATEST_POSITION = """
+    INSERT IGNORE INTO LATEST_POSITION
+    (MMSI, AISMessage_Id, Timestamp, Vessel_IMO, Latitude, Longitude, MapView1_Id, MapView2_Id, MapView3_Id)
+    SELECT AIS_MESSAGE.MMSI, AIS_MESSAGE.Id, AIS_MESSAGE.Timestamp, AIS_MESSAGE.Vessel_IMO,
+    POSITION_REPORT.Latitude, POSITION_REPORT.Longitude,
+    POSITION_REPORT.MapView1_Id, POSITION_REPORT.MapView2_Id, POSITION_REPORT.MapView3_Id
+    FROM POSITION_REPORT
+    JOIN AIS_MESSAGE ON POSITION_REPORT.AISMessage_Id = AIS_MESSAGE.Id
+    JOIN (SELECT MMSI, max(AIS_MESSAGE.Timestamp) AS time FROM AIS_MESSAGE
+          JOIN POSITION_REPORT ON POSITION_REPORT.AISMessage_Id = AIS_MESSAGE.Id
+          GROUP BY MMSI) LATEST
+    ON AIS_MESSAGE.MMSI = LATEST.MMSI AND AIS_MESSAGE.Timestamp = LATEST.time
+    ORDER BY AIS_MESSAGE.Id DESC
+    """
+
+_ensured = set()
+_ensured_lock = threading.Lock()
+
+
+class MigrationRequired(Exception):
+    """
+    Raised by `ensure_schema` when the database needs a change too long to make on the way to a
+    read or an insert; run `python schema.py indexes`
+    """
+
+
+def ensure_indexes(cursor, table, indexes):
+    """
+    Add the indexes of a table that do not exist yet
+
+    :param: cursor: cursor to run the statements with
+    :param: table: table name
+    :type: table: str
+    :param: indexes: column lists, e.g. `(MMSI, Timestamp)`, by index name
+    :type: indexes: dict
+    :return: names of the indexes created
+    :rtype: list
+    """
+    cursor.execute(f"SHOW INDEX FROM {table}")
+    name_column = [column[0] for column in cursor.description].index("Key_name")
+    existing = {row[name_column] for row in cursor.fetchall()}
+    created = []
+    for name, columns in indexes.items():
+        if name not in existing:
+            cursor.execute(f"CREATE INDEX {name} ON {table} {columns}")
+            created.append(name)
+    return created
+
+
+def table_columns(cursor, table):
+    """
+    Names of the columns of a table
+
+    :rtype: set
+    """
+    cursor.execute(f"SHOW COLUMNS FROM {table}")
+    return {row[0] for row in cursor.fetchall()}
+
+
+def ensure_columns(cursor, table, columns):
+    """
+    Add the columns of a table that do not exist yet
+
+    :param: cursor: cursor to run the statements with
+    :param: table: table name
+    :type: table: str
+    :param: columns: column definitions, e.g. `DATETIME NULL`, by column name
+    :type: columns: dict
+    :return: names of the columns added
+    :rtype: list
+    """
+    existing = table_columns(cursor, table)
+    added = []
+    for name, definition in columns.items():
+        if name not in existing:
+            cursor.execute(f"ALTER TABLE {table} ADD COLUMN {name} {definition}")
+            added.append(name)
+    return added
+
+
+def ensure_schema(runner=None):
+    """
+    Check that the derived tables and columns exist, creating them on a database without
+    position reports
+
+    Filling them from the message history is left to `rebuild_latest_position` and
+    `migrate_schema`, run from the command line. Runs once per process and configuration file.
+
+    :param: runner: runner to use
+    :type: runner: SQL_runner
+    :raises: MigrationRequired: if POSITION_REPORT has rows but LATEST_POSITION or the derived columns do not exist
+    """
+    runner = runner if runner is not None else SQL_runner()
+    with _ensured_lock:
+        if runner.config_file in _ensured:
+            return
+        # Only existence checks, and DDL on tables without rows (which MySQL commits implicitly)
+        with runner.transaction() as cursor:
+            cursor.execute("SHOW TABLES LIKE 'LATEST_POSITION'")
+            exists = len(cursor.fetchall()) > 0
+            missing = sorted(set(POSITION_REPORT_COLUMNS) - table_columns(cursor, "POSITION_REPORT"))
+            if not exists or missing:
+                cursor.execute(READ_ANY_POSITION_REPORT)
+                history = len(cursor.fetchall()) > 0
+                if history and not exists:
+                    raise MigrationRequired("LATEST_POSITION does not exist yet: run `python schema.py` "
+                                            "to build it from the message history")
+                if history:
+                    raise MigrationRequired(f"POSITION_REPORT has no {', '.join(missing)} column yet: "
+                                            f"run `python schema.py indexes` to add and fill it")
+            if not exists:
+                cursor.execute(CREATE_LATEST_POSITION)
+            ensure_indexes(cursor, "LATEST_POSITION", LATEST_POSITION_INDEXES)
+            ensure_columns(cursor, "POSITION_REPORT", POSITION_REPORT_COLUMNS)
+        _ensured.add(runner.config_file)
+
+
+def backfill_position_report_timestamp(runner=None, chunk_size=DEFAULT_BACKFILL_CHUNK_SIZE):
+    """
+    Fill the Timestamp of the position reports written before POSITION_REPORT had the column,
+    a bounded id range per transaction, as `RetentionEngine` deletes
+
+    :param: runner: runner to use
+    :type: runner: SQL_runner
+    :param: chunk_size: position reports filled per transaction
+    :type: chunk_size: int
+    :return: number of position reports filled
+    :rtype: int
+    """
+    runner = runner if runner is not None else SQL_runner()
+    filled = 0
+    after = 0
+    while True:
+        with runner.transaction() as cursor:
+            cursor.execute(SELECT_POSITION_REPORTS_WITHOUT_TIMESTAMP, (after, chunk_size))
+            ids = [row[0] for row in cursor.fetchall()]
+            if ids:
+                cursor.execute(BACKFILL_POSITION_REPORT_TIMESTAMP, (ids[0], ids[-1]))
+                filled += cursor.rowcount
+        if len(ids) < chunk_size:
+            return filled
+        after = ids[-1]
+
+
+def migrate_schema(runner=None, chunk_size=DEFAULT_BACKFILL_CHUNK_SIZE):
+    """
+    Add the derived columns of the base tables and fill them for the existing rows
+
+    :param: runner: runner to use
+    :type: runner: SQL_runner
+    :param: chunk_size: rows filled per transaction
+    :type: chunk_size: int
+    :return: number of position reports whose Timestamp was filled
+    :rtype: int
+    """
+    runner = runner if runner is not None else SQL_runner()
+    # MySQL commits an ALTER TABLE on its own: the column exists before the first chunk is filled
+    with runner.transaction() as cursor:
+        ensure_columns(cursor, "POSITION_REPORT", POSITION_REPORT_COLUMNS)
+    return backfill_position_report_timestamp(runner, chunk_size)
+
+
+def rebuild_latest_position(runner=None):
+    """
+    Refill the LATEST_POSITION table from the message history
+
+    :param: runner: runner to use
+    :type: runner: SQL_runner
+    :return: number of vessels
+    :rtype: int
+    """
+    runner = runner if runner is not None else SQL_runner()
+    with runner.transaction() as cursor:
+        cursor.execute(CREATE_LATEST_POSITION)
+        ensure_indexes(cursor, "LATEST_POSITION", LATEST_POSITION_INDEXES)
+        cursor.execute("DELETE FROM LATEST_POSITION")
+        cursor.execute(BACKFILL_LATEST_POSITION)
+        return cursor.rowcount
+
+
+def provision_indexes(runner=None):
+    """
+    Create the derived tables, and the indexes of the base tables that do not exist yet
+
+    Building an index on a large table takes a while and, on MySQL, is done online. Run
+    `migrate_schema` first on a database written before the derived columns existed.
+
+    :param: runner: runner to use
+    :type: runner: SQL_runner
+    :return: names of the indexes created, by table
+    :rtype: dict
+    """
+    runner = runner if runner is not None else SQL_runner()
+    ensure_schema(runner)
+    created = {}
+    with runner.transaction() as cursor:
+        for table, indexes in BASE_TABLE_INDEXES.items():
+            created[table] = ensure_indexes(cursor, table, indexes)
+    return created
+
+
+def main(argv=None):
+    """
+    Rebuild LATEST_POSITION, migrate the schema and provision the indexes, or check the plans of the DAO's queries
+    """
+    parser = argparse.ArgumentParser(description="Maintain the derived tables and indexes of the AIS database.")
+    parser.add_argument("command", nargs="?", default="rebuild", choices=("rebuild", "indexes", "explain"),
+        help="rebuild LATEST_POSITION (default), add and fill the derived columns and create the missing indexes, "
+             "or report the DAO's queries that scan whole tables, sort or use temporary tables")
+    args = parser.parse_args(argv)
+
+    if args.command == "rebuild":
+        print(f"LATEST_POSITION rebuilt for {rebuild_latest_position()} vessels")
+    elif args.command == "indexes":
+        print(f"POSITION_REPORT.Timestamp filled for {migrate_schema()} position reports")
+        for table, names in provision_indexes().items():
+            print(f"{table}: {', '.join(names) if names else 'nothing to create'}")
+    else:
+        from query_plans import explain_all, format_report
+        plans = explain_all()
+        print(format_report(plans))
+        return 1 if any(plan.flagged for plan in plans) else 0
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
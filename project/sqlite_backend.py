@@ -0,0 +1,418 @@
+import functools
+import os
+import re
+import shutil
+import sqlite3
+import tempfile
+import threading
+import unittest
+from datetime import datetime, timedelta, timezone
+
+# Pragmas set on every connection, tuned for bulk ingest: WAL lets readers run alongside the
+# writer, and with synchronous=NORMAL a commit does not wait for the disk
+DEFAULT_PRAGMAS = {
+    "journal_mode": "WAL",
+    "synchronous": "NORMAL",
+    "temp_store": "MEMORY",
+    "cache_size": "-65536",
+    "mmap_size": "268435456",
+    "busy_timeout": "5000",
+    "wal_autocheckpoint": "10000",
+}
+
+# The base tables of the MySQL schema; the derived tables and columns are added by schema.py
+BASE_SCHEMA = """
+    CREATE TABLE IF NOT EXISTS VESSEL (
+    IMO INTEGER PRIMARY KEY, Flag TEXT, Name TEXT, Built INTEGER, CallSign TEXT, Length INTEGER,
+    Breadth INTEGER, Tonnage INTEGER, MMSI INTEGER, Type TEXT, Status TEXT, Owner TEXT);
+
+    CREATE TABLE IF NOT EXISTS MAP_VIEW (
+    Id INTEGER PRIMARY KEY, Name TEXT, LongitudeW REAL, LatitudeS REAL, LongitudeE REAL, LatitudeN REAL,
+    Scale INTEGER, RasterFile BLOB, ImageWidth INTEGER, ImageHeight INTEGER, ActualLongitudeW REAL,
+    ActualLatitudeS REAL, ActualLongitudeE REAL, ActualLatitudeN REAL, ContainerMapView_Id INTEGER);
+
+    CREATE TABLE IF NOT EXISTS PORT (
+    Id INTEGER PRIMARY KEY, LoCode TEXT, Name TEXT, Country TEXT, Longitude REAL, Latitude REAL,
+    Website TEXT, MapView1_Id INTEGER, MapView2_Id INTEGER, MapView3_Id INTEGER);
+
+    CREATE TABLE IF NOT EXISTS AIS_MESSAGE (
+    Id INTEGER PRIMARY KEY, Timestamp DATETIME NOT NULL, MMSI INTEGER NOT NULL, Class TEXT,
+    Vessel_IMO INTEGER);
+
+    CREATE TABLE IF NOT EXISTS STATIC_DATA (
+    AISMessage_Id INTEGER PRIMARY KEY, AIS_IMO INTEGER, CallSign TEXT, Name TEXT, VesselType TEXT,
+    CargoType TEXT, Length INTEGER, Breadth INTEGER, Draught REAL, AISDestination TEXT, ETA DATETIME,
+    DestinationPort_Id INTEGER);
+
+    CREATE TABLE IF NOT EXISTS POSITION_REPORT (
+    AISMessage_Id INTEGER PRIMARY KEY, NavigationalStatus TEXT, Longitude REAL, Latitude REAL, RoT REAL,
+    SoG REAL, CoG REAL, Heading INTEGER, LastStaticData_Id INTEGER, MapView1_Id INTEGER,
+    MapView2_Id INTEGER, MapView3_Id INTEGER);
+    """
+
+# MySQL constructs of the DAO's statements and their SQLite equivalents, applied in order
+TRANSLATIONS = [
+    (re.compile(r"%s"), "?"),
+    (re.compile(r"\bINSERT\s+IGNORE\b", re.I), "INSERT OR IGNORE"),
+    (re.compile(r"\bON\s+DUPLICATE\s+KEY\s+UPDATE\b", re.I), "ON CONFLICT DO UPDATE SET"),
+    (re.compile(r"\bVALUES\(([A-Za-z_]\w*)\)", re.I), r"excluded.\1"),
+    (re.compile(r"\bIF\(", re.I), "IIF("),
+    (re.compile(r"^\s*SHOW\s+TABLES\s+LIKE\s+('[^']*')\s*$", re.I | re.S),
+     r"SELECT name FROM sqlite_master WHERE type = 'table' AND name LIKE \1"),
+    (re.compile(r"^\s*SHOW\s+INDEX\s+FROM\s+(\w+)\s*$", re.I | re.S),
+     r"SELECT name AS Key_name FROM pragma_index_list('\1')"),
+    (re.compile(r"^\s*SHOW\s+COLUMNS\s+FROM\s+(\w+)\s*$", re.I | re.S),
+     r"SELECT name AS Field FROM pragma_table_info('\1')"),
+    # Multi-table DELETE deletes from the first table only
+    (re.compile(r"^\s*DELETE\s+(\w+)\s+FROM\s+\1\s+(.*?)\s*$", re.I | re.S),
+     r"DELETE FROM \1 WHERE rowid IN (SELECT \1.rowid FROM \1 \2)"),
+    # DELETE ... LIMIT needs a compile-time option of SQLite
+    (re.compile(r"^\s*DELETE\s+FROM\s+(\w+)\s+(WHERE\s+.*?)\s+LIMIT\s+(\S+)\s*$", re.I | re.S),
+     r"DELETE FROM \1 WHERE rowid IN (SELECT rowid FROM \1 \2 LIMIT \3)"),
+]
+
+
+@functools.lru_cache(maxsize=512)
+def translate(sql):
+    """
+    SQLite text of a statement written for MySQL
+
+    :param sql: a single statement, with ``%s`` placeholders
+    :type sql: str
+    :rtype: str
+    """
+    for pattern, replacement in TRANSLATIONS:
+        sql = pattern.sub(replacement, sql)
+    return sql
+
+
+def split_script(script, params):
+    """
+    Split a script of ``;``-separated statements and its parameters, statement by statement
+
+    :return: (statement, parameters) pairs
+    :rtype: list
+    """
+    params = tuple(params or ())
+    pairs = []
+    for statement in script.split(";"):
+        if statement.strip():
+            count = statement.count("%s")
+            pairs.append((statement, params[:count]))
+            params = params[count:]
+    return pairs
+
+
+# Timestamps are stored as MySQL writes DATETIME values, so that text order is time order
+sqlite3.register_adapter(datetime, lambda value: value.isoformat(" ", "microseconds"))
+sqlite3.register_converter("DATETIME", lambda value: datetime.fromisoformat(value.decode()))
+
+
+class SQLiteCursor:
+    """
+    A sqlite3 cursor with the part of the ``mysql.connector`` cursor interface that
+    :class:`mysqlutils.SQL_runner` uses, running statements written for MySQL
+    """
+
+    def __init__(self, cnx):
+        self._cursor = cnx.cursor()
+        self.statement = None
+
+    @property
+    def description(self):
+        return self._cursor.description
+
+    @property
+    def with_rows(self):
+        return self._cursor.description is not None
+
+    @property
+    def rowcount(self):
+        return self._cursor.rowcount
+
+    @property
+    def lastrowid(self):
+        return self._cursor.lastrowid
+
+    def execute(self, sql, params=(), multi=False, map_results=False):
+        if multi or map_results:
+            return self._execute_script(sql, params)
+        self.statement = sql
+        self._cursor.execute(translate(sql), tuple(params or ()))
+
+    def _execute_script(self, script, params):
+        for statement, statement_params in split_script(script, params):
+            self.execute(statement, statement_params)
+            yield self
+
+    def executemany(self, sql, seq_params):
+        self.statement = sql
+        self._cursor.executemany(translate(sql), seq_params)
+
+    def fetchall(self):
+        return self._cursor.fetchall()
+
+    def fetchmany(self, size=1):
+        return self._cursor.fetchmany(size)
+
+    def fetchone(self):
+        return self._cursor.fetchone()
+
+    def close(self):
+        self._cursor.close()
+
+
+class SQLiteConnection:
+    """
+    A sqlite3 connection with the part of the ``mysql.connector`` connection interface that
+    :class:`mysqlutils.SQL_runner` and its pool use
+    """
+
+    def __init__(self, cnx):
+        self._cnx = cnx
+        self._closed = False
+
+    def cursor(self, **options):
+        # Statements are prepared and cached by sqlite3 itself, and results are read lazily,
+        # so the prepared and unbuffered cursors of mysql.connector need no counterpart
+        return SQLiteCursor(self._cnx)
+
+    @property
+    def in_transaction(self):
+        return self._cnx.in_transaction
+
+    def is_connected(self):
+        return not self._closed
+
+    def commit(self):
+        self._cnx.commit()
+
+    def rollback(self):
+        self._cnx.rollback()
+
+    def close(self):
+        self._closed = True
+        self._cnx.close()
+
+
+_created = set()
+_created_lock = threading.Lock()
+
+
+def connect(config):
+    """
+    Open a connection to the SQLite database of a parsed configuration, creating its tables if needed
+
+    The ``[SQLITE]`` section gives the database file (``path``); any other key sets a pragma,
+    overriding :data:`DEFAULT_PRAGMAS`.
+    """
+    settings = dict(config['SQLITE']) if config.has_section('SQLITE') else {}
+    path = settings.pop('path', 'ais.db')
+    pragmas = dict(DEFAULT_PRAGMAS, **settings)
+    cnx = sqlite3.connect(path, detect_types=sqlite3.PARSE_DECLTYPES, check_same_thread=False,
+                          timeout=int(pragmas['busy_timeout']) / 1000, cached_statements=256)
+    for name, value in pragmas.items():
+        cnx.execute(f"PRAGMA {name} = {value}")
+    key = os.path.abspath(path)
+    with _created_lock:
+        if key not in _created:
+            cnx.executescript(BASE_SCHEMA)
+            _created.add(key)
+    return SQLiteConnection(cnx)
+
+
+class SQLiteBackendTest(unittest.TestCase):
+
+    def setUp(self):
+        from mysqlutils import SQL_runner
+        self.directory = tempfile.mkdtemp()
+        self.config_file = os.path.join(self.directory, "connection_data.conf")
+        with open(self.config_file, "w") as f:
+            f.write(f"[SQL]\nbackend=sqlite\n\n[SQLITE]\npath={os.path.join(self.directory, 'ais.db')}\n")
+        self.default_config_file = SQL_runner.config_file
+        SQL_runner.config_file = self.config_file
+
+    def tearDown(self):
+        from mysqlutils import SQL_runner, get_pool
+        get_pool(self.config_file).close()
+        SQL_runner.config_file = self.default_config_file
+        shutil.rmtree(self.directory)
+
+    def test_translate(self):
+        """
+        Function `translate` rewrites the MySQL-only constructs of the DAO's statements.
+        """
+        self.assertEqual(translate("INSERT IGNORE INTO T (A) VALUES (%s)"), "INSERT OR IGNORE INTO T (A) VALUES (?)")
+        self.assertEqual(translate("INSERT INTO T (A) VALUES (%s) ON DUPLICATE KEY UPDATE A = IF(VALUES(A) > A, VALUES(A), A)"),
+                         "INSERT INTO T (A) VALUES (?) ON CONFLICT DO UPDATE SET A = IIF(excluded.A > A, excluded.A, A)")
+        self.assertEqual(translate("DELETE A FROM A JOIN B ON A.Id = B.Id WHERE B.T < %s"),
+                         "DELETE FROM A WHERE rowid IN (SELECT A.rowid FROM A JOIN B ON A.Id = B.Id WHERE B.T < ?)")
+        self.assertEqual(translate("DELETE FROM A WHERE T < %s LIMIT %s"),
+                         "DELETE FROM A WHERE rowid IN (SELECT rowid FROM A WHERE T < ? LIMIT ?)")
+
+    def test_split_script(self):
+        """
+        Function `split_script` hands each statement its own parameters.
+        """
+        self.assertEqual(split_script("A %s; B %s %s;", (1, 2, 3)), [("A %s", (1,)), (" B %s %s", (2, 3))])
+
+    def test_executemany(self):
+        """
+        Function `executemany` inserts every set of parameters in one call, and counts them.
+        """
+        from mysqlutils import SQL_runner
+        from query_metrics import normalize_statement
+        runner = SQL_runner()
+        sql = "INSERT INTO PORT (Id, Name, Country) VALUES (%s, %s, %s)"
+        self.assertEqual(runner.executemany(sql, [(1, "Esbjerg", "Denmark"), (2, "Skagen", "Denmark"), (3, "Oslo", "Norway")]), [(3,)])
+        self.assertEqual(runner.execute("SELECT count(*) FROM PORT")[0][0], 3)
+        self.assertEqual(runner.metrics.snapshot()["queries"][normalize_statement(sql)]["rows"], 3)
+
+    def test_position_report_timestamp(self):
+        """
+        Position reports written before the derived tables and columns existed are found once migrated.
+        """
+        from mysqlutils import SQL_runner
+        from tmb_dao import TMB_DAO
+        from schema import MigrationRequired, migrate_schema, rebuild_latest_position
+        runner = SQL_runner()
+        for id in (1, 2, 3):
+            runner.execute("INSERT INTO AIS_MESSAGE (Id, Timestamp, MMSI, Class) VALUES (%s, %s, %s, %s)",
+                           (id, datetime(2020, 11, 18, 0, id), 219000000, "Class A"))
+            runner.execute("INSERT INTO POSITION_REPORT (AISMessage_Id, Longitude, Latitude) VALUES (%s, %s, %s)", (id, 12.0, 55.0))
+        # Filling the column is an explicit migration, never run on the way to a read
+        with self.assertRaises(MigrationRequired):
+            TMB_DAO().read_positions_between(219000000, datetime(2020, 11, 17), datetime(2020, 11, 19))
+        self.assertEqual(migrate_schema(runner, chunk_size=2), 3)
+        with self.assertRaises(MigrationRequired):
+            TMB_DAO().read_positions_between(219000000, datetime(2020, 11, 17), datetime(2020, 11, 19))
+        self.assertEqual(rebuild_latest_position(runner), 1)
+        positions = TMB_DAO().read_positions_between(219000000, datetime(2020, 11, 17), datetime(2020, 11, 19))
+        self.assertEqual([position[4] for position in positions], [datetime(2020, 11, 18, 0, id) for id in (3, 2, 1)])
+
+    def test_static_data_write_failure(self):
+        """
+        Static data whose write fails is written again on the vessel's next message.
+        """
+        import json
+        from mysqlutils import SQL_runner
+        from id_allocator import IdAllocator
+        from tmb_dao import TMB_DAO
+        from static_data_cache import StaticDataCache
+        batch = json.dumps([{"Timestamp": "2020-11-18T00:00:00.000Z", "Class": "Class A", "MMSI": 219000000,
+                             "MsgType": "static_data", "IMO": 9000001, "Name": "SAGA", "VesselType": "Passenger",
+                             "Length": 35, "Breadth": 11}])
+        runner = SQL_runner()
+        id_allocator = IdAllocator(runner, block_size=4)
+        for method in ("insert_message_batch", "insert_message"):
+            insert = getattr(TMB_DAO(id_allocator=id_allocator, static_data_cache=StaticDataCache()), method)
+            runner.execute("DELETE FROM STATIC_DATA")
+            runner.execute("ALTER TABLE STATIC_DATA RENAME TO STATIC_DATA_OFF")
+            self.assertEqual(insert(batch), 0)
+            runner.execute("ALTER TABLE STATIC_DATA_OFF RENAME TO STATIC_DATA")
+            self.assertGreater(insert(batch), 0)
+            self.assertEqual(runner.execute("SELECT count(*) FROM STATIC_DATA")[0][0], 1)
+
+    def test_static_data_purged(self):
+        """
+        Static data purged by retention is written again on the vessel's next report, even if unchanged.
+        """
+        import json
+        from mysqlutils import SQL_runner
+        from id_allocator import IdAllocator
+        from tmb_dao import TMB_DAO
+        from static_data_cache import StaticDataCache
+
+        def batch(timestamp):
+            return json.dumps([{"Timestamp": timestamp.strftime("%Y-%m-%dT%H:%M:%S.000Z"), "Class": "Class A",
+                                "MMSI": 219000000, "MsgType": "static_data", "IMO": 9000001, "Name": "SAGA",
+                                "VesselType": "Passenger", "Length": 35, "Breadth": 11}])
+
+        runner = SQL_runner()
+        now = datetime.now(timezone.utc).replace(tzinfo=None)
+        tmb = TMB_DAO(id_allocator=IdAllocator(runner, block_size=4), static_data_cache=StaticDataCache())
+        self.assertEqual(tmb.insert_message_batch(batch(now - timedelta(minutes=30))), 2)
+        self.assertEqual(tmb.delete_all_msg_timestamp("[{}]"), 2)
+        self.assertEqual(tmb.insert_message_batch(batch(now)), 2)
+        self.assertEqual(runner.execute("SELECT count(*) FROM STATIC_DATA")[0][0], 1)
+
+    def test_tiles_assigned(self):
+        """
+        A default DAO fills the tile columns at ingest, so the tile reads find the vessels it wrote.
+        """
+        import json
+        from mysqlutils import SQL_runner
+        from id_allocator import IdAllocator
+        from tmb_dao import TMB_DAO
+        runner = SQL_runner()
+        for tile in [(1, 1, 0, 50, 20, 70, None), (2, 2, 10, 50, 15, 62, 1)]:
+            runner.execute("INSERT INTO MAP_VIEW (Id, Scale, LongitudeW, LatitudeS, LongitudeE, LatitudeN, ContainerMapView_Id) "
+                           "VALUES (%s, %s, %s, %s, %s, %s, %s)", tile)
+        batch = json.dumps([{"Timestamp": "2020-11-18T00:00:00.000Z", "Class": "Class A", "MMSI": 219000000,
+                             "MsgType": "position_report", "Position": {"type": "Point", "coordinates": [55.0, 12.0]},
+                             "Status": "Under way using engine"}])
+        tmb = TMB_DAO(id_allocator=IdAllocator(runner, block_size=4))
+        self.assertEqual(tmb.insert_message(batch), 1)
+        self.assertEqual(list(tmb.iter_most_recent_ship_pos_in_tile(2)), [(219000000, 55.0, 12.0, None)])
+        self.assertEqual(list(tmb.iter_most_recent_ship_pos_in_tile(1)), [(219000000, 55.0, 12.0, None)])
+
+    def test_dao(self):
+        """
+        The DAO writes and reads messages through SQL_runner on a SQLite database.
+        """
+        import json
+        from mysqlutils import SQL_runner
+        from id_allocator import IdAllocator
+        from tmb_dao import TMB_DAO
+        from static_data_cache import StaticDataCache
+        from ais_records import decode_messages
+        batch = json.dumps([
+            {"Timestamp": f"2020-11-18T00:0{i}:00.000Z", "Class": "Class A", "MMSI": 219000000 + i % 2,
+             "MsgType": "position_report", "Position": {"type": "Point", "coordinates": [55.0 + i, 12.0]},
+             "Status": "Under way using engine", "SoG": 10.0, "CoG": 90.0, "Heading": 90} for i in range(6)]
+            + [{"Timestamp": "2020-11-18T00:00:00.000Z", "Class": "Class A", "MMSI": 219000000,
+                "MsgType": "static_data", "IMO": 9000001, "Name": "SAGA", "VesselType": "Passenger",
+                "Length": 35, "Breadth": 11}])
+        static_data_cache = StaticDataCache()
+        tmb = TMB_DAO(id_allocator=IdAllocator(SQL_runner(), block_size=4), static_data_cache=static_data_cache)
+        counts = tmb.insert_message_batch_bulk(batch)
+        self.assertEqual(counts, {"AIS_MESSAGE": 7, "STATIC_DATA": 1, "POSITION_REPORT": 6})
+        self.assertEqual(tmb.insert_message_batch(batch), 13)
+        self.assertEqual(static_data_cache.suppressed, 1)
+        warmed = StaticDataCache()
+        self.assertEqual(warmed.warm(), 1)
+        self.assertFalse(warmed.changed(decode_messages(json.loads(batch))[-1]))
+
+        self.assertEqual(tmb.read_last_n_pos(219000000, 2), [(219000000, 59.0, 12.0, None), (219000000, 59.0, 12.0, None)])
+        self.assertEqual(sorted(tmb.read_most_recent_ship_pos("[{}]")), [(219000000, 59.0, 12.0, None), (219000001, 60.0, 12.0, None)])
+        self.assertEqual(tmb.read_pos_MMSI_many([219000001, 1]), {219000001: (219000001, 60.0, 12.0, None), 1: None})
+        self.assertEqual(tmb.read_last_n_pos_many([219000000, 219000001, 1], 2),
+                         {219000000: [(219000000, 59.0, 12.0, None)] * 2, 219000001: [(219000001, 60.0, 12.0, None)] * 2, 1: []})
+        self.assertEqual(len(SQL_runner().execute_in("SELECT Id FROM AIS_MESSAGE WHERE Id IN ({keys})", range(1, 100), chunk_size=8)),
+                         SQL_runner().execute("SELECT count(*) FROM AIS_MESSAGE")[0][0])
+        positions = tmb.read_positions_between(219000001, datetime(2020, 11, 18, 0, 1), datetime(2020, 11, 18, 0, 4))
+        self.assertEqual([position[4] for position in positions][:2], [datetime(2020, 11, 18, 0, 3)] * 2)
+        self.assertEqual(tmb.delete_all_msg_timestamp("[{}]"), 2 * (7 + 6) + 1 + 2)
+        # Each message is written with its AIS_MESSAGE row, and read back at once
+        self.assertEqual(tmb.insert_message(batch), 7)
+        self.assertEqual(tmb.read_last_n_pos(219000000, 1), [(219000000, 59.0, 12.0, None)])
+        self.assertEqual(sorted(tmb.read_most_recent_ship_pos("[{}]")), [(219000000, 59.0, 12.0, None), (219000001, 60.0, 12.0, None)])
+        self.assertEqual(tmb.insert_message_batch(batch), 13)
+
+        write_behind = tmb.start_write_behind(flush_size=4, flush_interval_ms=60000)
+        self.assertEqual(tmb.insert_message(batch), 7)
+        tmb.flush()
+        self.assertEqual(SQL_runner().execute("SELECT count(*) FROM AIS_MESSAGE")[0][0], 21)
+        self.assertEqual(write_behind.stats()["written"], 7)
+        self.assertEqual(write_behind.stats()["flush_latency"]["count"], 2)
+        tmb.close()
+        self.assertIsNone(tmb.write_behind)
+
+        metrics = SQL_runner().metrics.snapshot()
+        self.assertEqual(metrics["queries"]["SELECT Id FROM AIS_MESSAGE WHERE Timestamp < ? AND Id > ? ORDER BY Id LIMIT ?"]["rows"], 14)
+        self.assertEqual(metrics["errors"], 0)
+        self.assertTrue(metrics["connection_acquire"]["count"] > 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
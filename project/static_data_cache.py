@@ -0,0 +1,199 @@
+import threading
+import unittest
+from collections import OrderedDict
+from mysqlutils import SQL_runner, read_config
+from bulk_ingest import static_data_row
+from schema import ensure_schema
+from ais_records import decode_message
+
+DEFAULT_MAX_ENTRIES = 100000
+
+# Static data of the most recently reporting vessels, the latest message of each, newest first
+READ_LATEST_STATIC_DATA = """
+    SELECT MMSI, AIS_IMO, Name, VesselType, Length, Breadth FROM (
+    SELECT MMSI, AIS_IMO, Name, VesselType, Length, Breadth, AIS_MESSAGE.Timestamp,
+    ROW_NUMBER() OVER (PARTITION BY MMSI ORDER BY AIS_MESSAGE.Timestamp DESC) AS Recency
+    FROM STATIC_DATA, AIS_MESSAGE WHERE STATIC_DATA.AISMessage_Id = AIS_MESSAGE.Id) LATEST
+    WHERE Recency = 1 ORDER BY Timestamp DESC LIMIT %s
+    """
+
+
+def static_data_fingerprint(record):
+    """
+    Fingerprint of the STATIC_DATA columns a static data record is written with
+
+    :param: record: a static data record
+    :type: record: StaticData
+    :rtype: int
+    """
+    return hash(static_data_row(None, record)[1:])
+
+
+class StaticDataCache:
+    """
+    Bounded LRU map from MMSI to the fingerprint of the static data last written for that vessel
+
+    Vessels repeat their static data every few minutes, mostly unchanged; the writers ask `changed`
+    before writing a STATIC_DATA row, and skip it when the vessel's static data is the same as the
+    last written. The least recently reporting vessels are forgotten beyond `max_entries`, and
+    written again on their next report.
+    """
+
+    def __init__(self, max_entries=DEFAULT_MAX_ENTRIES):
+        """
+        :param: max_entries: number of vessels remembered, 0 to write every static data message
+        :type: max_entries: int
+        """
+        self.max_entries = max_entries
+        self.changes = 0
+        self.suppressed = 0
+        self.evictions = 0
+        self._fingerprints = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._fingerprints)
+
+    def stats(self):
+        """
+        Cache counters
+
+        :rtype: dict
+        """
+        with self._lock:
+            return {"changes": self.changes, "suppressed": self.suppressed, "evictions": self.evictions,
+                    "vessels": len(self._fingerprints)}
+
+    def _put(self, mmsi, fingerprint):
+        self._fingerprints[mmsi] = fingerprint
+        self._fingerprints.move_to_end(mmsi)
+        while len(self._fingerprints) > self.max_entries:
+            self._fingerprints.popitem(last=False)
+            self.evictions += 1
+
+    def changed(self, record):
+        """
+        Whether a static data record differs from the last one written for its vessel; if so it is
+        remembered as written, otherwise counted as suppressed
+
+        :param: record: a static data record
+        :type: record: StaticData
+        :rtype: bool
+        """
+        fingerprint = static_data_fingerprint(record)
+        with self._lock:
+            if self._fingerprints.get(record.mmsi) == fingerprint:
+                self._fingerprints.move_to_end(record.mmsi)
+                self.suppressed += 1
+                return False
+            self._put(record.mmsi, fingerprint)
+            self.changes += 1
+            return True
+
+    def remember(self, records):
+        """
+        Record static data written without asking `changed`
+        """
+        with self._lock:
+            for record in records:
+                self._put(record.mmsi, static_data_fingerprint(record))
+
+    def forget(self, mmsis):
+        """
+        Forget vessels whose static data may not have been written after all, e.g. on a rollback
+        """
+        with self._lock:
+            for mmsi in mmsis:
+                self._fingerprints.pop(mmsi, None)
+
+    def warm(self, runner=None, chunk_size=1000):
+        """
+        Load the latest static data of the `max_entries` most recently reporting vessels, so that a
+        restart does not write every vessel's static data again
+
+        :param: runner: runner to read with
+        :type: runner: SQL_runner
+        :return: number of vessels loaded
+        :rtype: int
+        """
+        if self.max_entries <= 0:
+            return 0
+        runner = runner if runner is not None else SQL_runner()
+        ensure_schema(runner)
+        rows = list(runner.stream(READ_LATEST_STATIC_DATA, (self.max_entries,), chunk_size=chunk_size))
+        with self._lock:
+            # Oldest first, so that the most recently reporting vessels are the last evicted
+            for mmsi, imo, name, vessel_type, length, breadth in reversed(rows):
+                self._put(mmsi, hash((imo, name, vessel_type, length, breadth)))
+        return len(rows)
+
+
+_default_cache = None
+_default_lock = threading.Lock()
+
+def default_static_data_cache(cfg=SQL_runner.config_file):
+    """
+    Return the static data cache shared by the whole process, creating and warming it on first use
+
+    Settings are read from the optional `[STATIC_DATA_CACHE]` section of the configuration file
+    (`max_entries`, and `warm` to load the latest static data from the database).
+    """
+    global _default_cache
+    with _default_lock:
+        if _default_cache is None:
+            config = read_config(cfg)
+            settings = config['STATIC_DATA_CACHE'] if config.has_section('STATIC_DATA_CACHE') else {}
+            cache = StaticDataCache(max_entries=int(settings.get('max_entries', DEFAULT_MAX_ENTRIES)))
+            if settings.get('warm', 'true').lower() in ('1', 'true', 'yes'):
+                cache.warm()
+            _default_cache = cache
+        return _default_cache
+
+
+class StaticDataCacheTest(unittest.TestCase):
+
+    @staticmethod
+    def record(mmsi, name="SAGA", imo="Unknown"):
+        return decode_message({"Timestamp": "2020-11-18T00:00:00.000Z", "Class": "Class A", "MMSI": mmsi,
+                               "MsgType": "static_data", "IMO": imo, "Name": name, "VesselType": "Passenger",
+                               "Length": 35, "Breadth": 11, "Destination": "DK HOR"})
+
+    def test_changed(self):
+        """
+        Function `changed` lets through new and changed static data, and counts the repeats.
+        """
+        cache = StaticDataCache()
+        self.assertTrue(cache.changed(self.record(1)))
+        self.assertFalse(cache.changed(self.record(1)))
+        self.assertTrue(cache.changed(self.record(1, name="SAGA II")))
+        self.assertTrue(cache.changed(self.record(2)))
+        self.assertEqual(cache.stats(), {"changes": 3, "suppressed": 1, "evictions": 0, "vessels": 2})
+        cache.forget([1])
+        self.assertTrue(cache.changed(self.record(1, name="SAGA II")))
+
+    def test_fingerprint(self):
+        """
+        Function `static_data_fingerprint` only depends on the written columns, with the IMO defaulted.
+        """
+        self.assertEqual(static_data_fingerprint(self.record(1)), static_data_fingerprint(self.record(2, imo=None)))
+        self.assertEqual(static_data_fingerprint(self.record(1)), hash((1, "SAGA", "Passenger", 35, 11)))
+        self.assertNotEqual(static_data_fingerprint(self.record(1)), static_data_fingerprint(self.record(1, imo=9000001)))
+
+    def test_lru(self):
+        """
+        The cache forgets the least recently reporting vessel beyond its size, and nothing with size 0.
+        """
+        cache = StaticDataCache(max_entries=2)
+        cache.remember([self.record(1), self.record(2)])
+        self.assertFalse(cache.changed(self.record(1)))
+        self.assertTrue(cache.changed(self.record(3)))
+        self.assertTrue(cache.changed(self.record(2)))
+        self.assertEqual((len(cache), cache.evictions), (2, 2))
+        disabled = StaticDataCache(max_entries=0)
+        self.assertTrue(disabled.changed(self.record(1)))
+        self.assertTrue(disabled.changed(self.record(1)))
+        self.assertEqual(disabled.warm(runner=object()), 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,213 @@
+import argparse
+import codecs
+import io
+import json
+import os
+import sys
+import tempfile
+import unittest
+
+# Size of the reads made on files
+READ_SIZE = 64 * 1024
+
+# Largest single JSON document accepted; a document that does not decode within this many
+# bytes is reported as malformed instead of growing the buffer without bound.
+MAX_DOCUMENT_SIZE = 1024 * 1024
+
+DEFAULT_CHUNK_SIZE = 1000
+
+_WHITESPACE = " \t\r\n"
+
+
+def _read_blocks(source, read_size=READ_SIZE):
+    """
+    Yield the text of a source in blocks: a path, a file object or an iterable of strings
+
+    Bytes are decoded incrementally, so a character split between two blocks is kept whole.
+    """
+    decoder = codecs.getincrementaldecoder("utf-8")()
+    if isinstance(source, (str, os.PathLike)):
+        with open(source, "r", encoding="utf-8") as f:
+            yield from _read_blocks(f, read_size)
+    elif hasattr(source, "read"):
+        while True:
+            block = source.read(read_size)
+            if not block:
+                break
+            yield decoder.decode(block) if isinstance(block, bytes) else block
+    else:
+        for line in source:
+            yield decoder.decode(line) if isinstance(line, bytes) else line
+    # Raises on a character truncated at the end of the input
+    yield decoder.decode(b"", final=True)
+
+
+def iter_messages(source, read_size=READ_SIZE, max_document_size=MAX_DOCUMENT_SIZE):
+    """
+    Decode AIS messages one at a time from NDJSON or JSON array input
+
+    Only the document being decoded is buffered, so memory use does not depend on the size of
+    the input. Top-level arrays are unwrapped; documents may be separated by whitespace, newlines
+    or commas.
+
+    :param: source: a file path, a file object or an iterable of lines
+    :type: source: str or file or iterable
+    :return: decoded documents
+    :rtype: generator
+    :raises ValueError: if the input is not valid JSON
+    """
+    decoder = json.JSONDecoder()
+    buffer = ""
+    pos = 0
+    depth = 0
+    blocks = _read_blocks(source, read_size)
+    eof = False
+
+    while True:
+        while pos < len(buffer) and (buffer[pos] in _WHITESPACE or buffer[pos] == ","):
+            pos += 1
+        if pos < len(buffer) and buffer[pos] == "[" and depth == 0:
+            depth = 1
+            pos += 1
+            continue
+        if pos < len(buffer) and buffer[pos] == "]" and depth == 1:
+            depth = 0
+            pos += 1
+            continue
+
+        if pos < len(buffer):
+            try:
+                document, end = decoder.raw_decode(buffer, pos)
+            except json.JSONDecodeError:
+                if eof or len(buffer) - pos > max_document_size:
+                    raise ValueError(f"Malformed JSON document near: {buffer[pos:pos + 80]!r}")
+            else:
+                # A document ending exactly at the end of the buffer may be a truncated number
+                # or literal, so wait for more input unless there is none.
+                if end < len(buffer) or eof:
+                    yield document
+                    pos = end
+                    continue
+
+        if eof:
+            if depth != 0:
+                raise ValueError("Unterminated JSON array")
+            return
+
+        block = next(blocks, None)
+        if block is None:
+            eof = True
+        else:
+            buffer = buffer[pos:] + block
+            pos = 0
+
+
+def chunked(messages, chunk_size=DEFAULT_CHUNK_SIZE):
+    """
+    Group an iterable into lists of at most `chunk_size` items
+
+    :param: messages: any iterable
+    :type: messages: iterable
+    :param: chunk_size: maximum length of a chunk
+    :type: chunk_size: int
+    :return: lists of items
+    :rtype: generator
+    """
+    if chunk_size < 1:
+        raise ValueError("Chunk size must be at least 1")
+    chunk = []
+    for message in messages:
+        chunk.append(message)
+        if len(chunk) == chunk_size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def main(argv=None):
+    """
+    Load an NDJSON or JSON array file of AIS messages into the database
+    """
+    from tmb_dao import TMB_DAO
+    from bulk_ingest import MAX_PACKET_SIZE
+
+    parser = argparse.ArgumentParser(description="Load AIS messages from an NDJSON or JSON array file.")
+    parser.add_argument("file", help="file to load, or - for standard input")
+    parser.add_argument("--chunk-size", type=int, default=DEFAULT_CHUNK_SIZE,
+        help=f"messages written per transaction (default: {DEFAULT_CHUNK_SIZE})")
+    parser.add_argument("--max-packet-size", type=int, default=MAX_PACKET_SIZE,
+        help=f"maximum size of one INSERT statement, in bytes (default: {MAX_PACKET_SIZE})")
+    parser.add_argument("--metrics-port", type=int,
+        help="serve the query metrics in the Prometheus text format on this port while loading")
+    args = parser.parse_args(argv)
+
+    if args.metrics_port is not None:
+        from mysqlutils import SQL_runner
+        from query_metrics import serve_metrics
+        serve_metrics(SQL_runner().metrics, args.metrics_port)
+
+    source = sys.stdin if args.file == "-" else args.file
+    counts = TMB_DAO().insert_message_stream(source, chunk_size=args.chunk_size, max_packet_size=args.max_packet_size)
+    return 1 if counts == -1 else 0
+
+
+class StreamIngestTest(unittest.TestCase):
+    documents = [{"MMSI": 304858000, "Position": {"coordinates": [55.218332, 13.371672]}},
+                 {"MMSI": 219005465, "RoT": 0},
+                 {"MMSI": 257961000, "Name": "A [B], {C}"}]
+
+    def test_iter_messages_ndjson(self):
+        """
+        Function `iter_messages` decodes NDJSON given as an iterable of lines.
+        """
+        lines = [json.dumps(doc) + "\n" for doc in self.documents]
+        self.assertEqual(list(iter_messages(lines)), self.documents)
+
+    def test_iter_messages_array(self):
+        """
+        Function `iter_messages` decodes a JSON array, whatever the size of the reads.
+        """
+        text = json.dumps(self.documents, indent=2)
+        for read_size in (1, 7, 64, len(text)):
+            self.assertEqual(list(iter_messages(io.StringIO(text), read_size=read_size)), self.documents)
+
+    def test_iter_messages_bytes(self):
+        """
+        Function `iter_messages` decodes UTF-8 bytes whose characters straddle the reads.
+        """
+        documents = self.documents + [{"MMSI": 257961001, "Name": "BJØRNØYA"}]
+        data = json.dumps(documents, ensure_ascii=False).encode("utf-8")
+        for read_size in (1, 2, 7):
+            self.assertEqual(list(iter_messages(io.BytesIO(data), read_size=read_size)), documents)
+        lines = [data[:data.index("Ø".encode("utf-8")) + 1], data[data.index("Ø".encode("utf-8")) + 1:]]
+        self.assertEqual(list(iter_messages(lines)), documents)
+
+    def test_iter_messages_path(self):
+        """
+        Function `iter_messages` reads a file given by its path.
+        """
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, "batch.json")
+            with open(path, "w") as f:
+                f.write("\n".join(json.dumps(doc) for doc in self.documents))
+            self.assertEqual(list(iter_messages(path, read_size=5)), self.documents)
+
+    def test_iter_messages_malformed(self):
+        """
+        Function `iter_messages` raises ValueError on malformed or truncated input.
+        """
+        with self.assertRaises(ValueError):
+            list(iter_messages(['[{"MMSI": 1}, {"MMSI": ']))
+        with self.assertRaises(ValueError):
+            list(iter_messages(['[{"MMSI": 1}']))
+
+    def test_chunked(self):
+        """
+        Function `chunked` groups items without losing any.
+        """
+        self.assertEqual(list(chunked(range(5), 2)), [[0, 1], [2, 3], [4]])
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,266 @@
+import mmap
+import os
+import shutil
+import tempfile
+import threading
+import unittest
+from collections import OrderedDict
+from mysqlutils import SQL_runner, read_config
+
+READ_TILE_FROM_ID = """
+    SELECT RasterFile FROM MAP_VIEW WHERE Id = %s
+    """
+
+DEFAULT_MAX_BYTES = 64 * 1024 * 1024
+
+
+class TileCache:
+    """
+    Byte-budgeted LRU cache of the PNG tiles of MAP_VIEW, in front of an optional cache directory
+
+    Tiles found in the directory are read through memory maps. In zero-copy mode, `get` returns
+    a memoryview over the cached tile (over the mapped file for tiles read from the directory)
+    instead of a bytes object.
+    """
+
+    def __init__(self, max_bytes=DEFAULT_MAX_BYTES, directory=None, zero_copy=False):
+        """
+        :param: max_bytes: memory budget for the tiles kept in memory
+        :type: max_bytes: int
+        :param: directory: directory where fetched tiles are written and looked up, or None
+        :type: directory: str
+        :param: zero_copy: return memoryviews instead of bytes
+        :type: zero_copy: bool
+        """
+        self.max_bytes = max_bytes
+        self.directory = directory
+        self.zero_copy = zero_copy
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._tiles = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+        if directory is not None:
+            os.makedirs(directory, exist_ok=True)
+
+    def __len__(self):
+        return len(self._tiles)
+
+    @property
+    def nbytes(self):
+        """
+        Size of the tiles held in memory, in bytes
+        """
+        return self._bytes
+
+    def stats(self):
+        """
+        Cache counters
+
+        :rtype: dict
+        """
+        with self._lock:
+            return {"hits": self.hits, "disk_hits": self.disk_hits, "misses": self.misses,
+                    "evictions": self.evictions, "tiles": len(self._tiles), "bytes": self._bytes}
+
+    def _path(self, tile_id):
+        return os.path.join(self.directory, f"{tile_id}.png")
+
+    def _result(self, tile):
+        return memoryview(tile) if self.zero_copy else tile
+
+    def _put(self, tile_id, tile):
+        """
+        Keep a tile in memory, evicting the least recently used tiles beyond the budget
+        """
+        size = len(tile)
+        if size > self.max_bytes:
+            return
+        with self._lock:
+            previous = self._tiles.pop(tile_id, None)
+            if previous is not None:
+                self._bytes -= len(previous)
+            self._tiles[tile_id] = tile
+            self._bytes += size
+            while self._bytes > self.max_bytes:
+                _, evicted = self._tiles.popitem(last=False)
+                self._bytes -= len(evicted)
+                self.evictions += 1
+
+    def _read_file(self, tile_id):
+        """
+        The tile in the cache directory, or None
+        """
+        try:
+            with open(self._path(tile_id), "rb") as file:
+                if os.fstat(file.fileno()).st_size == 0:
+                    return b""
+                mapped = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+        except FileNotFoundError:
+            return None
+        if self.zero_copy:
+            # The map stays open for as long as the cache or a caller's memoryview refers to it
+            return mapped
+        with mapped:
+            return mapped[:]
+
+    def _write_file(self, tile_id, tile):
+        """
+        Write a tile to the cache directory, atomically so readers never see a partial file
+        """
+        fd, temporary = tempfile.mkstemp(dir=self.directory, suffix=".tmp")
+        try:
+            with os.fdopen(fd, "wb") as file:
+                file.write(tile)
+            os.replace(temporary, self._path(tile_id))
+        except OSError:
+            if os.path.exists(temporary):
+                os.remove(temporary)
+
+    def get(self, tile_id, runner=None):
+        """
+        The PNG file of a tile
+
+        :param: tile_id: id of the tile
+        :type: tile_id: int
+        :param: runner: runner used on a miss
+        :type: runner: SQL_runner
+        :return: the tile, or None if there is no tile with that id
+        :rtype: bytes or memoryview
+        """
+        with self._lock:
+            tile = self._tiles.get(tile_id)
+            if tile is not None:
+                self._tiles.move_to_end(tile_id)
+                self.hits += 1
+                return self._result(tile)
+
+        if self.directory is not None:
+            tile = self._read_file(tile_id)
+            if tile is not None:
+                with self._lock:
+                    self.disk_hits += 1
+                self._put(tile_id, tile)
+                return self._result(tile)
+
+        with self._lock:
+            self.misses += 1
+        runner = runner if runner is not None else SQL_runner()
+        rs = runner.execute(READ_TILE_FROM_ID, (tile_id,))
+        if not rs or rs[0][0] is None:
+            return None
+        tile = bytes(rs[0][0])
+        if self.directory is not None:
+            self._write_file(tile_id, tile)
+        self._put(tile_id, tile)
+        return self._result(tile)
+
+    def invalidate(self, tile_id=None):
+        """
+        Forget one tile, or all of them, in memory and in the cache directory
+        """
+        with self._lock:
+            tile_ids = [tile_id] if tile_id is not None else list(self._tiles)
+            for key in tile_ids:
+                tile = self._tiles.pop(key, None)
+                if tile is not None:
+                    self._bytes -= len(tile)
+        if self.directory is None:
+            return
+        if tile_id is None:
+            tile_ids = [name[:-len(".png")] for name in os.listdir(self.directory) if name.endswith(".png")]
+        for key in tile_ids:
+            try:
+                os.remove(self._path(key))
+            except FileNotFoundError:
+                pass
+
+
+_default_cache = None
+_default_lock = threading.Lock()
+
+def default_tile_cache(cfg=SQL_runner.config_file):
+    """
+    Return the tile cache shared by the whole process, creating it on first use
+
+    Settings are read from the optional `[TILE_CACHE]` section of the configuration file
+    (`max_bytes`, `directory`, `zero_copy`).
+    """
+    global _default_cache
+    with _default_lock:
+        if _default_cache is None:
+            config = read_config(cfg)
+            settings = config['TILE_CACHE'] if config.has_section('TILE_CACHE') else {}
+            _default_cache = TileCache(max_bytes=int(settings.get('max_bytes', DEFAULT_MAX_BYTES)),
+                                       directory=settings.get('directory') or None,
+                                       zero_copy=settings.get('zero_copy', 'false').lower() in ('1', 'true', 'yes'))
+        return _default_cache
+
+
+class TileCacheTest(unittest.TestCase):
+
+    class FakeRunner:
+        def __init__(self, tiles):
+            self.tiles = tiles
+            self.queries = 0
+
+        def execute(self, sql, params=()):
+            self.queries += 1
+            tile = self.tiles.get(params[0])
+            return [(bytearray(tile),)] if tile is not None else []
+
+    tiles = {1: b"\x89PNG" + bytes(96), 2: b"\x89PNG" + bytes(196), 3: b"\x89PNG" + bytes(96)}
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_get(self):
+        """
+        Function `get` reads a tile once, then serves it from memory.
+        """
+        runner = self.FakeRunner(self.tiles)
+        cache = TileCache()
+        self.assertEqual(cache.get(1, runner), self.tiles[1])
+        self.assertEqual(cache.get(1, runner), self.tiles[1])
+        self.assertIsNone(cache.get(42, runner))
+        self.assertEqual(runner.queries, 2)
+        self.assertEqual((cache.hits, cache.misses), (1, 2))
+        self.assertTrue(type(cache.get(1, runner)) is bytes)
+
+    def test_eviction(self):
+        """
+        Function `get` keeps the tiles in memory within the byte budget, least recently used out first.
+        """
+        runner = self.FakeRunner(self.tiles)
+        cache = TileCache(max_bytes=300)
+        cache.get(1, runner)
+        cache.get(2, runner)
+        cache.get(1, runner)
+        cache.get(3, runner)
+        self.assertEqual(cache.evictions, 1)
+        self.assertEqual(cache.nbytes, 200)
+        cache.get(1, runner)
+        self.assertEqual(runner.queries, 3)
+
+    def test_directory(self):
+        """
+        Function `get` serves tiles written to the cache directory without querying, as memoryviews in zero-copy mode.
+        """
+        TileCache(directory=self.directory).get(1, self.FakeRunner(self.tiles))
+        runner = self.FakeRunner(self.tiles)
+        cache = TileCache(directory=self.directory, zero_copy=True)
+        tile = cache.get(1, runner)
+        self.assertTrue(type(tile) is memoryview)
+        self.assertEqual(bytes(tile), self.tiles[1])
+        self.assertEqual((runner.queries, cache.disk_hits), (0, 1))
+        cache.invalidate()
+        self.assertEqual(os.listdir(self.directory), [])
+
+
+if __name__ == '__main__':
+    unittest.main()
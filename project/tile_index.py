@@ -0,0 +1,216 @@
+import math
+import threading
+import unittest
+from mysqlutils import SQL_runner
+
+READ_MAP_VIEWS = """
+    SELECT Id, Scale, LongitudeW, LatitudeS, LongitudeE, LatitudeN, ContainerMapView_Id FROM MAP_VIEW
+    """
+
+# The DAO's tile columns (MapView1_Id, MapView2_Id, MapView3_Id) hold the tile of each scale
+SCALES = (1, 2, 3)
+
+
+class Tile:
+    """
+    Bounding box of one MAP_VIEW tile
+    """
+    __slots__ = ('id', 'scale', 'west', 'south', 'east', 'north', 'container_id')
+
+    def __init__(self, id, scale, west, south, east, north, container_id=None):
+        self.id = id
+        self.scale = scale
+        self.west = float(west)
+        self.south = float(south)
+        self.east = float(east)
+        self.north = float(north)
+        self.container_id = container_id
+
+    def contains(self, longitude, latitude):
+        return self.west <= longitude <= self.east and self.south <= latitude <= self.north
+
+    def document(self):
+        """
+        The tile as a map tile description document, in the column order of `READ_MAP_VIEWS`
+        """
+        return (self.id, self.scale, self.west, self.south, self.east, self.north, self.container_id)
+
+
+class _Grid:
+    """
+    Uniform grid over the tiles of one scale: each cell lists the tiles overlapping it
+    """
+
+    def __init__(self, tiles):
+        widths = sorted(tile.east - tile.west for tile in tiles)
+        heights = sorted(tile.north - tile.south for tile in tiles)
+        # The median tile spans about one cell, so a lookup checks one or two tiles
+        self.cell_width = widths[len(widths) // 2] or 1.0
+        self.cell_height = heights[len(heights) // 2] or 1.0
+        self.cells = {}
+        for tile in sorted(tiles, key=lambda tile: tile.id):
+            for x in range(self._x(tile.west), self._x(tile.east) + 1):
+                for y in range(self._y(tile.south), self._y(tile.north) + 1):
+                    self.cells.setdefault((x, y), []).append(tile)
+
+    def _x(self, longitude):
+        return math.floor(longitude / self.cell_width)
+
+    def _y(self, latitude):
+        return math.floor(latitude / self.cell_height)
+
+    def find(self, longitude, latitude):
+        for tile in self.cells.get((self._x(longitude), self._y(latitude)), ()):
+            if tile.contains(longitude, latitude):
+                return tile
+        return None
+
+
+class TileIndex:
+    """
+    MAP_VIEW tiles, loaded once, with a grid per scale for point lookups and the
+    parent to children hierarchy of the tile pyramid
+    """
+
+    def __init__(self, tiles=()):
+        """
+        :param: tiles: the tiles to index
+        :type: tiles: list of Tile
+        """
+        self._lock = threading.Lock()
+        self._build(tiles)
+
+    def _build(self, tiles):
+        tiles = list(tiles)
+        grids = {}
+        for scale in SCALES:
+            scale_tiles = [tile for tile in tiles if tile.scale == scale]
+            if scale_tiles:
+                grids[scale] = _Grid(scale_tiles)
+        children = {}
+        for tile in sorted(tiles, key=lambda tile: tile.id):
+            if tile.container_id is not None:
+                children.setdefault(tile.container_id, []).append(tile)
+        with self._lock:
+            self.tiles = {tile.id: tile for tile in tiles}
+            self._grids = grids
+            self._children = {parent: tuple(tiles) for parent, tiles in children.items()}
+
+    @classmethod
+    def load(cls, runner=None):
+        """
+        Build an index of all tiles of the MAP_VIEW table
+
+        :param: runner: runner to read with
+        :type: runner: SQL_runner
+        :rtype: TileIndex
+        """
+        index = cls()
+        index.refresh(runner)
+        return index
+
+    def refresh(self, runner=None):
+        """
+        Reload the tiles from the MAP_VIEW table
+
+        :param: runner: runner to read with
+        :type: runner: SQL_runner
+        :return: number of tiles
+        :rtype: int
+        """
+        runner = runner if runner is not None else SQL_runner()
+        rs = runner.execute(READ_MAP_VIEWS)
+        self._build(Tile(*row) for row in rs)
+        return len(self.tiles)
+
+    def tile(self, tile_id):
+        """
+        The tile with the given id, or None
+        """
+        return self.tiles.get(tile_id)
+
+    def children(self, tile_id):
+        """
+        Tiles of the next scale contained in a tile
+
+        :param: tile_id: id of the parent tile
+        :type: tile_id: int
+        :return: the child tiles (four for a tile of scale 1 or 2), ordered by id
+        :rtype: tuple of Tile
+        """
+        return self._children.get(tile_id, ())
+
+    def children_many(self, tile_ids):
+        """
+        Child tiles of several tiles at once
+
+        :param: tile_ids: ids of the parent tiles
+        :type: tile_ids: list
+        :return: the child tiles of each parent, by parent id
+        :rtype: dict
+        """
+        children = self._children
+        return {tile_id: children.get(tile_id, ()) for tile_id in tile_ids}
+
+    def tile_ids(self, longitude, latitude):
+        """
+        Ids of the tiles of scale 1, 2 and 3 containing a point
+
+        :return: one id (or None, outside all tiles of that scale) per scale
+        :rtype: tuple
+        """
+        grids = self._grids
+        ids = []
+        for scale in SCALES:
+            grid = grids.get(scale)
+            tile = grid.find(longitude, latitude) if grid is not None else None
+            ids.append(tile.id if tile is not None else None)
+        return tuple(ids)
+
+
+class TileIndexTest(unittest.TestCase):
+    # A 4x4 degree tile of scale 1, split in four 2x2 degree tiles of scale 2, the south-west one split again
+    tiles = [Tile(1, 1, 10, 54, 14, 58),
+             Tile(2, 2, 10, 54, 12, 56, 1), Tile(3, 2, 12, 54, 14, 56, 1),
+             Tile(4, 2, 10, 56, 12, 58, 1), Tile(5, 2, 12, 56, 14, 58, 1),
+             Tile(6, 3, 10, 54, 11, 55, 2), Tile(7, 3, 11, 54, 12, 55, 2),
+             Tile(8, 3, 10, 55, 11, 56, 2), Tile(9, 3, 11, 55, 12, 56, 2)]
+
+    def test_tile_ids(self):
+        """
+        Function `tile_ids` finds the tile of each scale containing a point.
+        """
+        index = TileIndex(self.tiles)
+        self.assertEqual(index.tile_ids(11.5, 55.5), (1, 2, 9))
+        self.assertEqual(index.tile_ids(13.37, 55.21), (1, 3, None))
+
+    def test_children(self):
+        """
+        Function `children` returns the four tiles of the next scale, and nothing for a leaf tile.
+        """
+        index = TileIndex(self.tiles)
+        self.assertEqual([tile.id for tile in index.children(1)], [2, 3, 4, 5])
+        self.assertEqual([tile.id for tile in index.children(2)], [6, 7, 8, 9])
+        self.assertEqual(index.children(9), ())
+
+    def test_children_many(self):
+        """
+        Function `children_many` looks up several parent tiles at once.
+        """
+        index = TileIndex(self.tiles)
+        children = index.children_many([1, 3, 42])
+        self.assertEqual(sorted(children), [1, 3, 42])
+        self.assertEqual(len(children[1]), 4)
+        self.assertEqual(children[42], ())
+
+    def test_tile_ids_outside(self):
+        """
+        Function `tile_ids` returns None for points outside every tile.
+        """
+        index = TileIndex(self.tiles)
+        self.assertEqual(index.tile_ids(-70.0, 40.0), (None, None, None))
+        self.assertEqual(TileIndex().tile_ids(11.5, 55.5), (None, None, None))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,13 +1,309 @@
 import unittest
 import json
 from datetime import datetime, timedelta
-import sys, re
+import sys, re, time
 from mysqlutils import SQL_runner
+from bulk_ingest import BulkWriter, group_by_type, MAX_PACKET_SIZE
+from bulk_ingest import INSERT_AIS_MESSAGE, INSERT_STATIC_DATA, INSERT_POSITION_REPORT
+from bulk_ingest import ais_message_row, static_data_row, position_report_row
+from bulk_ingest import UPSERT_LATEST_POSITION, latest_position_row, tile_ids_of
+from schema import ensure_schema
+from ais_records import decode_message, decode_messages
+from trajectory import READ_LAST_N_POS, READ_LAST_N_POS_MANY
+from id_allocator import default_allocator
+from stream_ingest import iter_messages, chunked, DEFAULT_CHUNK_SIZE
+from tile_index import Tile, TileIndex
+from tile_cache import default_tile_cache
+from static_data_cache import default_static_data_cache
+from write_behind import WriteBehindBuffer, QueueFull, write_behind_settings
+from parallel_ingest import ParallelWriter
+from retention import RetentionEngine
+
+# Statement texts are kept constant so that each is prepared once per connection
+
+# `insert_message` and `insert_message_batch` send each message and its child rows together, in one round trip
+INSERT_AIS_MESSAGE_WITH_STATIC_DATA = INSERT_AIS_MESSAGE + ";" + INSERT_STATIC_DATA
+INSERT_AIS_MESSAGE_WITH_POSITION_REPORT = INSERT_AIS_MESSAGE + ";" + INSERT_POSITION_REPORT + ";" + UPSERT_LATEST_POSITION
+
+READ_MOST_RECENT_SHIP_POS = """
+    SELECT MMSI, Latitude, Longitude, Vessel_IMO FROM LATEST_POSITION
+    """
+
+READ_POS_MMSI = """
+    SELECT MMSI, Latitude, Longitude, Vessel_IMO 
+    FROM POSITION_REPORT, AIS_MESSAGE WHERE MMSI = %s AND POSITION_REPORT.AISMessage_Id = AIS_MESSAGE.Id 
+    ORDER BY AIS_MESSAGE.Timestamp DESC LIMIT 1
+    """
+
+# The `_many` reads fill `{keys}` with an IN list of many MMSIs or ids (see `SQL_runner.execute_in`)
+READ_POS_MMSI_MANY = """
+    SELECT MMSI, Latitude, Longitude, Vessel_IMO FROM LATEST_POSITION WHERE MMSI IN ({keys})
+    """
+
+# Bounded on the Timestamp of both tables, so that MySQL only reads the partitions of the period
+READ_POSITIONS_BETWEEN = """
+    SELECT MMSI, Latitude, Longitude, Vessel_IMO, AIS_MESSAGE.Timestamp
+    FROM AIS_MESSAGE JOIN POSITION_REPORT ON POSITION_REPORT.AISMessage_Id = AIS_MESSAGE.Id
+    WHERE MMSI = %s AND AIS_MESSAGE.Timestamp >= %s AND AIS_MESSAGE.Timestamp < %s
+    AND POSITION_REPORT.Timestamp >= %s AND POSITION_REPORT.Timestamp < %s
+    ORDER BY AIS_MESSAGE.Timestamp DESC
+    """
+
+READ_VESSEL_INFO = """
+    SELECT MMSI, Latitude, Longitude, AIS_MESSAGE.Vessel_IMO, CallSign 
+    FROM POSITION_REPORT, AIS_MESSAGE, STATIC_DATA 
+    WHERE AIS_MESSAGE.Id = POSITION_REPORT.AISMessage_Id 
+    AND AIS_MESSAGE.Id = STATIC_DATA.AISMessage_Id 
+    AND POSITION_REPORT.LastStaticData_Id = STATIC_DATA.DestinationPort_Id AND MMSI = %s
+    """
+
+READ_VESSEL_INFO_MANY = """
+    SELECT MMSI, Latitude, Longitude, AIS_MESSAGE.Vessel_IMO, CallSign
+    FROM POSITION_REPORT, AIS_MESSAGE, STATIC_DATA
+    WHERE AIS_MESSAGE.Id = POSITION_REPORT.AISMessage_Id
+    AND AIS_MESSAGE.Id = STATIC_DATA.AISMessage_Id
+    AND POSITION_REPORT.LastStaticData_Id = STATIC_DATA.DestinationPort_Id AND MMSI IN ({keys})
+    """
+
+# One statement per tile scale, each served by the index on its MapView column
+READ_MOST_RECENT_SHIP_POS_IN_TILE = {
+    scale: f"""
+    SELECT MMSI, Latitude, Longitude, Vessel_IMO FROM LATEST_POSITION
+    WHERE MapView{scale}_Id = %s
+    """
+    for scale in (1, 2, 3)
+}
+
+READ_TILE_SCALE = """
+    SELECT Scale FROM MAP_VIEW WHERE Id = %s
+    """
+
+READ_ALL_PORTS = """
+    SELECT * FROM PORT WHERE Name = %s and Country = %s
+    """
+
+READ_ALL_SHIP_POS_SCALE3 = """
+    Select Longitude, Latitude, Scale FROM PORT, MAP_VIEW
+    WHERE Scale = 3 AND Port.Name = %s AND Port.Country = %s
+    """
+
+READ_POSITION_TO_PORT_ID = """
+    SELECT MMSI, Latitude, Longitude, Vessel_IMO FROM POSITION_REPORT, AIS_MESSAGE 
+    WHERE AIS_MESSAGE.Id = %s AND POSITION_REPORT.AISMessage_Id = AIS_MESSAGE.Id
+    """
+
+READ_POSITION_TO_PORT_ID_MANY = """
+    SELECT AIS_MESSAGE.Id, MMSI, Latitude, Longitude, Vessel_IMO FROM POSITION_REPORT, AIS_MESSAGE
+    WHERE AIS_MESSAGE.Id IN ({keys}) AND POSITION_REPORT.AISMessage_Id = AIS_MESSAGE.Id
+    """
+
+READ_POSITION_GIVEN_PORT = """
+    SELECT MMSI, LATEST_POSITION.Latitude, LATEST_POSITION.Longitude, LATEST_POSITION.Vessel_IMO FROM LATEST_POSITION, PORT
+    WHERE PORT.Id = %s AND LATEST_POSITION.MapView1_Id = PORT.MapView1_Id
+    AND LATEST_POSITION.MapView2_Id = PORT.MapView2_Id AND LATEST_POSITION.MapView3_Id = PORT.MapView3_Id
+    """
+
+READ_POSITION_GIVEN_PORT_MANY = """
+    SELECT PORT.Id, MMSI, LATEST_POSITION.Latitude, LATEST_POSITION.Longitude, LATEST_POSITION.Vessel_IMO
+    FROM LATEST_POSITION, PORT
+    WHERE PORT.Id IN ({keys}) AND LATEST_POSITION.MapView1_Id = PORT.MapView1_Id
+    AND LATEST_POSITION.MapView2_Id = PORT.MapView2_Id AND LATEST_POSITION.MapView3_Id = PORT.MapView3_Id
+    """
+
+def committed(results, script):
+    """
+    Results of a `SQL_runner.run_multi` script, or none if one of its statements failed: the runner
+    reports the error, keeps the results of the statements before it and does not commit
+
+    :rtype: list of StatementResult
+    """
+    return results if len(results) == script.count(";") + 1 else []
+
 
 class TMB_DAO:
 
-    def __init__(self, stub=False):
-        self.is_stub = stub    
+    def __init__(self, stub=False, id_allocator=None, position_store=None, trajectories=None, tile_index=None,
+                 tile_cache=None, static_data_cache=None, assign_tiles=True):
+        """
+        :param: stub: only check inputs, without touching the database
+        :type: stub: bool
+        :param: id_allocator: allocator for AIS_MESSAGE ids
+        :type: id_allocator: IdAllocator
+        :param: position_store: latest position of each vessel, kept up to date by the insert methods
+            and used by the position reads (warm it with `LatestPositionStore.warm` at startup)
+        :type: position_store: LatestPositionStore
+        :param: trajectories: last positions of each vessel, kept up to date by the insert methods
+            and used by `read_last_5_pos` and `read_last_n_pos`
+        :type: trajectories: TrajectoryStore
+        :param: tile_index: MAP_VIEW tiles, used to fill the tile columns of position reports,
+            to find the scale of a tile and its child tiles (loaded from MAP_VIEW on first use if not given)
+        :type: tile_index: TileIndex
+        :param: tile_cache: cache of the PNG tiles read by `find_tile_from_id`
+        :type: tile_cache: TileCache
+        :param: static_data_cache: static data already written, so that the insert methods skip unchanged
+            static data (the process-wide one, warmed on first use, unless given)
+        :type: static_data_cache: StaticDataCache
+        :param: assign_tiles: fill the tile columns of the position reports the insert methods write,
+            which the tile reads filter on
+        :type: assign_tiles: bool
+        """
+        self.is_stub = stub
+        self._id_allocator = id_allocator
+        self.position_store = position_store
+        self.trajectories = trajectories
+        self.tile_index = tile_index
+        self._loaded_tile_index = None
+        self._tile_cache = tile_cache
+        self._static_data_cache = static_data_cache
+        self.assign_tiles = assign_tiles
+        self.write_behind = None
+
+    def _record_positions(self, messages):
+        """
+        Feed written position reports to the in-memory position stores
+        """
+        if self.position_store is not None:
+            self.position_store.update_from_messages(messages)
+        if self.trajectories is not None:
+            self.trajectories.update_from_messages(messages)
+
+    @property
+    def id_allocator(self):
+        """
+        Allocator for AIS_MESSAGE ids, the process-wide one unless given to the constructor
+        """
+        if self._id_allocator is None:
+            self._id_allocator = default_allocator()
+        return self._id_allocator
+
+    @property
+    def tile_cache(self):
+        """
+        Cache of the PNG tiles, the process-wide one unless given to the constructor
+        """
+        if self._tile_cache is None:
+            self._tile_cache = default_tile_cache()
+        return self._tile_cache
+
+    @property
+    def active_tile_index(self):
+        """
+        Tile index of the reads and the insert methods: the one given to the constructor, or else
+        one loaded from MAP_VIEW on first use, whichever comes first
+        """
+        if self.tile_index is not None:
+            return self.tile_index
+        if self._loaded_tile_index is None:
+            self._loaded_tile_index = TileIndex.load()
+        return self._loaded_tile_index
+
+    @property
+    def ingest_tile_index(self):
+        """
+        Tile index the insert methods fill the tile columns from, None if `assign_tiles` is off
+        """
+        return self.active_tile_index if self.assign_tiles else None
+
+    @property
+    def static_data_cache(self):
+        """
+        Static data already written, the process-wide cache unless given to the constructor
+        """
+        if self._static_data_cache is None:
+            self._static_data_cache = default_static_data_cache()
+        return self._static_data_cache
+
+    def start_write_behind(self, **settings):
+        """
+        Switch `insert_message` to write-behind: messages are queued, and a background flusher writes
+        them in bulk transactions (with their AIS_MESSAGE rows) until `close`
+
+        :param: settings: arguments of `WriteBehindBuffer`, those of the `[WRITE_BEHIND]` section if none
+        :return: the buffer, for its `stats`
+        :rtype: WriteBehindBuffer
+        """
+        if self.write_behind is None:
+            writer = BulkWriter(id_allocator=self.id_allocator, tile_index=self.ingest_tile_index,
+                                static_data_cache=self.static_data_cache)
+
+            def write(records):
+                counts = writer.write(records)
+                self._record_positions(records)
+                return counts
+
+            self.write_behind = WriteBehindBuffer(write, **(settings or write_behind_settings()))
+        return self.write_behind
+
+    def flush(self):
+        """
+        Wait until the messages queued by `insert_message` are written, in write-behind mode
+
+        :raises: the error of a write that failed since the last flush
+        """
+        if self.write_behind is not None:
+            self.write_behind.flush()
+
+    def close(self):
+        """
+        Write the queued messages and stop the write-behind flusher
+        """
+        if self.write_behind is not None:
+            write_behind, self.write_behind = self.write_behind, None
+            write_behind.close()
+
+    def _insert_records(self, runner, array):
+        """
+        Write each message with its child rows, one round trip per message, keeping the static data
+        cache and the in-memory position stores up to date
+
+        :param: runner: runner to write with
+        :type: runner: SQL_runner
+        :param: array: AIS message records
+        :type: array: list of AISMessage
+        :return: number of insertions per table, and number of static data messages skipped as unchanged
+        :rtype: tuple
+        """
+        pos_insertions = 0
+        static_insertions = 0
+        static_suppressed = 0
+        ais_msg_insertions = 0
+
+        tile_index = self.ingest_tile_index
+        for record in array:
+
+            id = self.id_allocator.next_id()
+
+            if record.msg_type == "static_data" and not self.static_data_cache.changed(record):
+                rs = runner.execute(INSERT_AIS_MESSAGE, ais_message_row(id, record))
+                ais_msg_insertions += rs[0][0] if rs else 0
+                static_suppressed += 1
+
+            elif record.msg_type == "static_data":
+                results = committed(runner.run_multi(INSERT_AIS_MESSAGE_WITH_STATIC_DATA,
+                    ais_message_row(id, record) + static_data_row(id, record)), INSERT_AIS_MESSAGE_WITH_STATIC_DATA)
+                if not results:
+                    # Not written after all: the vessel's next static data must not be skipped
+                    self.static_data_cache.forget([record.mmsi])
+                ais_msg_insertions += sum(result.rowcount for result in results[:1])
+                static_insertions += sum(result.rowcount for result in results[1:])
+
+            elif record.msg_type == "position_report":
+                tile_ids = tile_ids_of(tile_index, record)
+                results = committed(runner.run_multi(INSERT_AIS_MESSAGE_WITH_POSITION_REPORT,
+                    ais_message_row(id, record) + position_report_row(id, record, tile_ids) + latest_position_row(id, record, tile_ids)),
+                    INSERT_AIS_MESSAGE_WITH_POSITION_REPORT)
+                ais_msg_insertions += sum(result.rowcount for result in results[:1])
+                inserted = sum(result.rowcount for result in results[1:2])
+                pos_insertions += inserted
+                if inserted:
+                    self._record_positions([record])
+
+            else:
+                rs = runner.execute(INSERT_AIS_MESSAGE, ais_message_row(id, record))
+                ais_msg_insertions += rs[0][0] if rs else 0
+
+        return {"AIS_MESSAGE": ais_msg_insertions, "STATIC_DATA": static_insertions,
+                "POSITION_REPORT": pos_insertions}, static_suppressed
 
     def insert_message_batch(self, batch):
         """
@@ -22,154 +318,218 @@ class TMB_DAO:
             return -1
 
         try:
-            array = json.loads(batch)
+            array = decode_messages(json.loads(batch))
         except Exception:
             return -1
 
         if self.is_stub:
             return len(array)
 
-        pos_insertions = 0
-        static_insertions = 0
-        ais_msg_insertions = 0    
-
-        for ais_msg in array:
-
-            date_time_obj = datetime.strptime(ais_msg["Timestamp"], '%Y-%m-%dT%H:%M:%S.%fZ')
-
-            QUERY1=f"""
-            SELECT Id FROM AIS_MESSAGE  
-            ORDER BY Id DESC  
-            LIMIT 1;
-            """
-            rs = SQL_runner().run(QUERY1)
-            id = rs[0][0]
-            id += 1
-
-            QUERY2=f"""
-            INSERT INTO AIS_MESSAGE 
-            (Id, Timestamp, MMSI, Class) 
-            VALUES (
-            {id},
-            '{date_time_obj}', 
-            '{ais_msg["MMSI"]}', 
-            '{ais_msg["Class"]}');
-            SELECT ROW_COUNT();
-            """
-            rs = SQL_runner().run(QUERY2)
-            ais_msg_insertions += rs[0][0]
-
-            if ais_msg["MsgType"] == "static_data":
-
-                QUERY3=f"""
-                INSERT INTO STATIC_DATA 
-                (AIS_IMO, Name, VesselType, Length, Breadth) 
-                VALUES (
-                '{ais_msg["IMO"] if type(ais_msg["IMO"]) is int else 1}', 
-                '{ais_msg["Name"]}', 
-                '{ais_msg["VesselType"]}', 
-                {ais_msg["Length"]}, 
-                {ais_msg["Breadth"]}); 
-                SELECT ROW_COUNT();
-                """
-                rs = SQL_runner().run(QUERY3)
-                static_insertions += rs[0][0]
-
-            if ais_msg["MsgType"] == "position_report":
-                
-                if "RoT" not in ais_msg:
-                    ais_msg["RoT"] = 0 
-
-                QUERY4=f"""
-                INSERT INTO POSITION_REPORT 
-                (AISMessage_Id, NavigationalStatus, Longitude, Latitude, RoT, SoG, CoG, Heading) 
-                VALUES (
-                5,
-                '{ais_msg["Status"]}', 
-                {ais_msg["Position"]["coordinates"][1]}, 
-                {ais_msg["Position"]["coordinates"][0]}, 
-                {ais_msg["RoT"]}, 
-                {ais_msg["SoG"]}, 
-                {ais_msg["CoG"]}, 
-                {ais_msg["Heading"]}); 
-                SELECT ROW_COUNT();
-                """
-                rs = SQL_runner().run(QUERY4)
-                pos_insertions += rs[0][0]
+        runner = SQL_runner()
+        ensure_schema(runner)
+        counts, static_suppressed = self._insert_records(runner, array)
+        ais_msg_insertions, static_insertions, pos_insertions = counts["AIS_MESSAGE"], counts["STATIC_DATA"], counts["POSITION_REPORT"]
 
         print(f"\nAIS Message Insertions: {ais_msg_insertions}")
         print(f"Static Data Insertions: {static_insertions}")
+        print(f"Static Data Suppressed: {static_suppressed}")
         print(f"Position Report Insertions: {pos_insertions}")        
         print(f"Total Insertion Count: {pos_insertions + static_insertions + ais_msg_insertions}")
-        return pos_insertions + static_insertions + ais_msg_insertions    
+        return pos_insertions + static_insertions + ais_msg_insertions
+
+    def insert_message_batch_bulk(self, batch, max_packet_size=MAX_PACKET_SIZE):
+        """
+        Insert a batch of messages with multi-row inserts, in a single transaction
+
+        :param: batch: a string that represent a JSON array of docs
+        :type: batch: str
+        :param: max_packet_size: maximum size of one INSERT statement, in bytes
+        :type: max_packet_size: int
+        :return: Number of successful insertions per table, or -1 on failure
+        :rtype: dict
+        """
+        if batch == "" or batch == None:
+            return -1
 
-            
+        try:
+            array = decode_messages(json.loads(batch))
+        except Exception:
+            return -1
+
+        if self.is_stub:
+            static_data, position_reports = group_by_type(array)
+            return {"AIS_MESSAGE": len(array), "STATIC_DATA": len(static_data), "POSITION_REPORT": len(position_reports)}
+
+        start = time.perf_counter()
+        try:
+            counts = BulkWriter(max_packet_size=max_packet_size, id_allocator=self.id_allocator, tile_index=self.ingest_tile_index,
+                                static_data_cache=self.static_data_cache).write(array)
+        except Exception as e:
+            print(e)
+            return -1
+        self._record_positions(array)
+        elapsed = time.perf_counter() - start
+        static_data, _ = group_by_type(array)
+
+        print(f"\nAIS Message Insertions: {counts['AIS_MESSAGE']}")
+        print(f"Static Data Insertions: {counts['STATIC_DATA']}")
+        print(f"Static Data Suppressed: {len(static_data) - counts['STATIC_DATA']}")
+        print(f"Position Report Insertions: {counts['POSITION_REPORT']}")
+        print(f"Total Insertion Count: {sum(counts.values())}")
+        print(f"Throughput: {len(array) / elapsed if elapsed > 0 else 0:.1f} messages/sec")
+        return counts
+
+    def insert_message_batch_parallel(self, batch, workers=None, writer=None, chunk_size=DEFAULT_CHUNK_SIZE, max_packet_size=MAX_PACKET_SIZE):
+        """
+        Insert a batch of messages from a pool of worker processes, partitioned by MMSI
+
+        Each worker decodes and writes its vessels' messages in order, a bulk transaction per chunk;
+        this process only parses and partitions them.
+
+        :param: batch: a string that represent a JSON array of docs
+        :type: batch: str
+        :param: workers: number of worker processes, from the `[INGEST]` configuration if not given
+        :type: workers: int
+        :param: writer: a running writer to reuse across batches, instead of starting workers for this one
+        :type: writer: ParallelWriter
+        :param: chunk_size: number of messages written per transaction
+        :type: chunk_size: int
+        :param: max_packet_size: maximum size of one INSERT statement, in bytes
+        :type: max_packet_size: int
+        :return: Number of successful insertions per table, or -1 on failure
+        :rtype: dict
+        """
+        if batch == "" or batch == None:
+            return -1
+
+        try:
+            array = json.loads(batch)
+            if self.is_stub:
+                static_data, position_reports = group_by_type(decode_messages(array))
+                return {"AIS_MESSAGE": len(array), "STATIC_DATA": len(static_data), "POSITION_REPORT": len(position_reports)}
+        except Exception:
+            return -1
+
+        start = time.perf_counter()
+        try:
+            if writer is not None:
+                counts = writer.write(array)
+            else:
+                with ParallelWriter(workers, chunk_size=chunk_size, max_packet_size=max_packet_size,
+                                    load_tiles=self.assign_tiles) as writer:
+                    counts = writer.write(array)
+        except Exception as e:
+            print(e)
+            return -1
+        # Only the messages the in-memory stores need are decoded here too
+        if self.position_store is not None or self.trajectories is not None:
+            self._record_positions(decode_messages(doc for doc in array if doc.get("MsgType") == "position_report"))
+        # The workers write every static data message; later writes compare with what they wrote
+        self.static_data_cache.remember(decode_messages(doc for doc in array if doc.get("MsgType") == "static_data"))
+        elapsed = time.perf_counter() - start
+
+        print(f"\nAIS Message Insertions: {counts['AIS_MESSAGE']}")
+        print(f"Static Data Insertions: {counts['STATIC_DATA']}")
+        print(f"Position Report Insertions: {counts['POSITION_REPORT']}")
+        print(f"Total Insertion Count: {sum(counts.values())}")
+        print(f"Throughput: {len(array) / elapsed if elapsed > 0 else 0:.1f} messages/sec")
+        return counts
+
+    def insert_message_stream(self, source, chunk_size=DEFAULT_CHUNK_SIZE, max_packet_size=MAX_PACKET_SIZE):
+        """
+        Insert messages read incrementally from NDJSON or a JSON array, one bulk transaction per chunk
+
+        :param: source: a file path, a file object or an iterable of lines
+        :type: source: str or file or iterable
+        :param: chunk_size: number of messages written per transaction
+        :type: chunk_size: int
+        :param: max_packet_size: maximum size of one INSERT statement, in bytes
+        :type: max_packet_size: int
+        :return: Number of successful insertions per table, or -1 on failure
+        :rtype: dict
+        """
+        if source == "" or source == None:
+            return -1
+
+        counts = {"AIS_MESSAGE": 0, "STATIC_DATA": 0, "POSITION_REPORT": 0}
+        writer = None if self.is_stub else BulkWriter(max_packet_size=max_packet_size, id_allocator=self.id_allocator,
+                                                      tile_index=self.ingest_tile_index, static_data_cache=self.static_data_cache)
+        message_count = 0
+        static_count = 0
+        start = time.perf_counter()
+
+        try:
+            for chunk in chunked(map(decode_message, iter_messages(source)), chunk_size):
+                static_data, position_reports = group_by_type(chunk)
+                if self.is_stub:
+                    chunk_counts = {"AIS_MESSAGE": len(chunk), "STATIC_DATA": len(static_data), "POSITION_REPORT": len(position_reports)}
+                else:
+                    chunk_counts = writer.write(chunk)
+                    self._record_positions(chunk)
+                for table, count in chunk_counts.items():
+                    counts[table] += count
+                message_count += len(chunk)
+                static_count += len(static_data)
+        except Exception as e:
+            print(e)
+            print(f"Stopped after {message_count} messages")
+            return -1
+        elapsed = time.perf_counter() - start
+
+        if self.is_stub:
+            return counts
+
+        print(f"\nAIS Message Insertions: {counts['AIS_MESSAGE']}")
+        print(f"Static Data Insertions: {counts['STATIC_DATA']}")
+        print(f"Static Data Suppressed: {static_count - counts['STATIC_DATA']}")
+        print(f"Position Report Insertions: {counts['POSITION_REPORT']}")
+        print(f"Total Insertion Count: {sum(counts.values())}")
+        print(f"Throughput: {message_count / elapsed if elapsed > 0 else 0:.1f} messages/sec")
+        return counts
 
     def insert_message(self, batch):
         """
         Insert an AIS message
+
+        Each message is written like `insert_message_batch` does, with its AIS_MESSAGE row. After
+        `start_write_behind`, the messages are only queued (see `flush`), and -1 is returned if the
+        queue rejects them.
+
         :param: batch: a string that represent a JSON array of docs
         :type: batch: str
-        :return: completion code number
+        :return: number of messages written (or queued), or -1 on failure
         :rtype: int
         """
         if batch == "" or batch == None:
             return -1
 
         try:
-            array = json.loads(batch)
+            array = decode_messages(json.loads(batch))
         except Exception:
             return -1
 
         if self.is_stub:
             return len(array)
 
-        insertions = 0
-
-        for ais_msg in array:
-            if ais_msg["MsgType"] == "static_data":
-                QUERY = f"""
-                        INSERT INTO STATIC_DATA 
-                        (AIS_IMO, Name, VesselType, Length, Breadth) 
-                        VALUES (
-                        '{ais_msg["IMO"] if type(ais_msg["IMO"]) is int else 1}', 
-                        '{ais_msg["Name"]}', 
-                        '{ais_msg["VesselType"]}', 
-                        {ais_msg["Length"]}, 
-                        {ais_msg["Breadth"]}); 
-                        SELECT ROW_COUNT();
-                        """
-                rs = SQL_runner().run(QUERY)
-                insertions += rs[0][0]
-
-            if ais_msg["MsgType"] == "position_report":
-
-                if "RoT" not in ais_msg:
-                    ais_msg["RoT"] = 0
-
-                QUERY = f"""
-                        INSERT INTO POSITION_REPORT 
-                        (AISMessage_Id, NavigationalStatus, Longitude, Latitude, RoT, SoG, CoG, Heading) 
-                        VALUES (
-                        5,
-                        '{ais_msg["Status"]}', 
-                        {ais_msg["Position"]["coordinates"][1]}, 
-                        {ais_msg["Position"]["coordinates"][0]}, 
-                        {ais_msg["RoT"]}, 
-                        {ais_msg["SoG"]}, 
-                        {ais_msg["CoG"]}, 
-                        {ais_msg["Heading"]}); 
-                        SELECT ROW_COUNT();
-                        """
-                rs = SQL_runner().run(QUERY)
-                insertions += rs[0][0]
-
-        return insertions        
+        if self.write_behind is not None:
+            try:
+                return self.write_behind.put(array)
+            except QueueFull as e:
+                print(e)
+                return -1
+
+        runner = SQL_runner()
+        ensure_schema(runner)
+        counts, _ = self._insert_records(runner, array)
+        return counts["AIS_MESSAGE"]
 
     def delete_all_msg_timestamp(self, batch):
         """
         Delete all AIS Messages older than 5 minutes
 
+        The whole history is purged by timestamp range, in chunks (see `RetentionEngine`);
+        the batch is only checked.
+
         :param: batch: a string that represent a JSON array of docs
         :type: batch: str
         :return: Number of successful deletions
@@ -184,26 +544,12 @@ class TMB_DAO:
             return -1
 
         if self.is_stub:
-           len(array)
-
-        deletions = 0
-        for ais_msg in array:
-            now = datetime.now()
-            timestamp = ais_msg["Timestamp"]
-            date_time_obj = datetime.strptime(timestamp, '%Y-%m-%dT%H:%M:%S.%fZ')
-
-            if now - date_time_obj > timedelta(minutes=5):
-                QUERY = f"""
-                delete AIS_MESSAGE, POSITION_REPORT, STATIC_DATA 
-                from AIS_MESSAGE 
-                LEFT join POSITION_REPORT on AIS_MESSAGE.Id = POSITION_REPORT.AISMessage_Id 
-                LEFT join STATIC_DATA on AIS_MESSAGE.Id = STATIC_DATA.AISMessage_Id 
-                WHERE Timestamp = '{date_time_obj}' AND POSITION_REPORT.LastStaticData_Id = STATIC_DATA.DestinationPort_Id ;
-                SELECT ROW_COUNT();
-                """
-                rs = SQL_runner().run(QUERY)
-                deletions += rs[0][0]
-        return deletions   
+           return len(array)
+
+        report = RetentionEngine(max_age=timedelta(minutes=5), position_store=self.position_store,
+                                 static_data_cache=self.static_data_cache).purge()
+        print(f"Purged {report['rows']} rows ({report['rows_per_sec']:.1f} rows/sec)")
+        return report["rows"]   
 
     def read_most_recent_ship_pos(self, batch):
         """
@@ -225,14 +571,28 @@ class TMB_DAO:
         if self.is_stub:
             return array
 
-        QUERY="""
-            SELECT MMSI, Latitude, Longitude, AIS_MESSAGE.Vessel_IMO FROM POSITION_REPORT, AIS_MESSAGE, 
-            (SELECT max(Timestamp) as time, Vessel_IMO from AIS_MESSAGE GROUP BY Vessel_IMO) 
-            RECENT_SHIP WHERE POSITION_REPORT.AISMessage_Id = AIS_MESSAGE.Id AND AIS_MESSAGE.Vessel_IMO = RECENT_SHIP.Vessel_IMO;
-            """
-        rs = SQL_runner().run(QUERY)
+        if self.position_store is not None and self.position_store.warmed:
+            return self.position_store.all()
+
+        ensure_schema()
+        rs = SQL_runner().execute(READ_MOST_RECENT_SHIP_POS)
         return rs
 
+    def iter_most_recent_ship_pos(self, chunk_size=1000):
+        """
+        Read all most recent ship positions, lazily
+
+        :param: chunk_size: number of rows fetched per round trip
+        :type: chunk_size: int
+        :return: ship documents, as they arrive from the server
+        :rtype: generator
+        """
+        if self.is_stub:
+            return
+
+        ensure_schema()
+        yield from SQL_runner().stream(READ_MOST_RECENT_SHIP_POS, chunk_size=chunk_size)
+
     def read_pos_MMSI(self, batch):
         """
         Read most recent position of given MMSI
@@ -261,12 +621,35 @@ class TMB_DAO:
             print("Value must be an integer.")
             return - 1
 
-        QUERY = f"""SELECT MMSI, Latitude, Longitude, Vessel_IMO 
-        FROM POSITION_REPORT, AIS_MESSAGE WHERE MMSI = {mmsi} AND POSITION_REPORT.AISMessage_Id = AIS_MESSAGE.Id 
-        ORDER BY Timestamp LIMIT 1;"""
-        rs = SQL_runner().run(QUERY)
+        if self.position_store is not None:
+            position = self.position_store.get(int(mmsi))
+            return position if position is not None else -1
+
+        rs = SQL_runner().execute(READ_POS_MMSI, (int(mmsi),))
         return rs[0]   
 
+    def read_pos_MMSI_many(self, mmsis):
+        """
+        Read most recent position of each of several MMSIs
+
+        :param: mmsis: MMSIs of the vessels
+        :type: mmsis: list
+        :return: a position document per MMSI, None for an MMSI without any position
+        :rtype: dict
+        """
+        mmsis = [int(mmsi) for mmsi in mmsis]
+        if self.is_stub:
+            return {mmsi: None for mmsi in mmsis}
+
+        if self.position_store is not None:
+            return self.position_store.get_many(mmsis)
+
+        ensure_schema()
+        positions = {mmsi: None for mmsi in mmsis}
+        for row in SQL_runner().execute_in(READ_POS_MMSI_MANY, mmsis):
+            positions[row[0]] = row
+        return positions
+
     def read_vessel_info(self, batch):
         """
         Read permanent or transient vessel information matching the given MMSI,
@@ -290,14 +673,28 @@ class TMB_DAO:
 
         mmsi = input("Please enter an MMSI to read permanent or transient vessel information matching the given MMSI: ")
 
-        QUERY = f"""SELECT MMSI, Latitude, Longitude, AIS_MESSAGE.Vessel_IMO, CallSign 
-        FROM POSITION_REPORT, AIS_MESSAGE, STATIC_DATA 
-        WHERE AIS_MESSAGE.Id = POSITION_REPORT.AISMessage_Id 
-        AND AIS_MESSAGE.Id = STATIC_DATA.AISMessage_Id 
-        AND POSITION_REPORT.LastStaticData_Id = STATIC_DATA.DestinationPort_Id AND MMSI = {mmsi};"""
-        rs = SQL_runner().run(QUERY)
+        rs = SQL_runner().execute(READ_VESSEL_INFO, (mmsi,))
         return rs[0]     
 
+    def read_vessel_info_many(self, mmsis):
+        """
+        Read permanent or transient vessel information matching each of several MMSIs
+
+        :param: mmsis: MMSIs of the vessels
+        :type: mmsis: list
+        :return: a vessel document per MMSI, None for an MMSI without any
+        :rtype: dict
+        """
+        mmsis = [int(mmsi) for mmsi in mmsis]
+        if self.is_stub:
+            return {mmsi: None for mmsi in mmsis}
+
+        vessels = {mmsi: None for mmsi in mmsis}
+        for row in SQL_runner().execute_in(READ_VESSEL_INFO_MANY, mmsis):
+            if vessels[row[0]] is None:
+                vessels[row[0]] = row
+        return vessels
+
     def read_most_recent_ship_pos_in_tile(self, batch):
         """
         Read all most recent ship positions in the given tile
@@ -326,14 +723,46 @@ class TMB_DAO:
             print("Value must be an integer.")
             return - 1  
 
-        QUERY=f"""
-        SELECT MMSI, Latitude, Longitude, AIS_MESSAGE.Vessel_IMO FROM POSITION_REPORT, AIS_MESSAGE, MAP_VIEW,
-        (SELECT max(Timestamp) as time, Vessel_IMO from AIS_MESSAGE GROUP BY Vessel_IMO) 
-        RECENT_SHIP WHERE POSITION_REPORT.AISMessage_Id = AIS_MESSAGE.Id AND AIS_MESSAGE.Vessel_IMO = RECENT_SHIP.Vessel_IMO
-        AND MAP_VIEW.Id = {tile_id};
+        scale = self._tile_scale(int(tile_id))
+        if scale not in READ_MOST_RECENT_SHIP_POS_IN_TILE:
+            return []
+
+        ensure_schema()
+        rs = SQL_runner().execute(READ_MOST_RECENT_SHIP_POS_IN_TILE[scale], (int(tile_id),))
+        return rs
+
+    def _tile_scale(self, tile_id):
+        """
+        Scale of a tile, from the tile index when there is one, or None for an unknown tile
+        """
+        tile_index = self.tile_index if self.tile_index is not None else self._loaded_tile_index
+        if tile_index is not None:
+            tile = tile_index.tile(tile_id)
+            return tile.scale if tile is not None else None
+
+        rs = SQL_runner().execute(READ_TILE_SCALE, (tile_id,))
+        return rs[0][0] if rs else None
+
+    def iter_most_recent_ship_pos_in_tile(self, tile_id, chunk_size=1000):
+        """
+        Read all most recent ship positions in the given tile, lazily
+
+        :param: tile_id: id of the tile
+        :type: tile_id: int
+        :param: chunk_size: number of rows fetched per round trip
+        :type: chunk_size: int
+        :return: ship documents, as they arrive from the server
+        :rtype: generator
         """
-        rs = SQL_runner().run(QUERY)
-        return rs        
+        if self.is_stub:
+            return
+
+        scale = self._tile_scale(int(tile_id))
+        if scale not in READ_MOST_RECENT_SHIP_POS_IN_TILE:
+            return
+
+        ensure_schema()
+        yield from SQL_runner().stream(READ_MOST_RECENT_SHIP_POS_IN_TILE[scale], (int(tile_id),), chunk_size=chunk_size)
 
     def read_all_ports(self, batch):
         """
@@ -359,11 +788,7 @@ class TMB_DAO:
         name = input("Enter the Port's name")
         country = input("Enter the country the Port is located in: ")
 
-        QUERY = f"""
-        SELECT * FROM PORT WHERE Name = '{name}' and Country = '{country}';
-        """
-
-        rs = SQL_runner().run(QUERY)
+        rs = SQL_runner().execute(READ_ALL_PORTS, (name, country))
         return rs
 
 
@@ -391,11 +816,7 @@ class TMB_DAO:
         name = input("Enter the Port's name: ")
         country = input("Enter the country the Port is located in: ") 
 
-        QUERY=f"""
-        Select Longitude, Latitude, Scale FROM PORT, MAP_VIEW
-        WHERE Scale = 3 AND Port.Name = '{name}' AND Port.Country = '{country}';
-        """
-        rs = SQL_runner().run(QUERY)
+        rs = SQL_runner().execute(READ_ALL_SHIP_POS_SCALE3, (name, country))
         return rs     
 
     def read_last_5_pos(self, batch):
@@ -426,11 +847,80 @@ class TMB_DAO:
             print("Value must be an integer.")
             return - 1
 
-        QUERY = f"""SELECT MMSI, Latitude, Longitude, Vessel_IMO 
-        FROM POSITION_REPORT, AIS_MESSAGE WHERE MMSI = {mmsi} AND POSITION_REPORT.AISMessage_Id = AIS_MESSAGE.Id 
-        ORDER BY Timestamp DESC LIMIT 5;"""
-        rs = SQL_runner().run(QUERY)
-        return rs    
+        return self.read_last_n_pos(int(mmsi), 5)
+
+    def read_last_5_pos_many(self, mmsis):
+        """
+        Read last 5 positions of each of several MMSIs, newest first
+
+        :param: mmsis: MMSIs of the vessels
+        :type: mmsis: list
+        :return: a list of position documents per MMSI, empty for an MMSI without any position
+        :rtype: dict
+        """
+        return self.read_last_n_pos_many(mmsis, 5)
+
+    def read_last_n_pos(self, mmsi, n):
+        """
+        Read last n positions of given MMSI, newest first
+
+        :param: mmsi: MMSI of the vessel
+        :type: mmsi: int
+        :param: n: number of positions
+        :type: n: int
+        :return: a list of position documents
+        :rtype: list
+        """
+        if self.is_stub:
+            return []
+
+        if self.trajectories is not None:
+            return self.trajectories.last_n(mmsi, n)
+
+        rs = SQL_runner().execute(READ_LAST_N_POS, (mmsi, n))
+        return [row[:4] for row in rs]    
+
+    def read_last_n_pos_many(self, mmsis, n):
+        """
+        Read last n positions of each of several MMSIs, newest first
+
+        :param: mmsis: MMSIs of the vessels
+        :type: mmsis: list
+        :param: n: number of positions per vessel
+        :type: n: int
+        :return: a list of position documents per MMSI, empty for an MMSI without any position
+        :rtype: dict
+        """
+        mmsis = [int(mmsi) for mmsi in mmsis]
+        if self.is_stub:
+            return {mmsi: [] for mmsi in mmsis}
+
+        if self.trajectories is not None:
+            return self.trajectories.last_n_many(mmsis, n)
+
+        positions = {mmsi: [] for mmsi in mmsis}
+        for row in SQL_runner().execute_in(READ_LAST_N_POS_MANY, mmsis, (n,)):
+            positions[row[0]].append(row[:4])
+        return positions
+
+    def read_positions_between(self, mmsi, start, end):
+        """
+        Read the positions of given MMSI reported from `start` (included) to `end` (excluded), newest first
+
+        :param: mmsi: MMSI of the vessel
+        :type: mmsi: int
+        :param: start: beginning of the period
+        :type: start: datetime
+        :param: end: end of the period
+        :type: end: datetime
+        :return: a list of position documents, with their timestamp
+        :rtype: list
+        """
+        if self.is_stub:
+            return []
+
+        ensure_schema()
+        return SQL_runner().execute(READ_POSITIONS_BETWEEN, (mmsi, start, end, start, end))
 
     def read_position_to_port_id(self, batch):
         """
@@ -454,13 +944,26 @@ class TMB_DAO:
 
         given_id = input("Please enter a Port Id to read most recent positions of ships headed to the port: ")
 
-        QUERY = f"""
-        SELECT MMSI, Latitude, Longitude, Vessel_IMO FROM POSITION_REPORT, AIS_MESSAGE 
-        WHERE AIS_MESSAGE.Id = {given_id} AND POSITION_REPORT.AISMessage_Id = AIS_MESSAGE.Id;
+        rs = SQL_runner().execute(READ_POSITION_TO_PORT_ID, (given_id,))
+        return rs
+
+    def read_position_to_port_id_many(self, ids):
+        """
+        Read most recent positions of ships headed to each of several port ids
+
+        :param: ids: port ids
+        :type: ids: list
+        :return: a list of position documents per id, empty for an id without any
+        :rtype: dict
         """
-        rs = SQL_runner().run(QUERY)    
+        ids = [int(id) for id in ids]
+        if self.is_stub:
+            return {id: [] for id in ids}
 
-        return -1
+        positions = {id: [] for id in ids}
+        for row in SQL_runner().execute_in(READ_POSITION_TO_PORT_ID_MANY, ids):
+            positions[row[0]].append(row[1:])
+        return positions
 
     def read_position_given_port(self, batch):
         """
@@ -484,15 +987,29 @@ class TMB_DAO:
 
         port_id = input("Please enter a Port Id to read most recent positions of ships headed to given the Port: ")    
 
-        QUERY=f"""SELECT MMSI, Latitude, Longitude, AIS_MESSAGE.Vessel_IMO FROM POSITION_REPORT, AIS_MESSAGE, PORT, 
-        (SELECT max(Timestamp) as time, Vessel_IMO from AIS_MESSAGE GROUP BY Vessel_IMO) RECENT_SHIP 
-        WHERE POSITION_REPORT.AISMessage_Id = AIS_MESSAGE.Id AND AIS_MESSAGE.Vessel_IMO = RECENT_SHIP.Vessel_IMO 
-        AND PORT.Id = {port_id} AND POSITION_REPORT.MapView1_Id = PORT.MapView1_Id 
-        AND POSITION_REPORT.MapView2_Id = PORT.MapView2_Id AND POSITION_REPORT.MapView3_Id = PORT.MapView3_Id;
-        """
-        rs = SQL_runner().run(QUERY)  
+        ensure_schema()
+        rs = SQL_runner().execute(READ_POSITION_GIVEN_PORT, (port_id,))
         return rs
 
+    def read_position_given_port_many(self, port_ids):
+        """
+        Read most recent positions of ships headed to each of several ports
+
+        :param: port_ids: ids of the ports
+        :type: port_ids: list
+        :return: a list of position documents per port id, empty for a port without any
+        :rtype: dict
+        """
+        port_ids = [int(port_id) for port_id in port_ids]
+        if self.is_stub:
+            return {port_id: [] for port_id in port_ids}
+
+        ensure_schema()
+        positions = {port_id: [] for port_id in port_ids}
+        for row in SQL_runner().execute_in(READ_POSITION_GIVEN_PORT_MANY, port_ids):
+            positions[row[0]].append(row[1:])
+        return positions
+
     def find_tiles_zoom_2(self, batch):
         """
         Given a background map tile for zoom level 1 (2), find the 4 tiles of zoom level 2 (3) that are contained in it
@@ -513,7 +1030,48 @@ class TMB_DAO:
         if self.is_stub:
             return array
 
-        return -1
+        id = input("Please enter a tile ID of zoom level 1 or 2 to find the tiles contained in it: ")
+
+        try:
+            int(id)
+        except ValueError:
+            print("Value must be an integer.")
+            return - 1
+
+        return self.find_tiles_zoom_2_many([int(id)])[int(id)]
+
+    def find_tiles_zoom_2_many(self, tile_ids):
+        """
+        Find the tiles of the next zoom level contained in each of several tiles
+
+        Child tiles come from the in-memory tile hierarchy, loaded from MAP_VIEW on first use;
+        call `refresh_tiles` after MAP_VIEW changes.
+
+        :param: tile_ids: ids of tiles of zoom level 1 or 2
+        :type: tile_ids: list
+        :return: a list of map tile description documents for each tile id (empty for a tile
+            of zoom level 3 or an unknown tile)
+        :rtype: dict
+        """
+        if self.is_stub:
+            return {tile_id: [] for tile_id in tile_ids}
+
+        children = self.active_tile_index.children_many(tile_ids)
+        return {tile_id: [tile.document() for tile in tiles] for tile_id, tiles in children.items()}
+
+    def refresh_tiles(self):
+        """
+        Reload the tile hierarchy from the MAP_VIEW table
+
+        :return: number of tiles
+        :rtype: int
+        """
+        if self.is_stub:
+            return 0
+
+        if self.tile_index is None and self._loaded_tile_index is None:
+            return len(self.active_tile_index.tiles)
+        return self.active_tile_index.refresh()
 
     def find_tile_from_id(self, batch):
         """
@@ -521,7 +1079,7 @@ class TMB_DAO:
 
         :param: batch: a string that represent a JSON array of docs
         :type: batch: str
-        :return: a PNG file
+        :return: a PNG file (a memoryview over it if the tile cache is in zero-copy mode)
         :rtype: binary data
         """
         if batch == "" or batch == None:
@@ -543,11 +1101,11 @@ class TMB_DAO:
             print("Value must be an integer.")
             return - 1 
 
-        QUERY = f"""
-        SELECT RasterFile FROM MAP_VIEW WHERE Id={id};
-        """
-        rs = SQL_runner().run(QUERY)
-        return rs
+        tile = self.tile_cache.get(int(id))
+        if tile is None:
+            print("No tile with that ID.")
+            return -1
+        return tile
 
 
 class TMBTest(unittest.TestCase):
@@ -575,7 +1133,61 @@ class TMBTest(unittest.TestCase):
         tmb = TMB_DAO(True) 
         array = json.loads(self.batch)
         inserted_count = tmb.insert_message_batch(array)
-        self.assertEqual(inserted_count, -1)  
+        self.assertEqual(inserted_count, -1)
+
+    def test_insert_message_batch_bulk_1(self):
+        """
+        Function `insert_message_batch_bulk` takes a JSON parsable string as an input.
+        Returns: number (int) of insertions per table (dict)
+        """
+        tmb = TMB_DAO(True)
+        counts = tmb.insert_message_batch_bulk(self.batch)
+        self.assertEqual(counts, {"AIS_MESSAGE": 7, "STATIC_DATA": 2, "POSITION_REPORT": 5})
+
+    def test_insert_message_batch_bulk_2(self):
+        """
+        Function `insert_message_batch_bulk` fails nicely if input is not JSON parsable, or is empty.
+        """
+        tmb = TMB_DAO(True)
+        array = json.loads(self.batch)
+        counts = tmb.insert_message_batch_bulk(array)
+        self.assertEqual(counts, -1)
+
+    def test_insert_message_batch_parallel_1(self):
+        """
+        Function `insert_message_batch_parallel` takes a JSON parsable string as an input.
+        Returns: the number of insertions per table
+        """
+        tmb = TMB_DAO(True)
+        counts = tmb.insert_message_batch_parallel(self.batch, workers=2)
+        self.assertEqual(counts, {"AIS_MESSAGE": 7, "STATIC_DATA": 2, "POSITION_REPORT": 5})
+
+    def test_insert_message_batch_parallel_2(self):
+        """
+        Function `insert_message_batch_parallel` fails nicely if input is not JSON parsable, or is empty.
+        """
+        tmb = TMB_DAO(True)
+        self.assertEqual(tmb.insert_message_batch_parallel(""), -1)
+        self.assertEqual(tmb.insert_message_batch_parallel("[{"), -1)
+
+    def test_insert_message_stream_1(self):
+        """
+        Function `insert_message_stream` takes NDJSON lines or a JSON array as an input.
+        Returns: number (int) of insertions per table (dict)
+        """
+        tmb = TMB_DAO(True)
+        lines = [json.dumps(doc) + "\n" for doc in json.loads(self.batch)]
+        expected = {"AIS_MESSAGE": 7, "STATIC_DATA": 2, "POSITION_REPORT": 5}
+        self.assertEqual(tmb.insert_message_stream(lines, chunk_size=3), expected)
+        self.assertEqual(tmb.insert_message_stream([self.batch], chunk_size=3), expected)
+
+    def test_insert_message_stream_2(self):
+        """
+        Function `insert_message_stream` fails nicely if input is not JSON parsable, or is empty.
+        """
+        tmb = TMB_DAO(True)
+        self.assertEqual(tmb.insert_message_stream(["[{\"MsgType\": "]), -1)
+        self.assertEqual(tmb.insert_message_stream(None), -1)
 
     def test_insert_message_interface_1(self):
         """
@@ -631,6 +1243,22 @@ class TMBTest(unittest.TestCase):
         ships = tmb.read_most_recent_ship_pos(array)
         self.assertEqual(ships, -1)
 
+    def test_iter_most_recent_ship_pos(self):
+        """
+        Function `iter_most_recent_ship_pos` returns an iterator of ship documents.
+        """
+        tmb = TMB_DAO(True)
+        ships = tmb.iter_most_recent_ship_pos()
+        self.assertEqual(list(ships), [])
+
+    def test_iter_most_recent_ship_pos_in_tile(self):
+        """
+        Function `iter_most_recent_ship_pos_in_tile` returns an iterator of ship documents.
+        """
+        tmb = TMB_DAO(True)
+        ships = tmb.iter_most_recent_ship_pos_in_tile(1)
+        self.assertEqual(list(ships), [])
+
     def test_read_pos_MMSI1(self):
         """
         Function `read_pos_MMSI` takes a JSON parsable string as an input.
@@ -649,6 +1277,13 @@ class TMBTest(unittest.TestCase):
         document = tmb.read_pos_MMSI(array)
         self.assertEqual(document, -1)
 
+    def test_read_pos_MMSI_many(self):
+        """
+        Function `read_pos_MMSI_many` returns a position document or None per MMSI.
+        """
+        tmb = TMB_DAO(True)
+        self.assertEqual(tmb.read_pos_MMSI_many([304858000, 219005465]), {304858000: None, 219005465: None})
+
     def test_read_vessel_info1(self):
         """
         Function `read_vessel_info` takes a JSON parsable string as an input.
@@ -667,6 +1302,13 @@ class TMBTest(unittest.TestCase):
         document = tmb.read_vessel_info(array)
         self.assertEqual(document, -1)
 
+    def test_read_vessel_info_many(self):
+        """
+        Function `read_vessel_info_many` returns a vessel document or None per MMSI.
+        """
+        tmb = TMB_DAO(True)
+        self.assertEqual(tmb.read_vessel_info_many(["304858000"]), {304858000: None})
+
     def test_read_most_recent_ship_pos_in_tile1(self):
         """
         Function `read_most_recent_ship_pos_in_tile` takes a JSON parsable string as an input.
@@ -739,6 +1381,30 @@ class TMBTest(unittest.TestCase):
         document = tmb.read_last_5_pos(array)
         self.assertEqual(document, -1)
 
+    def test_read_last_n_pos(self):
+        """
+        Function `read_last_n_pos` takes an MMSI and a count as input.
+        Returns: a list of documents
+        """
+        tmb = TMB_DAO(True)
+        document = tmb.read_last_n_pos(304858000, 3)
+        self.assertTrue(type(document) is list)
+
+    def test_read_last_5_pos_many(self):
+        """
+        Function `read_last_5_pos_many` returns a list of position documents per MMSI.
+        """
+        tmb = TMB_DAO(True)
+        self.assertEqual(tmb.read_last_5_pos_many([304858000, 219005465]), {304858000: [], 219005465: []})
+
+    def test_read_positions_between(self):
+        """
+        Function `read_positions_between` returns a list of position documents.
+        """
+        tmb = TMB_DAO(True)
+        positions = tmb.read_positions_between(304858000, datetime(2020, 11, 18), datetime(2020, 11, 19))
+        self.assertEqual(positions, [])
+
     def test_read_position_to_port_id1(self):
         """
         Function 'read_position_to_port_id' takes a JSON parsable string as an input.
@@ -757,6 +1423,13 @@ class TMBTest(unittest.TestCase):
         document = tmb.read_position_to_port_id(array)
         self.assertEqual(document, -1)
 
+    def test_read_position_to_port_id_many(self):
+        """
+        Function `read_position_to_port_id_many` returns a list of position documents per id.
+        """
+        tmb = TMB_DAO(True)
+        self.assertEqual(tmb.read_position_to_port_id_many([1, 2]), {1: [], 2: []})
+
     def test_read_position_given_port1(self):
         """
         Function 'read_position_given_port' takes a JSON parsable string as an input.
@@ -775,6 +1448,13 @@ class TMBTest(unittest.TestCase):
         document = tmb.read_position_given_port(array)
         self.assertEqual(document, -1)
 
+    def test_read_position_given_port_many(self):
+        """
+        Function `read_position_given_port_many` returns a list of position documents per port id.
+        """
+        tmb = TMB_DAO(True)
+        self.assertEqual(tmb.read_position_given_port_many([1, 2]), {1: [], 2: []})
+
     def test_find_tiles_zoom_2_1(self):
         """
         Function 'find_tiles_zoom_2' takes a JSON parsable string as an input.
@@ -793,6 +1473,25 @@ class TMBTest(unittest.TestCase):
         document = tmb.find_tiles_zoom_2(array)
         self.assertEqual(document, -1)  
 
+    def test_find_tiles_zoom_2_many(self):
+        """
+        Function `find_tiles_zoom_2_many` returns a list of map tile description documents per tile id.
+        """
+        tmb = TMB_DAO(True)
+        documents = tmb.find_tiles_zoom_2_many([1, 2])
+        self.assertEqual(documents, {1: [], 2: []})
+
+    def test_active_tile_index(self):
+        """
+        The reads and the insert methods share the tile index, unless tile assignment is off.
+        """
+        tmb = TMB_DAO()
+        tmb._loaded_tile_index = TileIndex([Tile(1, 1, 0, 50, 20, 60), Tile(2, 2, 0, 50, 10, 55, container_id=1)])
+        self.assertEqual(tmb.find_tiles_zoom_2_many([1]), {1: [(2, 2, 0.0, 50.0, 10.0, 55.0, 1)]})
+        self.assertIs(tmb.ingest_tile_index, tmb._loaded_tile_index)
+        self.assertEqual(tmb._tile_scale(2), 2)
+        self.assertIsNone(TMB_DAO(tile_index=tmb._loaded_tile_index, assign_tiles=False).ingest_tile_index)
+
     def test_find_tile_from_id1(self):
         """
         Function 'find_tile_from_id' takes a JSON parsable string as an input.
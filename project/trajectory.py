@@ -0,0 +1,336 @@
+import sys
+import threading
+import unittest
+from array import array
+from datetime import datetime
+from mysqlutils import SQL_runner
+from ais_records import to_epoch_us, decode_messages
+
+DEFAULT_CAPACITY = 5
+
+READ_LAST_N_POS = """
+    SELECT MMSI, Latitude, Longitude, Vessel_IMO, AIS_MESSAGE.Timestamp
+    FROM POSITION_REPORT, AIS_MESSAGE WHERE MMSI = %s AND POSITION_REPORT.AISMessage_Id = AIS_MESSAGE.Id
+    ORDER BY AIS_MESSAGE.Timestamp DESC LIMIT %s
+    """
+
+# Stored in place of a missing Vessel_IMO; no vessel has IMO 0
+NO_IMO = 0
+
+# Last n positions of each of several vessels, numbered newest first within each vessel
+READ_LAST_N_POS_MANY = """
+    SELECT MMSI, Latitude, Longitude, Vessel_IMO, Timestamp FROM (
+    SELECT MMSI, Latitude, Longitude, Vessel_IMO, AIS_MESSAGE.Timestamp,
+    ROW_NUMBER() OVER (PARTITION BY MMSI ORDER BY AIS_MESSAGE.Timestamp DESC) AS Recency
+    FROM POSITION_REPORT, AIS_MESSAGE WHERE MMSI IN ({keys}) AND POSITION_REPORT.AISMessage_Id = AIS_MESSAGE.Id) RECENT
+    WHERE Recency <= %s ORDER BY MMSI, Recency
+    """
+
+class PositionFix:
+    """
+    One position of a vessel, with the Vessel_IMO of its message (None if unknown)
+    """
+    __slots__ = ('timestamp', 'latitude', 'longitude', 'vessel_imo')
+
+    def __init__(self, timestamp, latitude, longitude, vessel_imo=None):
+        self.timestamp = timestamp
+        self.latitude = latitude
+        self.longitude = longitude
+        self.vessel_imo = vessel_imo
+
+    def __repr__(self):
+        return f"PositionFix({self.timestamp}, {self.latitude}, {self.longitude}, {self.vessel_imo})"
+
+
+class PositionRing:
+    """
+    The most recent positions of one vessel, in fixed-size arrays kept in timestamp order
+
+    Timestamps are stored as int64 microseconds since the epoch, coordinates as float64 and
+    IMOs as int64 (`NO_IMO` when unknown). A position older than all stored ones is dropped once
+    the ring is full.
+    """
+    __slots__ = ('capacity', '_timestamps', '_latitudes', '_longitudes', '_imos', '_start', '_count')
+
+    def __init__(self, capacity=DEFAULT_CAPACITY):
+        if capacity < 1:
+            raise ValueError("Capacity must be at least 1")
+        self.capacity = capacity
+        self._timestamps = array('q', bytes(8 * capacity))
+        self._latitudes = array('d', bytes(8 * capacity))
+        self._longitudes = array('d', bytes(8 * capacity))
+        self._imos = array('q', bytes(8 * capacity))
+        self._start = 0
+        self._count = 0
+
+    def __len__(self):
+        return self._count
+
+    def _slot(self, i):
+        """
+        Array index of the i-th oldest position
+        """
+        return (self._start + i) % self.capacity
+
+    def _set(self, i, timestamp, latitude, longitude, vessel_imo):
+        slot = self._slot(i)
+        self._timestamps[slot] = timestamp
+        self._latitudes[slot] = latitude
+        self._longitudes[slot] = longitude
+        self._imos[slot] = NO_IMO if vessel_imo is None else vessel_imo
+
+    def _move(self, source, target):
+        source = self._slot(source)
+        target = self._slot(target)
+        self._timestamps[target] = self._timestamps[source]
+        self._latitudes[target] = self._latitudes[source]
+        self._longitudes[target] = self._longitudes[source]
+        self._imos[target] = self._imos[source]
+
+    def add(self, timestamp, latitude, longitude, vessel_imo=None):
+        """
+        Record a position, wherever its timestamp falls
+
+        :param: timestamp: microseconds since the epoch
+        :type: timestamp: int
+        :param: vessel_imo: Vessel_IMO of the position's message, None if unknown
+        :type: vessel_imo: int
+        :return: False if the position was older than everything kept, and dropped
+        :rtype: bool
+        """
+        # Number of stored positions at or before the new one
+        position = self._count
+        while position > 0 and self._timestamps[self._slot(position - 1)] > timestamp:
+            position -= 1
+
+        if position > 0 and self._timestamps[self._slot(position - 1)] == timestamp:
+            # Same report seen twice (e.g. from ingest and from the database); keep a known IMO
+            if vessel_imo is None:
+                vessel_imo = self._imos[self._slot(position - 1)] or None
+            self._set(position - 1, timestamp, latitude, longitude, vessel_imo)
+            return True
+
+        if self._count < self.capacity:
+            for i in range(self._count, position, -1):
+                self._move(i - 1, i)
+            self._set(position, timestamp, latitude, longitude, vessel_imo)
+            self._count += 1
+            return True
+
+        if position == 0:
+            return False
+        if position == self._count:
+            # The common case: the newest position overwrites the oldest
+            self._start = self._slot(1)
+            self._set(self._count - 1, timestamp, latitude, longitude, vessel_imo)
+            return True
+        for i in range(1, position):
+            self._move(i, i - 1)
+        self._set(position - 1, timestamp, latitude, longitude, vessel_imo)
+        return True
+
+    def latest(self, n):
+        """
+        The `n` most recent positions, newest first
+
+        :rtype: list of PositionFix
+        """
+        fixes = []
+        for i in range(self._count - 1, max(self._count - n, 0) - 1, -1):
+            slot = self._slot(i)
+            fixes.append(PositionFix(self._timestamps[slot], self._latitudes[slot], self._longitudes[slot],
+                                     self._imos[slot] or None))
+        return fixes
+
+    def nbytes(self):
+        """
+        Memory held by the ring, in bytes
+        """
+        return (sys.getsizeof(self) + sys.getsizeof(self._timestamps)
+                + sys.getsizeof(self._latitudes) + sys.getsizeof(self._longitudes) + sys.getsizeof(self._imos))
+
+
+class TrajectoryStore:
+    """
+    A ring of the last `capacity` positions for every MMSI seen by ingest
+    """
+
+    def __init__(self, capacity=DEFAULT_CAPACITY, fallback_to_sql=True):
+        """
+        :param: capacity: positions kept per vessel
+        :type: capacity: int
+        :param: fallback_to_sql: read unknown vessels from the database (and remember them)
+        :type: fallback_to_sql: bool
+        """
+        self.capacity = capacity
+        self.fallback_to_sql = fallback_to_sql
+        self._rings = {}
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._rings)
+
+    def add(self, mmsi, timestamp, latitude, longitude, vessel_imo=None):
+        """
+        Record a position of a vessel
+
+        :param: timestamp: time of the report
+        :type: timestamp: datetime
+        :param: vessel_imo: Vessel_IMO of the report's message, None if unknown
+        :type: vessel_imo: int
+        """
+        return self._add(mmsi, to_epoch_us(timestamp), latitude, longitude, vessel_imo)
+
+    def _add(self, mmsi, timestamp, latitude, longitude, vessel_imo=None):
+        with self._lock:
+            ring = self._rings.get(mmsi)
+            if ring is None:
+                ring = self._rings[mmsi] = PositionRing(self.capacity)
+            return ring.add(timestamp, latitude, longitude, vessel_imo)
+
+    def update_from_messages(self, messages):
+        """
+        Record the position reports among AIS message records, whose timestamps already are
+        microseconds since the epoch
+        """
+        for record in messages:
+            if record.msg_type == "position_report":
+                self._add(record.mmsi, record.timestamp, record.latitude, record.longitude)
+
+    def last_n(self, mmsi, n, runner=None):
+        """
+        Last `n` positions of a vessel, newest first
+
+        When falling back to SQL, a vessel whose ring holds fewer than `n` positions (e.g. one not
+        seen since startup) is read from the database, and its ring filled from the result.
+
+        :param: mmsi: MMSI of the vessel
+        :type: mmsi: int
+        :param: n: number of positions
+        :type: n: int
+        :return: position documents (MMSI, Latitude, Longitude, Vessel_IMO)
+        :rtype: list
+        """
+        with self._lock:
+            ring = self._rings.get(mmsi)
+            fixes = ring.latest(n) if ring is not None else []
+        if len(fixes) == n or not self.fallback_to_sql:
+            return [(mmsi, fix.latitude, fix.longitude, fix.vessel_imo) for fix in fixes]
+
+        runner = runner if runner is not None else SQL_runner()
+        rs = runner.execute(READ_LAST_N_POS, (mmsi, n))
+        for row in rs[:self.capacity]:
+            self.add(row[0], row[4], row[1], row[2], row[3])
+        return [row[:4] for row in rs]
+
+    def last_n_many(self, mmsis, n, runner=None):
+        """
+        Last `n` positions of several vessels, newest first
+
+        When falling back to SQL, the vessels whose ring holds fewer than `n` positions are read
+        from the database together, and their rings filled from the result.
+
+        :param: mmsis: MMSIs of the vessels
+        :type: mmsis: list
+        :param: n: number of positions per vessel
+        :type: n: int
+        :return: position documents (MMSI, Latitude, Longitude, Vessel_IMO) per MMSI, an empty list
+            for an unknown vessel
+        :rtype: dict
+        """
+        positions = {}
+        missing = []
+        with self._lock:
+            for mmsi in mmsis:
+                ring = self._rings.get(mmsi)
+                fixes = ring.latest(n) if ring is not None else []
+                positions[mmsi] = [(mmsi, fix.latitude, fix.longitude, fix.vessel_imo) for fix in fixes]
+                if len(fixes) < n:
+                    missing.append(mmsi)
+        if not missing or not self.fallback_to_sql:
+            return positions
+
+        runner = runner if runner is not None else SQL_runner()
+        rows = {mmsi: [] for mmsi in missing}
+        for row in runner.execute_in(READ_LAST_N_POS_MANY, missing, (n,)):
+            rows[row[0]].append(row)
+        for mmsi, rs in rows.items():
+            for row in rs[:self.capacity]:
+                self.add(row[0], row[4], row[1], row[2], row[3])
+            positions[mmsi] = [row[:4] for row in rs]
+        return positions
+
+    def memory_usage(self):
+        """
+        Memory held by the store, in bytes, counting the rings and the MMSI index
+        """
+        with self._lock:
+            rings = sum(ring.nbytes() for ring in self._rings.values())
+            return rings + sys.getsizeof(self._rings) + sum(sys.getsizeof(mmsi) for mmsi in self._rings)
+
+    def memory_per_vessel(self):
+        """
+        Average memory per vessel, in bytes; multiply by the fleet size to size the store
+        """
+        if not self._rings:
+            ring = PositionRing(self.capacity)
+            return ring.nbytes() + sys.getsizeof(2 ** 30)
+        return self.memory_usage() / len(self._rings)
+
+
+class TrajectoryTest(unittest.TestCase):
+
+    def test_ring_in_order(self):
+        """
+        Function `add` keeps the last `capacity` positions when they arrive in order.
+        """
+        ring = PositionRing(3)
+        for t in range(1, 6):
+            ring.add(t, float(t), -float(t))
+        self.assertEqual([fix.timestamp for fix in ring.latest(5)], [5, 4, 3])
+        self.assertEqual(ring.latest(1)[0].longitude, -5.0)
+
+    def test_ring_out_of_order(self):
+        """
+        Function `add` places late positions by timestamp and drops ones older than the ring.
+        """
+        ring = PositionRing(3)
+        for t in (10, 30, 20, 40, 5, 35):
+            ring.add(t, float(t), 0.0)
+        self.assertEqual([fix.timestamp for fix in ring.latest(3)], [40, 35, 30])
+        self.assertFalse(ring.add(1, 1.0, 0.0))
+        ring.add(35, 1.0, 2.0)
+        self.assertEqual([(fix.timestamp, fix.latitude) for fix in ring.latest(3)], [(40, 40.0), (35, 1.0), (30, 30.0)])
+
+    def test_store_last_n(self):
+        """
+        Function `last_n` returns position documents, newest first.
+        """
+        store = TrajectoryStore(capacity=5, fallback_to_sql=False)
+        messages = decode_messages([{"Timestamp": f"2020-11-18T00:00:0{s}.000Z", "MMSI": 7, "MsgType": "position_report",
+                                     "Position": {"type": "Point", "coordinates": [55.0 + s, 13.0]}} for s in (2, 1, 3)])
+        store.update_from_messages(messages)
+        self.assertEqual(store.last_n(7, 2), [(7, 58.0, 13.0, None), (7, 57.0, 13.0, None)])
+        self.assertEqual(store.last_n(8, 2), [])
+        self.assertTrue(store.memory_per_vessel() > 0)
+        self.assertEqual(store.last_n_many([7, 8], 1), {7: [(7, 58.0, 13.0, None)], 8: []})
+
+    def test_store_vessel_imo(self):
+        """
+        The rings return the Vessel_IMO of the positions read from the database, like the database does.
+        """
+        class Runner:
+            def execute(self, sql, params):
+                return [(7, 56.0, 13.0, 9000001, datetime(2020, 11, 18, 0, 0, 1)),
+                        (7, 55.0, 13.0, 9000001, datetime(2020, 11, 18, 0, 0, 0))]
+
+        store = TrajectoryStore(capacity=5)
+        from_sql = store.last_n(7, 2, runner=Runner())
+        self.assertEqual(from_sql, [(7, 56.0, 13.0, 9000001), (7, 55.0, 13.0, 9000001)])
+        self.assertEqual(store.last_n(7, 2), from_sql)
+        store.add(7, datetime(2020, 11, 18, 0, 0, 1), 56.0, 13.0)
+        self.assertEqual(store.last_n(7, 1), from_sql[:1])
+
+
+if __name__ == '__main__':
+    unittest.main()
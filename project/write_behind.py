@@ -0,0 +1,347 @@
+import threading
+import time
+import unittest
+from collections import deque
+from mysqlutils import SQL_runner, read_config
+from query_metrics import Histogram
+
+DEFAULT_MAX_QUEUE = 10000
+DEFAULT_FLUSH_SIZE = 1000
+DEFAULT_FLUSH_INTERVAL_MS = 200
+
+# What `put` does when the queue is full
+BACKPRESSURE = ("block", "reject")
+
+
+class QueueFull(Exception):
+    """
+    Raised by `WriteBehindBuffer.put` when messages do not fit in the queue: at once when rejecting,
+    after `put_timeout` when blocking
+    """
+
+
+def write_behind_settings(cfg=SQL_runner.config_file):
+    """
+    Arguments of `WriteBehindBuffer` from the optional `[WRITE_BEHIND]` section of the configuration
+    file (`max_queue`, `flush_size`, `flush_interval_ms`, `backpressure`, `put_timeout` seconds)
+
+    :rtype: dict
+    """
+    config = read_config(cfg)
+    settings = config['WRITE_BEHIND'] if config.has_section('WRITE_BEHIND') else {}
+    return {"max_queue": int(settings.get('max_queue', DEFAULT_MAX_QUEUE)),
+            "flush_size": int(settings.get('flush_size', DEFAULT_FLUSH_SIZE)),
+            "flush_interval_ms": float(settings.get('flush_interval_ms', DEFAULT_FLUSH_INTERVAL_MS)),
+            "backpressure": settings.get('backpressure', 'block'),
+            "put_timeout": float(settings['put_timeout']) if settings.get('put_timeout') else None}
+
+
+class WriteBehindBuffer:
+    """
+    Bounded in-memory queue of AIS message records, written in bulk by a background flusher
+
+    The flusher writes up to `flush_size` messages at a time, as soon as that many are queued or the
+    oldest queued message has waited `flush_interval_ms`. Messages are only durable once written:
+    `flush` waits for everything queued before it, and `close` flushes and stops the flusher. A batch
+    whose write fails is dropped and counted, and the next `flush` or `close` raises its error.
+
+    When the queue is full, `put` either blocks until the flusher makes room or rejects the messages.
+    """
+
+    def __init__(self, write, max_queue=DEFAULT_MAX_QUEUE, flush_size=DEFAULT_FLUSH_SIZE,
+                 flush_interval_ms=DEFAULT_FLUSH_INTERVAL_MS, backpressure="block", put_timeout=None):
+        """
+        :param: write: function writing a list of records, e.g. `BulkWriter.write`
+        :type: write: callable
+        :param: max_queue: maximum number of queued messages
+        :type: max_queue: int
+        :param: flush_size: number of queued messages that triggers a write, and most written at once
+        :type: flush_size: int
+        :param: flush_interval_ms: longest a message waits in the queue before a write, in milliseconds
+        :type: flush_interval_ms: float
+        :param: backpressure: `block` or `reject` when the queue is full
+        :type: backpressure: str
+        :param: put_timeout: longest `put` blocks before rejecting, in seconds, or None to wait for ever
+        :type: put_timeout: float
+        """
+        if backpressure not in BACKPRESSURE:
+            raise ValueError(f"backpressure must be one of {', '.join(BACKPRESSURE)}")
+        if max_queue < 1 or flush_size < 1:
+            raise ValueError("max_queue and flush_size must be at least 1")
+        self.write = write
+        self.max_queue = max_queue
+        self.flush_size = flush_size
+        self.flush_interval = flush_interval_ms / 1000
+        self.backpressure = backpressure
+        self.put_timeout = put_timeout
+        self.written = 0
+        self.failed = 0
+        self.rejected = 0
+        self.blocked = 0
+        self.blocked_seconds = 0.0
+        self.max_depth = 0
+        self.flush_latency = Histogram()
+        self._queue = deque()
+        self._queued_at = None
+        # Messages accepted, and messages written or dropped, since the start
+        self._enqueued = 0
+        self._done = 0
+        self._flush_waiters = 0
+        self._closing = False
+        self._error = None
+        self._cond = threading.Condition()
+        self._thread = threading.Thread(target=self._run, name="write-behind", daemon=True)
+        self._thread.start()
+
+    def __len__(self):
+        return len(self._queue)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def stats(self):
+        """
+        Queue depth, message counters and flush latencies
+
+        :rtype: dict
+        """
+        with self._cond:
+            return {"depth": len(self._queue), "max_depth": self.max_depth, "max_queue": self.max_queue,
+                    "written": self.written, "failed": self.failed, "rejected": self.rejected,
+                    "blocked": self.blocked, "blocked_seconds": self.blocked_seconds,
+                    "flush_latency": self.flush_latency.snapshot()}
+
+    def _append(self, records):
+        if not self._queue:
+            self._queued_at = time.monotonic()
+        self._queue.extend(records)
+        self._enqueued += len(records)
+        self.max_depth = max(self.max_depth, len(self._queue))
+        if len(self._queue) >= self.flush_size or len(self._queue) == len(records):
+            self._cond.notify_all()
+
+    def put(self, records):
+        """
+        Queue messages for the flusher
+
+        A blocking buffer queues what fits and waits for room for the rest; if `put_timeout` runs
+        out, the messages queued so far stay queued and the rest are rejected. A rejecting buffer
+        queues all the messages or none.
+
+        :param: records: AIS message records
+        :type: records: list of AISMessage
+        :return: number of messages queued
+        :rtype: int
+        :raises: QueueFull: if the messages do not fit in the queue
+        """
+        records = list(records)
+        with self._cond:
+            if self._closing:
+                raise RuntimeError("write-behind buffer is closed")
+            if self.backpressure == "reject":
+                if len(self._queue) + len(records) > self.max_queue:
+                    self.rejected += len(records)
+                    raise QueueFull(f"{len(self._queue)} of {self.max_queue} messages queued, {len(records)} rejected")
+                self._append(records)
+                return len(records)
+
+            deadline = None if self.put_timeout is None else time.monotonic() + self.put_timeout
+            queued = 0
+            waited = False
+            while queued < len(records):
+                room = self.max_queue - len(self._queue)
+                if room > 0:
+                    self._append(records[queued:queued + room])
+                    queued += min(room, len(records) - queued)
+                    continue
+                remaining = None if deadline is None else deadline - time.monotonic()
+                if self._closing or (remaining is not None and remaining <= 0):
+                    self.rejected += len(records) - queued
+                    raise QueueFull(f"{queued} messages queued, {len(records) - queued} rejected after waiting for room")
+                if not waited:
+                    self.blocked += 1
+                    waited = True
+                start = time.monotonic()
+                self._cond.wait(remaining)
+                self.blocked_seconds += time.monotonic() - start
+            return queued
+
+    def _ready(self):
+        """
+        Whether the flusher should write now
+        """
+        if not self._queue:
+            return False
+        return (len(self._queue) >= self.flush_size or self._closing or self._flush_waiters > 0
+                or time.monotonic() - self._queued_at >= self.flush_interval)
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while not self._ready():
+                    if self._closing and not self._queue:
+                        return
+                    timeout = None if not self._queue else self._queued_at + self.flush_interval - time.monotonic()
+                    self._cond.wait(timeout)
+                batch = [self._queue.popleft() for _ in range(min(self.flush_size, len(self._queue)))]
+                if not self._queue:
+                    self._queued_at = None
+                # Room for blocked producers
+                self._cond.notify_all()
+            self._write(batch)
+
+    def _write(self, batch):
+        start = time.perf_counter()
+        try:
+            self.write(batch)
+            error = None
+        except Exception as e:
+            print(e)
+            error = e
+        seconds = time.perf_counter() - start
+        with self._cond:
+            self.flush_latency.observe(seconds)
+            if error is None:
+                self.written += len(batch)
+            else:
+                self.failed += len(batch)
+                self._error = error
+            self._done += len(batch)
+            self._cond.notify_all()
+
+    def _raise_error(self):
+        with self._cond:
+            error, self._error = self._error, None
+        if error is not None:
+            raise error
+
+    def flush(self, timeout=None):
+        """
+        Wait until every message queued before the call is written
+
+        :param: timeout: longest wait, in seconds, or None to wait for ever
+        :type: timeout: float
+        :raises: the error of a write that failed since the last `flush`, or TimeoutError
+        """
+        with self._cond:
+            target = self._enqueued
+            self._flush_waiters += 1
+            self._cond.notify_all()
+            try:
+                if not self._cond.wait_for(lambda: self._done >= target, timeout):
+                    raise TimeoutError(f"{target - self._done} messages still queued")
+            finally:
+                self._flush_waiters -= 1
+        self._raise_error()
+
+    def close(self):
+        """
+        Write every queued message and stop the flusher; further `put` calls fail
+
+        :raises: the error of a write that failed since the last `flush`
+        """
+        with self._cond:
+            self._closing = True
+            self._cond.notify_all()
+        self._thread.join()
+        self._raise_error()
+
+
+class WriteBehindBufferTest(unittest.TestCase):
+
+    def buffer(self, **settings):
+        self.batches = []
+        self.release = threading.Event()
+        self.release.set()
+
+        def write(batch):
+            self.release.wait()
+            if batch and batch[0] == "fail":
+                raise ValueError("write failed")
+            self.batches.append(batch)
+
+        buffer = WriteBehindBuffer(write, **settings)
+        self.addCleanup(self.release.set)
+        return buffer
+
+    def test_flush_size(self):
+        """
+        The flusher writes as soon as `flush_size` messages are queued, at most that many at a time.
+        """
+        with self.buffer(flush_size=3, flush_interval_ms=60000) as buffer:
+            buffer.put(range(7))
+            buffer.flush()
+            self.assertEqual(self.batches[:2], [[0, 1, 2], [3, 4, 5]])
+            self.assertEqual([m for batch in self.batches for m in batch], list(range(7)))
+            stats = buffer.stats()
+        self.assertEqual((stats["written"], stats["depth"], stats["max_depth"]), (7, 0, 7))
+        self.assertEqual(stats["flush_latency"]["count"], len(self.batches))
+
+    def test_flush_interval(self):
+        """
+        The flusher writes fewer than `flush_size` messages once the oldest has waited `flush_interval_ms`.
+        """
+        with self.buffer(flush_size=100, flush_interval_ms=10) as buffer:
+            buffer.put([1, 2])
+            deadline = time.monotonic() + 5
+            while not self.batches and time.monotonic() < deadline:
+                time.sleep(0.005)
+            self.assertEqual(self.batches, [[1, 2]])
+
+    def test_reject(self):
+        """
+        A rejecting buffer refuses messages that do not fit, all of them, and counts them.
+        """
+        buffer = self.buffer(max_queue=4, flush_size=1, backpressure="reject")
+        self.release.clear()
+        buffer.put([1, 2, 3])
+        with self.assertRaises(QueueFull):
+            buffer.put([4, 5, 6])
+        self.release.set()
+        buffer.close()
+        self.assertEqual([m for batch in self.batches for m in batch], [1, 2, 3])
+        self.assertEqual(buffer.stats()["rejected"], 3)
+        with self.assertRaises(RuntimeError):
+            buffer.put([7])
+
+    def test_block(self):
+        """
+        A blocking buffer waits for room, up to `put_timeout`.
+        """
+        buffer = self.buffer(max_queue=2, flush_size=1, put_timeout=0.05)
+        self.release.clear()
+        with self.assertRaises(QueueFull):
+            buffer.put(range(10))
+        self.assertEqual(buffer.stats()["blocked"], 1)
+        self.release.set()
+        buffer.put_timeout = None
+        buffer.put(range(10, 20))
+        buffer.close()
+        self.assertEqual([m for batch in self.batches for m in batch][-10:], list(range(10, 20)))
+
+    def test_errors(self):
+        """
+        Function `flush` raises the error of a failed write once, and the failed messages are counted.
+        """
+        buffer = self.buffer(flush_size=2)
+        buffer.put(["fail", 1])
+        with self.assertRaises(ValueError):
+            buffer.flush()
+        buffer.put([2])
+        buffer.flush()
+        buffer.close()
+        self.assertEqual((buffer.failed, buffer.written), (2, 1))
+
+    def test_settings(self):
+        """
+        The buffer only accepts blocking or rejecting backpressure.
+        """
+        with self.assertRaises(ValueError):
+            WriteBehindBuffer(lambda batch: None, backpressure="drop")
+
+
+if __name__ == '__main__':
+    unittest.main()